@@ -52,6 +52,42 @@
 """
 
 
+import binascii, collections, copy, csv, datetime, decimal, hashlib, heapq
+import itertools, json, math, os, pickle, shutil, tempfile, time, zlib
+
+
+# __all__ keeps "from PollyReports import *" to the public classes and
+# functions described in docs/docs.rst.
+
+__all__ = [
+    "Report", "Band", "Element", "SumElement", "TopElement", "QuantileElement",
+    "CrossTab", "Rule", "Image", "Renderer", "ImageRenderer",
+    "SortedSource", "CSVSource", "JSONLSource", "QuerySource", "Row", "rowclass",
+    "Progress", "ProfileStats", "ProfileEntry", "PageIndex", "PageEntry",
+    "StopReport", "LimitReached",
+    "NullCanvas", "PDFCanvas", "TextCanvas", "CSVCanvas", "HTMLCanvas",
+    "ReportPool", "LocalReportPool", "ReportResult", "ReportServer", "ReportClient",
+    "registerfunction", "registerformat", "compilespec", "reportfromspec",
+]
+
+
+# clock() is the timer used for profiling, progress rates and limits.
+
+clock = getattr(time, "perf_counter", time.time)
+
+
+# bindkey() resolves a key to a position in the row, if the key is
+# one of the field names in fieldindex; other keys are left alone.
+
+def bindkey(key, fieldindex):
+    if fieldindex is None:
+        return key
+    try:
+        return fieldindex.get(key, key)
+    except TypeError:
+        return key
+
+
 class Renderer(object):
 
     def __init__(self, parent, pos, font, text, align, height, onrender, width):
@@ -69,38 +105,65 @@ class Renderer(object):
         # characters in the current font are 2/3 as wide as they are
         # tall (which is probably BS).
 
+        # wrapped text of more than lazylines lines is only counted
+        # here; its lines are wrapped again as they are printed.
+
         if self.width is None:
             self.lines = text.split("\n")
         else:
-            paragraphs = text.split("\n")
-            lines = []
+            lines = self.wrap(text)
+            self.lines = list(itertools.islice(lines, self.lazylines + 1))
+            if len(self.lines) > self.lazylines:
+                count = len(self.lines)
+                for line in lines:
+                    count += 1
+                self.lines = WrappedLines(self, text, count)
+
+        self.height = height * len(self.lines)
+
+    lazylines = 1000
+
+    def wrap(self, text):
+        first = 1
+        for para in text.split("\n"):
+            if not first:
+                yield " "
+            first = 0
             curline = []
-            for para in paragraphs:
-                words = para.split()
-                for word in words:
-                    if not curline:
+            for word in para.split():
+                if not curline:
+                    curline = [ word ]
+                else:
+                    if self.calcwidth(" ".join(curline + [ word ])) > self.width:
+                        yield " ".join(curline)
                         curline = [ word ]
                     else:
-                        if self.calcwidth(" ".join(curline + [ word ])) > width:
-                            lines.append(" ".join(curline))
-                            curline = [ word ]
-                        else:
-                            curline.append(word)
-                if curline:
-                    lines.append(" ".join(curline))
-                    curline = []
-                lines.append(" ")
-            self.lines = lines[:-1]
-
-        self.height = height * len(self.lines)
+                        curline.append(word)
+            if curline:
+                yield " ".join(curline)
 
     def calcwidth(self, s):
         return len(s) * int(self.font[1] * 2 / 3 + 0.5)
 
+    # slice() returns a Renderer for lines first up to last only, for
+    # a band divided between pages.
+
+    def slice(self, first, last):
+        piece = copy.copy(self)
+        piece.lines = self.lines[first:last]
+        piece.pos = (self.pos[0], self.pos[1] + first * self.lineheight)
+        piece.height = self.lineheight * len(piece.lines)
+        if first:
+            piece.onrender = None
+        return piece
+
     def render(self, offset, canvas):
         if self.onrender is not None:
             self.onrender(self)
-        leftmargin = self.parent.report.leftmargin
+        report = self.parent.report
+        if report.elementhook is not None:
+            report.elementhook()
+        leftmargin = report.leftmargin
         canvas.setFont(*self.font)
         for text in self.lines:
             if "right".startswith(self.align):
@@ -130,6 +193,58 @@ class Renderer(object):
         return self
 
 
+# WrappedLines stands in for the list of lines of a Renderer with a
+# great deal of wrapped text.  the lines are wrapped afresh as they
+# are wanted, and as the slices taken are normally in order, page by
+# page, each continues from where the last left off.
+
+class WrappedLines(object):
+
+    def __init__(self, renderer, text, count):
+        self.renderer = renderer
+        self.text = text
+        self.count = count
+        self.restart()
+
+    def restart(self):
+        self.lines = self.renderer.wrap(self.text)
+        self.position = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.renderer.wrap(self.text)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            if index < 0:
+                index += self.count
+            return self[index:index+1][0]
+        start, stop, step = index.indices(self.count)
+        if start < self.position:
+            self.restart()
+        lines = list(itertools.islice(self.lines,
+            start - self.position, max(start, stop) - self.position))
+        self.position = max(start, stop)
+        return lines[::step]
+
+
+# _memokeys lists the types of value whose formatted text an Element
+# may memoize, with the function giving the key for each (None for
+# the value itself).  equal floats, Decimals and datetimes may still
+# be formatted differently (0.0 and -0.0, Decimal("1.0") and
+# Decimal("1.00"), the same time in different zones), so they are
+# keyed by their repr.  values of other types are always formatted.
+
+_memokeys = {
+    int: None, type(10 ** 20): None, bool: None,
+    str: None, type(u""): None, bytes: None,
+    float: repr, decimal.Decimal: repr,
+    datetime.date: repr, datetime.datetime: repr, datetime.time: repr,
+}
+
+
 class Element(object):
 
     text_conversion = str
@@ -144,9 +259,10 @@ class Element(object):
     def __init__(self, pos = None, font = None, text = None,
                  key = None, getvalue = None, sysvar = None,
                  align = "left", format = str, width = None,
-                 leading = None, onrender = None):
+                 leading = None, onrender = None, memo = 0):
         self.text = text
         self.key = key
+        self._key = key
         self._getvalue = getvalue
         self.sysvar = sysvar
         self.pos = pos
@@ -160,6 +276,13 @@ class Element(object):
             self.leading = max(1, int(font[1] * 0.4 + 0.5))
         self.onrender = onrender
 
+        # memo, if given, is the number of formatted values to keep,
+        # so that a value seen before need not be formatted again.
+        self.memo = memo
+        self._memo = {} if memo else None
+        self._memolookups = 0
+        self._memohits = 0
+
         self.report = None
         self.summary = 0 # used in SumElement, below
 
@@ -167,8 +290,40 @@ class Element(object):
         value = self.getvalue(row)
         if value is None:
             return ""
+        if self._memo is not None:
+            return self.memoformat(value)
         return self._format(value)
 
+    # values are kept by type as well, so that 1 and 1.0 are formatted
+    # separately (see _memokeys, above).  once memo values are kept, if
+    # fewer than memorate of the next memowindow are found, memoizing
+    # is given up.
+
+    memowindow = 1000
+    memorate = 0.5
+
+    def memoformat(self, value):
+        cls = value.__class__
+        try:
+            keyfunc = _memokeys[cls]
+        except KeyError:
+            return self._format(value)
+        key = (cls, value if keyfunc is None else keyfunc(value))
+        text = self._memo.get(key)
+        self._memolookups += 1
+        if text is not None:
+            self._memohits += 1
+        else:
+            text = self._format(value)
+            if len(self._memo) < self.memo:
+                self._memo[key] = text
+        if self._memolookups >= self.memowindow:
+            if len(self._memo) >= self.memo \
+            and self._memohits < self._memolookups * self.memorate:
+                self._memo = None
+            self._memolookups = self._memohits = 0
+        return text
+
     # prior to 1.6.7, self.text was returned blindly;
     # Jose Jachuf changed the behavior to encode as
     # utf8.  this evidently broke other people's code,
@@ -188,13 +343,20 @@ class Element(object):
         if self._getvalue is not None:
             return self._getvalue(row)
         if self.key is not None:
-            return row[self.key]
+            return row[self._key]
         if self.text is not None:
             return Element.text_conversion(self.text)
         if self.sysvar is not None:
             return getattr(self.report, self.sysvar)
         return None
 
+    # bind() is called at the start of Report.generate() with a dict
+    # mapping field names to positions in the row (or None), so that
+    # a named key can be looked up by index in a plain tuple row.
+
+    def bind(self, fieldindex):
+        self._key = bindkey(self.key, fieldindex)
+
     # generating an element returns a Renderer object
     # which can be used to print the element out.
 
@@ -202,6 +364,23 @@ class Element(object):
         return Renderer(self, self.pos, self.font, self.gettext(row), self.align,
             self.font[1] + self.leading, self.onrender, self.width)
 
+    # generateat() is generate() with the Renderer placed at pos
+    # instead; see Band.flatten().
+
+    def generateat(self, row, pos):
+        return Renderer(self, pos, self.font, self.gettext(row), self.align,
+            self.font[1] + self.leading, self.onrender, self.width)
+
+    # fixedheight() returns the bottom of the element, relative to its
+    # band, if it is the same for every row; that is, if the element
+    # is not wrapped and its text is a single line (Band.generate()
+    # checks the latter).  otherwise it returns None.
+
+    def fixedheight(self):
+        if self.width is not None or type(self).generate != Element.generate:
+            return None
+        return self.pos[1] + self.font[1] + self.leading
+
 
 class SumElement(Element):
 
@@ -216,6 +395,469 @@ class SumElement(Element):
             v = 0
         self.summary += v
 
+    def reset(self):
+        self.summary = 0
+
+    # savestate() and loadstate() save and restore the running total,
+    # so that a report may be resumed part way through.
+
+    def savestate(self):
+        return self.summary
+
+    def loadstate(self, state):
+        self.summary = state
+
+    # mergestate() adds in the state saved by the same element in
+    # another process, for Report.generatesharded().
+
+    def mergestate(self, state):
+        self.summary += state
+
+
+# TopElement, for group and report footers, prints the count largest
+# values (or smallest, with smallest set) of the rows summarized, one
+# per line, keeping no more than count of them in a heap.  if labelkey
+# or getlabel is given, the label of each row is printed at pos and
+# its value labelwidth points to the right, aligned by align.  rows
+# with equal values are listed in the order they came.
+
+class TopElement(Element):
+
+    def __init__(self, pos = None, font = None, text = None,
+                 key = None, getvalue = None, sysvar = None,
+                 align = "left", format = str, width = None,
+                 leading = None, onrender = None, count = 10,
+                 labelkey = None, getlabel = None, labelwidth = 100,
+                 smallest = 0):
+        Element.__init__(self, pos, font, text, key, getvalue, sysvar,
+                         align, format, width, leading, onrender)
+        self.count = count
+        self.labelkey = labelkey
+        self._labelkey = labelkey
+        self._getlabel = getlabel
+        self.labelwidth = labelwidth
+        self.smallest = smallest
+        self.reset()
+
+    def bind(self, fieldindex):
+        Element.bind(self, fieldindex)
+        self._labelkey = bindkey(self.labelkey, fieldindex)
+
+    # each entry in the heap is (sort value, -sequence, value, label),
+    # so the entry at the top of the heap is the one to drop.
+
+    def summarize(self, row):
+        value = Element.getvalue(self, row)
+        if value is None:
+            return
+        if self._getlabel is not None:
+            label = self._getlabel(row)
+        elif self.labelkey is not None:
+            label = row[self._labelkey]
+        else:
+            label = None
+        self.seq += 1
+        self.push((-value if self.smallest else value, -self.seq, value, label))
+
+    def push(self, entry):
+        if len(self.heap) < self.count:
+            heapq.heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def getvalue(self, row):
+        entries = sorted(self.heap, reverse = True)
+        self.reset()
+        return [ (value, label) for key, seq, value, label in entries ]
+
+    def reset(self):
+        self.heap = []
+        self.seq = 0
+
+    def savestate(self):
+        return (self.seq, list(self.heap))
+
+    def loadstate(self, state):
+        self.seq, heap = state
+        self.heap = list(heap)
+
+    # the rows merged in are taken to follow those already seen.
+
+    def mergestate(self, state):
+        seq, heap = state
+        for key, negseq, value, label in heap:
+            self.push((key, negseq - self.seq, value, label))
+        self.seq += seq
+
+    def generate(self, row):
+        entries = self.getvalue(row)
+        height = self.font[1] + self.leading
+        labelled = self.labelkey is not None or self._getlabel is not None
+        if self.width is not None:
+            return self.generatewrapped(entries, height, labelled)
+        values = "\n".join([ self._format(value) for value, label in entries ])
+        if not labelled:
+            return Renderer(self, self.pos, self.font, values, self.align,
+                height, self.onrender, None)
+        labels = "\n".join([ str(label).replace("\n", " ") for value, label in entries ])
+        renderers = [
+            Renderer(self, self.pos, self.font, labels, "left", height, None, None),
+            Renderer(self, (self.pos[0] + self.labelwidth, self.pos[1]), self.font,
+                values, self.align, height, self.onrender, None),
+        ]
+        return MultiRenderer(self, self.pos, renderers, renderers[0].height)
+
+    # with a width, each label (or each value, if there are no labels)
+    # is wrapped to it, the value being printed beside the first line
+    # of its label, and the entries below are moved down to suit.
+
+    def generatewrapped(self, entries, height, labelled):
+        renderers = []
+        x, y = self.pos
+        onrender = self.onrender
+        for value, label in entries:
+            text = self._format(value)
+            if labelled:
+                first = Renderer(self, (x, y), self.font,
+                    str(label).replace("\n", " "), "left", height, None, self.width)
+                renderers.append(first)
+                renderers.append(Renderer(self, (x + self.labelwidth, y), self.font,
+                    text, self.align, height, onrender, None))
+            else:
+                first = Renderer(self, (x, y), self.font, text, self.align,
+                    height, onrender, self.width)
+                renderers.append(first)
+            onrender = None
+            y += first.height
+        return MultiRenderer(self, self.pos, renderers, y - self.pos[1])
+
+
+# QuantileElement, for group and report footers, prints the given
+# quantile (0.5 for the median, 0.95 for the 95th percentile) of the
+# values of the rows summarized.  the values are counted in buckets
+# whose bounds grow by a constant ratio, so the value printed is
+# within accuracy (as a fraction) of the true one, and the number of
+# buckets, and so the memory used, depends only on the range of the
+# values.  should there ever be more than maxbuckets, the smallest are
+# combined.  bucket counts simply add, so sketches merge exactly.
+
+class QuantileElement(Element):
+
+    def __init__(self, pos = None, font = None, text = None,
+                 key = None, getvalue = None, sysvar = None,
+                 align = "left", format = str, width = None,
+                 leading = None, onrender = None, quantile = 0.5,
+                 accuracy = 0.01, maxbuckets = 2048):
+        Element.__init__(self, pos, font, text, key, getvalue, sysvar,
+                         align, format, width, leading, onrender)
+        if not 0 <= quantile <= 1:
+            raise ValueError("quantile must be between 0 and 1")
+        if not 0 < accuracy < 1:
+            raise ValueError("accuracy must be between 0 and 1")
+        self.quantile = quantile
+        self.accuracy = accuracy
+        self.maxbuckets = maxbuckets
+        self.gamma = (1.0 + accuracy) / (1.0 - accuracy)
+        self.loggamma = math.log(self.gamma)
+        self.reset()
+
+    def summarize(self, row):
+        value = Element.getvalue(self, row)
+        if value is None:
+            return
+        self.total += 1
+        if value > 0:
+            buckets = self.positive
+        elif value < 0:
+            buckets = self.negative
+            value = -value
+        else:
+            self.zeros += 1
+            return
+        i = int(math.ceil(math.log(value) / self.loggamma))
+        buckets[i] = buckets.get(i, 0) + 1
+        if len(buckets) > self.maxbuckets:
+            self.collapse(buckets)
+
+    def collapse(self, buckets):
+        keys = sorted(buckets)
+        while len(buckets) > self.maxbuckets:
+            buckets[keys[1]] += buckets.pop(keys[0])
+            keys.pop(0)
+
+    def getvalue(self, row):
+        if not self.total:
+            self.reset()
+            return None
+        rank = self.quantile * (self.total - 1)
+        seen = 0
+        value = None
+        for i in sorted(self.negative, reverse = True):
+            seen += self.negative[i]
+            if seen > rank:
+                value = -self.bucketvalue(i)
+                break
+        if value is None:
+            seen += self.zeros
+            if seen > rank:
+                value = 0
+        if value is None:
+            for i in sorted(self.positive):
+                seen += self.positive[i]
+                if seen > rank:
+                    value = self.bucketvalue(i)
+                    break
+        self.reset()
+        return value
+
+    def bucketvalue(self, i):
+        return 2 * self.gamma ** i / (self.gamma + 1)
+
+    def reset(self):
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.total = 0
+
+    def savestate(self):
+        return (dict(self.positive), dict(self.negative), self.zeros, self.total)
+
+    def loadstate(self, state):
+        positive, negative, self.zeros, self.total = state
+        self.positive = dict(positive)
+        self.negative = dict(negative)
+
+    def mergestate(self, state):
+        positive, negative, zeros, total = state
+        for buckets, other in ((self.positive, positive), (self.negative, negative)):
+            for i, n in other.items():
+                buckets[i] = buckets.get(i, 0) + n
+            if len(buckets) > self.maxbuckets:
+                self.collapse(buckets)
+        self.zeros += zeros
+        self.total += total
+
+
+# CrossTab is an element for a group or report footer which prints a
+# table of totals, rows by one value and columns by another, such as
+# regions by month.  as the rows of the group are summarized, each is
+# added to the cell for its (row value, column value) pair, kept in a
+# dict, so the rows need not be sorted in any particular order, and
+# only one entry is kept for each cell however many rows there are.
+# the rows and columns are those found in the data, sorted.
+#
+# aggregate may be "sum", "count", "min", "max" or "average"; with no
+# key or getvalue, the rows are counted.  the row labels are printed
+# at pos, the cells in columns of columnwidth points after labelwidth,
+# aligned by align, and with totals set, a total is added to the end
+# of each row and column.
+
+class CrossTab(object):
+
+    def __init__(self, pos = None, font = None,
+                 rowkey = None, getrowkey = None,
+                 columnkey = None, getcolumnkey = None,
+                 key = None, getvalue = None, aggregate = "sum",
+                 labelwidth = 100, columnwidth = 60, align = "right",
+                 format = str, headerfont = None, title = "",
+                 totals = 1, totallabel = "Total", leading = None):
+        if aggregate not in _aggregates:
+            raise ValueError("unknown aggregate %r" % (aggregate,))
+        if aggregate == "average" and key is None and getvalue is None:
+            raise ValueError("aggregate \"average\" requires key or getvalue")
+        self.pos = pos
+        self.font = font
+        self.rowkey = rowkey
+        self._rowkey = rowkey
+        self._getrowkey = getrowkey
+        self.columnkey = columnkey
+        self._columnkey = columnkey
+        self._getcolumnkey = getcolumnkey
+        self.key = key
+        self._key = key
+        self._getvalue = getvalue
+        self.aggregate = aggregate
+        self.labelwidth = labelwidth
+        self.columnwidth = columnwidth
+        self.align = align
+        self._format = format
+        self.headerfont = headerfont or font
+        self.title = title
+        self.totals = totals
+        self.totallabel = totallabel
+        if leading is not None:
+            self.leading = leading
+        else:
+            self.leading = max(1, int(font[1] * 0.4 + 0.5))
+
+        self.report = None
+        self.cells = {}
+
+    def bind(self, fieldindex):
+        self._rowkey = bindkey(self.rowkey, fieldindex)
+        self._columnkey = bindkey(self.columnkey, fieldindex)
+        self._key = bindkey(self.key, fieldindex)
+
+    def summarize(self, row):
+        if self._getrowkey is not None:
+            rowvalue = self._getrowkey(row)
+        else:
+            rowvalue = row[self._rowkey]
+        if self._getcolumnkey is not None:
+            columnvalue = self._getcolumnkey(row)
+        else:
+            columnvalue = row[self._columnkey]
+        if self.aggregate == "count" \
+        or (self._getvalue is None and self.key is None):
+            value = 1
+        else:
+            if self._getvalue is not None:
+                value = self._getvalue(row)
+            else:
+                value = row[self._key]
+            if value is None:
+                return
+            if self.aggregate == "average":
+                value = (value, 1)
+        cell = (rowvalue, columnvalue)
+        old = self.cells.get(cell)
+        if old is None:
+            self.cells[cell] = value
+        else:
+            self.cells[cell] = _aggregates[self.aggregate](old, value)
+
+    def reset(self):
+        self.cells = {}
+
+    def savestate(self):
+        return dict(self.cells)
+
+    def loadstate(self, state):
+        self.cells = dict(state)
+
+    def mergestate(self, state):
+        combine = _aggregates[self.aggregate]
+        for cell, value in state.items():
+            old = self.cells.get(cell)
+            if old is None:
+                self.cells[cell] = value
+            else:
+                self.cells[cell] = combine(old, value)
+
+    def formatvalue(self, value):
+        if value is None:
+            return ""
+        if self.aggregate == "average":
+            value = value[0] / float(value[1])
+        return self._format(value)
+
+    # generating a CrossTab lays out the table as it stands and
+    # clears it, as getting the value of a SumElement does.
+
+    def generate(self, row):
+        cells = self.cells
+        self.cells = {}
+        combine = _aggregates[self.aggregate]
+        rowtotals = {}
+        columntotals = {}
+        grandtotal = None
+        for (rowvalue, columnvalue), value in cells.items():
+            if self.totals:
+                old = rowtotals.get(rowvalue)
+                rowtotals[rowvalue] = value if old is None else combine(old, value)
+                old = columntotals.get(columnvalue)
+                columntotals[columnvalue] = value if old is None else combine(old, value)
+                grandtotal = value if grandtotal is None else combine(grandtotal, value)
+            else:
+                rowtotals[rowvalue] = columntotals[columnvalue] = None
+        rows = sortedkeys(rowtotals)
+        columns = sortedkeys(columntotals)
+
+        renderers = []
+        if not cells:
+            return MultiRenderer(self, self.pos, renderers, 0)
+        lineheight = self.font[1] + self.leading
+        headerheight = self.headerfont[1] + self.leading
+        x, y = self.pos
+        if self.title:
+            renderers.append(self.renderer((x, y), self.headerfont,
+                self.title, "left", headerheight))
+        headings = [ str(column) for column in columns ]
+        if self.totals:
+            headings.append(self.totallabel)
+        for i, heading in enumerate(headings):
+            renderers.append(self.renderer((self.columnx(i), y),
+                self.headerfont, heading, self.align, headerheight))
+        y += headerheight
+        for rowvalue in rows:
+            values = [ cells.get((rowvalue, column)) for column in columns ]
+            if self.totals:
+                values.append(rowtotals[rowvalue])
+            self.addline(renderers, y, str(rowvalue), values, lineheight)
+            y += lineheight
+        if self.totals:
+            values = [ columntotals[column] for column in columns ]
+            values.append(grandtotal)
+            self.addline(renderers, y, self.totallabel, values, lineheight)
+            y += lineheight
+        return MultiRenderer(self, self.pos, renderers, y - self.pos[1])
+
+    def addline(self, renderers, y, label, values, lineheight):
+        renderers.append(self.renderer((self.pos[0], y), self.font,
+            label, "left", lineheight))
+        for i, value in enumerate(values):
+            if value is not None:
+                renderers.append(self.renderer((self.columnx(i), y),
+                    self.font, self.formatvalue(value), self.align, lineheight))
+
+    def columnx(self, i):
+        x = self.pos[0] + self.labelwidth + i * self.columnwidth
+        if "right".startswith(self.align):
+            return x + self.columnwidth
+        if "center".startswith(self.align) or "centre".startswith(self.align):
+            return x + self.columnwidth // 2
+        return x
+
+    def renderer(self, pos, font, text, align, height):
+        return Renderer(self, pos, font, text, align, height, None, None)
+
+
+_aggregates = {
+    "sum": lambda a, b: a + b,
+    "count": lambda a, b: a + b,
+    "min": min,
+    "max": max,
+    "average": lambda a, b: (a[0] + b[0], a[1] + b[1]),
+}
+
+def sortedkeys(values):
+    try:
+        return sorted(values)
+    except TypeError:
+        return list(values)
+
+
+# MultiRenderer renders a list of Renderers as one, for an element
+# which prints more than one string.
+
+class MultiRenderer(object):
+
+    def __init__(self, parent, pos, renderers, height):
+        self.parent = parent
+        self.pos = pos
+        self.renderers = renderers
+        self.height = height
+
+    def render(self, offset, canvas):
+        for renderer in self.renderers:
+            renderer.render(offset, canvas)
+
+    def applyoffset(self, offset):
+        self.pos = (self.pos[0], self.pos[1] + offset)
+        for renderer in self.renderers:
+            renderer.applyoffset(offset)
+        return self
+
 
 class Rule(object):
 
@@ -232,7 +874,14 @@ class Rule(object):
         return "-"
 
     def generate(self, row):
-        return Rule(self.pos, self.width, self.height, self.report)
+        rule = Rule(self.pos, self.width, self.height, self.report)
+        rule.parent = self
+        return rule
+
+    def fixedheight(self):
+        if type(self).generate != Rule.generate:
+            return None
+        return self.pos[1] + self.height
 
     def render(self, offset, canvas):
         leftmargin = self.report.leftmargin
@@ -286,6 +935,7 @@ class Image(object):
         self.height = height
         self.text = text
         self.key = key
+        self._key = key
         self._getvalue = getvalue
         self.onrender = onrender
 
@@ -298,28 +948,38 @@ class Image(object):
         if self._getvalue is not None:
             return self._getvalue(row)
         if self.key is not None:
-            return row[self.key]
+            return row[self._key]
         if self.text is not None:
             return self.text
         return ""
 
+    def bind(self, fieldindex):
+        self._key = bindkey(self.key, fieldindex)
+
     def generate(self, row):
         return ImageRenderer(self, self.pos, self.width, self.height,
             self.gettext(row), self.onrender)
 
+    def fixedheight(self):
+        if type(self).generate != Image.generate:
+            return None
+        return self.pos[1] + self.height
+
 
 class Band(object):
 
     # key, getvalue and previousvalue are used only for group headers and footers
     # newpagebefore/after do not apply to detail bands, page headers, or page footers, obviously
     # newpageafter also does not apply to the report footer
+    # bookmark applies only to group headers
 
     def __init__(self, elements = None, childbands = None,
                  additionalbands = None, key = None, getvalue = None,
                  newpagebefore = 0, newpageafter = 0, hidden = 0,
-                 getrows = None):
+                 getrows = None, bookmark = None):
         self.elements = elements
         self.key = key
+        self._key = key
         self._getvalue = getvalue
         self.previousvalue = None
         self.newpagebefore = newpagebefore
@@ -328,6 +988,90 @@ class Band(object):
         self.additionalbands = additionalbands or []
         self.hidden = hidden
         self.getrows = getrows
+        self.bookmark = bookmark
+
+        # set by prepare(), below
+        self.ownheight = None
+        self.fixedheight = None
+        self.checklines = []
+        self.blocks = None
+
+    # prepare() is called at the start of Report.generate().  if
+    # every element of the band has a height which does not vary
+    # from row to row, ownheight is set to the height of the band's
+    # own elements, and generate() need not measure each row; if the
+    # child bands are fixed as well, fixedheight is the height of the
+    # whole band.
+
+    def prepare(self):
+        for band in self.childbands:
+            if hasattr(band, "prepare"):
+                band.prepare()
+        self.prepareheight()
+        if self.childbands:
+            self.blocks = self.flatten()
+        else:
+            self.blocks = None
+
+    def prepareheight(self):
+        self.ownheight = self.fixedheight = None
+        self.checklines = []
+        if self.hidden:
+            return
+        height = 0
+        for i, element in enumerate(self.elements):
+            if not hasattr(element, "fixedheight"):
+                return
+            elementheight = element.fixedheight()
+            if elementheight is None:
+                return
+            height = max(height, elementheight)
+            if isinstance(element, Element):
+                self.checklines.append(i + 1)
+        self.ownheight = height
+        for band in self.childbands:
+            if getattr(band, "fixedheight", None) is None:
+                return
+            height += band.fixedheight
+        self.fixedheight = height
+
+    # flatten() turns the band and its child bands into a list of
+    # blocks, one for each band's own elements, in the order generate()
+    # would reach them; each band's elements follow those of the bands
+    # before it.  a block's start is where it would begin if none of
+    # the blocks before it varied in height, and the position of each
+    # plain Element is worked out from it here, so that only blocks
+    # which follow one of varying height (wrapped text, say) need to
+    # be moved as each row is generated.  an element or child band
+    # which generates itself in some other way, or whose generate() has
+    # been replaced (as it is while the report is profiled), is left to
+    # do so.
+
+    def flatten(self):
+        blocks = []
+        self.flattenband(blocks, 0, 0)
+        return blocks
+
+    def flattenband(self, blocks, start, hidden):
+        hidden = hidden or self.hidden
+        entries = []
+        for i, element in enumerate(self.elements):
+            if type(element).generate == Element.generate \
+            and "generate" not in element.__dict__:
+                entries.append((element, (element.pos[0], element.pos[1] + start)))
+            else:
+                entries.append((element, None))
+        checklines = [ i - 1 for i in self.checklines ]
+        blocks.append((self, start, entries, self.ownheight, checklines, hidden))
+        if not hidden and self.ownheight is not None:
+            start += self.ownheight
+        for band in self.childbands:
+            if type(band).generate == Band.generate and hasattr(band, "flattenband") \
+            and "generate" not in band.__dict__:
+                start = band.flattenband(blocks, start, hidden)
+            else:
+                blocks.append((band, start, None, None, None, hidden))
+        return start
 
     # generating a band creates a list of Renderer objects.
     # the first element of the list is a single integer
@@ -335,6 +1079,10 @@ class Band(object):
     # list.
 
     def generate(self, row):
+        if self.blocks is not None:
+            return self.generateflat(row)
+        if self.ownheight is not None:
+            return self.generatefixed(row)
         elementlist = [ 0 ]
         for element in self.elements:
             renderer = element.generate(row)
@@ -350,6 +1098,69 @@ class Band(object):
                 elementlist[0] += childlist[0]
         return elementlist
 
+    # generatefixed() is generate() for a band of known height.  only
+    # a value containing a newline can change the height, in which
+    # case the band is measured after all.
+
+    def generatefixed(self, row):
+        elementlist = [ self.ownheight ]
+        for element in self.elements:
+            elementlist.append(element.generate(row))
+        for i in self.checklines:
+            if len(elementlist[i].lines) > 1:
+                elementlist[0] = max([ 0 ] + [ renderer.height + renderer.pos[1]
+                    for renderer in elementlist[1:] ])
+                break
+        return elementlist
+
+    # generateflat() is generate() for a band which has been flattened
+    # by prepare().  height is the height of the blocks so far, and
+    # shift is how far the current block is from its start.
+
+    def generateflat(self, row):
+        elementlist = [ 0 ]
+        height = 0
+        for band, start, entries, ownheight, checklines, hidden in self.blocks:
+            shift = height - start
+            if entries is None:
+                childlist = band.generate(row)
+                if not hidden:
+                    for renderer in childlist[1:]:
+                        renderer.applyoffset(height)
+                        elementlist.append(renderer)
+                    height += childlist[0]
+                continue
+            renderers = []
+            for element, pos in entries:
+                if pos is None:
+                    renderer = element.generate(row)
+                    if start + shift:
+                        renderer.applyoffset(start + shift)
+                elif shift:
+                    renderer = element.generateat(row, (pos[0], pos[1] + shift))
+                else:
+                    renderer = element.generateat(row, pos)
+                renderers.append(renderer)
+            if hidden:
+                continue
+            if ownheight is not None:
+                blockheight = ownheight
+                for i in checklines:
+                    if len(renderers[i].lines) > 1:
+                        blockheight = None
+                        break
+            else:
+                blockheight = None
+            if blockheight is None:
+                blockheight = 0
+                top = start + shift
+                for renderer in renderers:
+                    blockheight = max(blockheight, renderer.height + renderer.pos[1] - top)
+            elementlist.extend(renderers)
+            height += blockheight
+        elementlist[0] = height
+        return elementlist
+
     # summarize() is only used for total bands, i.e. group and
     # report footers.
 
@@ -368,9 +1179,25 @@ class Band(object):
         if self._getvalue is not None:
             return self._getvalue(row)
         if self.key is not None:
-            return row[self.key]
+            return row[self._key]
         return 0
 
+    def bind(self, fieldindex):
+        self._key = bindkey(self.key, fieldindex)
+
+    # bookmarktitle() returns the title of a group header's bookmark:
+    # what bookmark returns, if it is a function, or else the band's
+    # value.
+
+    def bookmarktitle(self, row):
+        if callable(self.bookmark):
+            title = self.bookmark(row)
+        else:
+            title = self.getvalue(row)
+        if not hasattr(title, "encode"):
+            title = str(title)
+        return totext(title)
+
     def ischanged(self, row):
         pv = self.previousvalue
         self.previousvalue = self.getvalue(row)
@@ -379,226 +1206,2574 @@ class Band(object):
         return None
 
 
-class Report(object):
+class SortedSource(object):
 
-    def __init__(self, datasource = None,
-            titleband = None, detailband = None,
-            pageheader = None, pagefooter = None,
-            reportheader = None, reportfooter = None,
-            groupheaders = None, groupfooters = None,
-            onrow = None, onnewpage = None, ondetail = None):
+    # SortedSource wraps a datasource which is not in group order,
+    # yielding its rows sorted by getkey(row).  no more than runsize
+    # rows are held in memory at once; each full run is sorted and
+    # spilled to a temporary file, and the runs are merged back together
+    # as the report consumes them.  rows must be picklable.
 
+    chunksize = 1024
+
+    def __init__(self, datasource, getkey, runsize = 100000, tempdir = None):
         self.datasource = datasource
-        self.pagesize = None
-        self.topmargin = 36
-        self.bottommargin = 36
-        self.leftmargin = 36
+        self.getkey = getkey
+        self.runsize = max(1, runsize)
+        self.tempdir = tempdir
 
-        # events
-        self.onrow = onrow
-        self.onnewpage = onnewpage
-        self.ondetail = ondetail
+    def __iter__(self):
+        runs = []
+        try:
+            run = []
+            # the sequence number keeps the sort stable and
+            # prevents the rows themselves from being compared.
+            for seq, row in enumerate(self.datasource):
+                run.append((self.getkey(row), seq, row))
+                if len(run) >= self.runsize:
+                    run.sort()
+                    runs.append(self.spill(run))
+                    run = []
+            run.sort()
+            if not runs:
+                for item in run:
+                    yield item[2]
+                return
+            merged = heapq.merge(iter(run), *[ self.readrun(f) for f in runs ])
+            for item in merged:
+                yield item[2]
+        finally:
+            for f in runs:
+                f.close()
 
-        # bands
-        self.titleband = titleband
-        self.detailband = detailband
-        self.pageheader = pageheader
-        self.pagefooter = pagefooter
-        self.reportfooter = reportfooter
-        self.reportheader = reportheader
-        self.groupheaders = groupheaders or []
-        self.groupfooters = groupfooters or []
+    def spill(self, run):
+        f = tempfile.TemporaryFile(dir = self.tempdir)
+        for i in range(0, len(run), self.chunksize):
+            pickle.dump(run[i:i+self.chunksize], f, pickle.HIGHEST_PROTOCOL)
+        f.seek(0)
+        return f
 
-        self.footerelementlist = []
+    def readrun(self, f):
+        while 1:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                return
+            for item in chunk:
+                yield item
 
-        self.pagenumber = 0
-        self.rownumber = 0
-        self.currentrow = {}
 
-        # private
-        self._sum_detail_ht = 0
-        self._avg_detail_ht = 0
-        self._max_detail_ht = 0
+class Row(tuple):
 
-    def newpage(self, canvas, row):
-        if self.onnewpage:
-            self.onnewpage(self)
-        if self.pagenumber:
-            for el in self.footerelementlist[1:]:
-                el.render(self.endofpage, canvas)
-            canvas.showPage()
-        self.pagenumber += 1
-        self.endofpage = self.pagesize[1] - self.bottommargin
-        canvas.translate(0, self.pagesize[1])
-        self.current_offset = self.topmargin
-        if self.titleband and self.pagenumber == 1:
-            elementlist = self.titleband.generate(row)
-            self.current_offset += self.addtopage(canvas, elementlist)
-        if self.pageheader:
-            elementlist = self.pageheader.generate(row)
-            self.current_offset += self.addtopage(canvas, elementlist)
-        if self.reportheader and self.pagenumber == 1:
-            elementlist = self.reportheader.generate(row)
-            self.current_offset += self.addtopage(canvas, elementlist)
-        if self.pagefooter:
-            self.footerelementlist = self.pagefooter.generate(row)
-            self.endofpage = self.pagesize[1] - self.bottommargin - elementlist[0]
+    # a Row is a tuple which may also be indexed by field name,
+    # so that Elements with key = "name" work as they would with a
+    # dict, without the memory cost of a dict per row.  use
+    # rowclass() to get the Row class for a list of field names.
 
-    def addtopage(self, canvas, elementlist):
-        for el in elementlist[1:]:
-            el.render(self.current_offset, canvas)
-        return elementlist[0]
+    __slots__ = ()
 
-    def setreference(self, bands):
-        for band in bands:
-            if band is not None:
-                for element in band.elements:
-                    element.report = self
-                self.setreference(band.childbands)
-                self.setreference(band.additionalbands)
+    fields = ()
+    _index = {}
 
-    def generate(self, canvas):
+    def __getitem__(self, key):
+        try:
+            key = self._index[key]
+        except KeyError:
+            if not isinstance(key, (int, slice)):
+                raise
+        except TypeError:
+            pass
+        return tuple.__getitem__(self, key)
 
-        # every Element in every Band needs a reference to this Report
-        self.setreference([
-            self.titleband, self.detailband,
-            self.pageheader, self.pagefooter,
-            self.reportheader, self.reportfooter,
-        ])
-        self.setreference(self.groupheaders)
-        self.setreference(self.groupfooters)
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except (KeyError, IndexError):
+            return default
 
-        self.pagesize = (int(canvas._pagesize[0]), int(canvas._pagesize[1]))
-        self.current_offset = self.pagesize[1]
-        self.pagenumber = 0
-        self.endofpage = self.pagesize[1] - self.bottommargin
-        prevrow = None
-        firstrow = 1
+    def keys(self):
+        return list(self.fields)
 
-        for row in self.datasource:
+    def __reduce__(self):
+        return (makerow, (self.fields, tuple(self)))
 
-            self.currentrow = row
 
-            if self.onrow is not None:
-                self.currentrow = row = self.onrow(row)
+_rowclasses = {}
 
-            if row is None:
-                continue
+def rowclass(fields):
+    fields = tuple(fields)
+    cls = _rowclasses.get(fields)
+    if cls is None:
+        index = dict([ (i, i) for i in range(len(fields)) ])
+        for i, name in enumerate(fields):
+            index[name] = i
+        cls = type("Row", (Row,), {
+            "__slots__": (), "fields": fields, "_index": index })
+        _rowclasses[fields] = cls
+    return cls
 
-            self.rownumber += 1
+def makerow(fields, values):
+    return rowclass(fields)(values)
 
-            if firstrow:
-                firstrow = None
-                for band in self.groupheaders:
-                    elementlist = band.generate(row)
-                    if (self.current_offset + elementlist[0]) >= self.endofpage:
-                        self.newpage(canvas, row)
-                    self.current_offset += self.addtopage(canvas, elementlist)
-                    for aband in band.additionalbands:
-                        if aband.getrows:
-                            abandrows = aband.getrows(row)
-                        else:
-                            abandrows = [ row ]
-                        for abandrow in abandrows:
-                            elementlist = aband.generate(abandrow)
-                            if (self.current_offset + elementlist[0]) >= self.endofpage:
-                                self.newpage(canvas, row)
-                            self.current_offset += self.addtopage(canvas, elementlist)
-
-            lastchanged = None
-            for i in range(len(self.groupfooters)):
-                if self.groupfooters[i].ischanged(row):
-                    lastchanged = i
-            if lastchanged is not None:
-                for i in range(lastchanged+1):
-                    elementlist = self.groupfooters[i].generate(prevrow)
-                    if self.groupfooters[i].newpagebefore \
-                    or (self.current_offset + elementlist[0]) >= self.endofpage:
-                        self.newpage(canvas, prevrow)
-                    self.current_offset += self.addtopage(canvas, elementlist)
-                    for aband in self.groupfooters[i].additionalbands:
-                        if aband.getrows:
-                            abandrows = aband.getrows(row)
-                        else:
-                            abandrows = [ row ]
-                        for abandrow in abandrows:
-                            elementlist = aband.generate(abandrow)
-                            if (self.current_offset + elementlist[0]) >= self.endofpage:
-                                self.newpage(canvas, row)
-                            self.current_offset += self.addtopage(canvas, elementlist)
-                    if self.groupfooters[i].newpageafter:
-                        self.current_offset = self.pagesize[1]
-            for band in self.groupfooters:
-                band.summarize(row)
-
-            firstchanged = None
-            for i in range(len(self.groupheaders)):
-                if self.groupheaders[i].ischanged(row):
-                    if firstchanged is None:
-                        firstchanged = i
-            if firstchanged is not None:
-                for i in range(firstchanged, len(self.groupheaders)):
-                    elementlist = self.groupheaders[i].generate(row)
-                    if self.groupheaders[i].newpagebefore \
-                    or (self.current_offset + elementlist[0] + self._avg_detail_ht) >= self.endofpage:
-                        self.newpage(canvas, row)
-                    self.current_offset += self.addtopage(canvas, elementlist)
-                    for aband in self.groupheaders[i].additionalbands:
-                        if aband.getrows:
-                            abandrows = aband.getrows(row)
-                        else:
-                            abandrows = [ row ]
-                        for abandrow in abandrows:
-                            elementlist = aband.generate(abandrow)
-                            if (self.current_offset + elementlist[0]) >= self.endofpage:
-                                self.newpage(canvas, row)
-                            self.current_offset += self.addtopage(canvas, elementlist)
-                    if self.groupheaders[i].newpageafter:
-                        self.current_offset = self.pagesize[1]
-
-            if self.detailband is not None:
+
+class FileSource(object):
+
+    # FileSource is the base for the streaming file datasources below.
+    # the file is read in large buffered chunks (or through mmap, if
+    # usemmap is set) each time the source is iterated, and each row
+    # is produced as a Row, with the values of any column named in
+    # types converted once, as the row is read.  empty values in
+    # typed columns become None.
+    #
+    # tell() returns the byte offset of the row most recently read,
+    # and rowsfrom() reads rows starting at such an offset; these let
+    # Report.generatepages() seek directly to a page.
+
+    def __init__(self, filename, fields = None, types = None,
+                 encoding = "utf-8", buffersize = 1 << 20, usemmap = 0):
+        self.filename = filename
+        self.fields = fields and tuple(fields)
+        self.fieldsgiven = fields is not None
+        self.types = types or {}
+        self.encoding = encoding
+        self.buffersize = buffersize
+        self.usemmap = usemmap
+        self.consumed = 0
+        self.position = 0
+
+    def __iter__(self):
+        return self.rowsfrom(0)
+
+    def tell(self):
+        return self.position
+
+    # readfields() returns the field names, reading them from the file
+    # afresh (in case it has been rewritten) unless they were given.
+    # Report.prepare() calls it, so that named keys are bound to the
+    # right columns before the first row is read.
+
+    def readfields(self):
+        if not self.fieldsgiven:
+            self.fields = self.fieldsinfile()
+        return self.fields
+
+    def fieldsinfile(self):
+        return None
+
+    def firstline(self):
+        f = open(self.filename, "rb")
+        try:
+            for line in f:
+                if line.strip():
+                    return line.decode(self.encoding)
+        finally:
+            f.close()
+        return None
+
+    def lines(self, start = 0):
+        self.consumed = start
+        f = open(self.filename, "rb", self.buffersize)
+        try:
+            if self.usemmap:
+                import mmap
+                try:
+                    m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+                except ValueError:
+                    return # empty file
+                try:
+                    m.seek(start)
+                    readline = m.readline
+                    line = readline()
+                    while line:
+                        self.consumed += len(line)
+                        yield line
+                        line = readline()
+                finally:
+                    m.close()
+            else:
+                f.seek(start)
+                for line in f:
+                    self.consumed += len(line)
+                    yield line
+        finally:
+            f.close()
+
+    def converters(self):
+        return [ self.types.get(name) for name in self.fields ]
+
+    # fingerprint() identifies the file's contents by its size and
+    # modification time, for Report's output cache, along with the
+    # options it is read with.  field names read from the file itself
+    # are covered by the former.
+
+    def fingerprint(self):
+        st = os.stat(self.filename)
+        skip = ("consumed", "position", "buffersize", "usemmap")
+        if not self.fieldsgiven:
+            skip += ("fields",)
+        options = dict([ (k, v) for k, v in vars(self).items() if k not in skip ])
+        options["filename"] = os.path.abspath(self.filename)
+        return (type(self).__name__, st.st_size, st.st_mtime, describe(options))
+
+    def makerows(self, values):
+        # the field names may not be known until the first row is read.
+        values = iter(values)
+        first = next(values, None)
+        if first is None:
+            return
+        values = itertools.chain([ first ], values)
+        cls = rowclass(self.fields)
+        converters = self.converters()
+        if not [ c for c in converters if c is not None ]:
+            for row in values:
+                yield cls(row)
+            return
+        converters = list(enumerate(converters))
+        for row in values:
+            for i, convert in converters:
+                if convert is not None:
+                    v = row[i]
+                    if v == "" or v is None:
+                        row[i] = None
+                    else:
+                        row[i] = convert(v)
+            yield cls(row)
+
+
+class CSVSource(FileSource):
+
+    # if fields is not given, the first line of the file is taken
+    # as the field names; if it is given and the file also has a
+    # header line, set header = 1 so the header is skipped.  any
+    # other keyword arguments are passed to csv.reader.
+
+    def __init__(self, filename, fields = None, types = None,
+                 encoding = "utf-8", buffersize = 1 << 20, usemmap = 0,
+                 header = None, **csvoptions):
+        FileSource.__init__(self, filename, fields, types,
+                            encoding, buffersize, usemmap)
+        if header is None:
+            header = fields is None
+        if not header and fields is None:
+            raise ValueError("CSVSource needs fields when the file has no header line")
+        self.header = header
+        self.csvoptions = csvoptions
+
+    def reader(self, start):
+        encoding = self.encoding
+        return csv.reader(
+            (line.decode(encoding) for line in self.lines(start)),
+            **self.csvoptions)
+
+    def fieldsinfile(self):
+        if not self.header:
+            return None
+        line = self.firstline()
+        if line is None:
+            return None
+        return tuple(next(csv.reader([ line ], **self.csvoptions)))
+
+    def rowsfrom(self, start):
+        if self.header and self.fields is None and start > 0:
+            # starting partway through, the field names must still
+            # come from the header line.
+            if self.readfields() is None:
+                return
+        reader = self.reader(start)
+        if self.header and start == 0:
+            fields = next(reader, None)
+            if fields is None:
+                return
+            if not self.fieldsgiven:
+                self.fields = tuple(fields)
+        for row in self.makerows(self.positioned(reader)):
+            yield row
+        self.position = self.consumed
+
+    # csv.reader reads only as many lines as each row needs, so the
+    # bytes consumed before a row is read give its starting offset.
+
+    def positioned(self, reader):
+        while 1:
+            position = self.consumed
+            row = next(reader, None)
+            if row is None:
+                return
+            self.position = position
+            yield row
+
+
+class JSONLSource(FileSource):
+
+    # each line of the file holds one JSON object.  if fields is
+    # not given, the keys of the first object are used; keys missing
+    # from a later object read as None.
+
+    def fieldsinfile(self):
+        line = self.firstline()
+        if line is None:
+            return None
+        return tuple(json.loads(line))
+
+    def rowsfrom(self, start):
+        if not self.fieldsgiven:
+            if start == 0:
+                self.fields = None
+            elif self.fields is None and self.readfields() is None:
+                return
+        for row in self.makerows(self.values(json.loads, start)):
+            yield row
+        self.position = self.consumed
+
+    def values(self, loads, start):
+        encoding = self.encoding
+        for line in self.lines(start):
+            position = self.consumed - len(line)
+            line = line.strip()
+            if not line:
+                continue
+            obj = loads(line.decode(encoding))
+            if self.fields is None:
+                self.fields = tuple(obj)
+            self.position = position
+            yield [ obj.get(name) for name in self.fields ]
+
+
+class QuerySource(object):
+
+    # QuerySource runs a query on a DB-API connection each time it is
+    # iterated, yielding each result row as a Row.  rowsfrom() reruns
+    # the query starting at a given row, using offsetquery to add an
+    # OFFSET clause; the default suits SQLite, while PostgreSQL needs
+    # "%s OFFSET %d" and MySQL "%s LIMIT 18446744073709551615 OFFSET %d"
+    # (MySQL rejects LIMIT -1).
+    #
+    # fingerprintquery, if given, is a query (taking the same params)
+    # whose result changes whenever the data does, such as the
+    # latest update time of the rows selected; it lets fingerprint()
+    # identify the data for Report's output cache.
+
+    def __init__(self, connection, query, params = (),
+                 offsetquery = "%s LIMIT -1 OFFSET %d",
+                 fingerprintquery = None):
+        self.connection = connection
+        self.query = query
+        self.params = params
+        self.offsetquery = offsetquery
+        self.fingerprintquery = fingerprintquery
+        self.fields = None
+
+    def fingerprint(self):
+        if self.fingerprintquery is None:
+            return None
+        cursor = self.connection.cursor()
+        cursor.execute(self.fingerprintquery, self.params)
+        return (self.query, tuple(self.params), repr(cursor.fetchall()))
+
+    def __iter__(self):
+        return self.execute(self.query)
+
+    def rowsfrom(self, offset):
+        if not offset:
+            return self.execute(self.query)
+        return self.execute(self.offsetquery % (self.query, offset))
+
+    def execute(self, query):
+        cursor = self.connection.cursor()
+        cursor.execute(query, self.params)
+        self.fields = tuple([ column[0] for column in cursor.description ])
+        cls = rowclass(self.fields)
+        return (cls(row) for row in cursor)
+
+
+# PositionedRows is the rows a datasource gives from partway through,
+# by rowsfrom(), along with the datasource's tell(), so that run()
+# goes on recording positions as the datasource counts them (byte
+# offsets, for a FileSource) rather than counting rows from there.
+
+class PositionedRows(object):
+
+    def __init__(self, rows, tell):
+        self.rows = rows
+        self.tell = tell
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class RecordingCanvas(object):
+
+    # RecordingCanvas passes every call through to another canvas,
+    # also appending it to ops while ops is a list.
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self._pagesize = canvas._pagesize
+        self.ops = None
+
+    def __getattr__(self, name):
+        attr = getattr(self.canvas, name)
+        if not callable(attr):
+            return attr
+        def method(*args, **kwargs):
+            if self.ops is not None:
+                self.ops.append((name, args, kwargs))
+            return attr(*args, **kwargs)
+        setattr(self, name, method)
+        return method
+
+
+# Progress is passed to Report.onprogress.  rate is in rows per
+# second, and eta, the estimated number of seconds remaining, is
+# known only when the datasource has a length.
+
+class Progress(object):
+
+    def __init__(self, rows, pages, elapsed, rate, pagerate, total, done):
+        self.rows = rows
+        self.pages = pages
+        self.elapsed = elapsed
+        self.rate = rate
+        self.pagerate = pagerate
+        self.total = total
+        self.done = done
+        self.eta = None
+        if done:
+            self.eta = 0.0
+        elif total is not None and rate:
+            self.eta = max(0, total - rows) / rate
+
+    def __repr__(self):
+        return "<Progress %d rows, %d pages, %.1f s>" % (self.rows, self.pages, self.elapsed)
+
+
+# ProfileStats holds the call counts and times recorded when a Report
+# is generated with profile set.  there is a ProfileEntry for each
+# band and element, named for where it is found in the report (e.g.
+# "groupfooters[1].elements[0]"), and one named "report" timing
+# Report.newpage().  the times are cumulative, so a band's generate
+# time includes that of its elements.
+
+_notwrapped = object()
+
+
+class ProfileEntry(object):
+
+    def __init__(self, name, obj):
+        self.name = name
+        self.obj = obj
+        self.calls = {}
+        self.times = {}
+
+    def add(self, operation, seconds):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+        self.times[operation] = self.times.get(operation, 0.0) + seconds
+
+    def __repr__(self):
+        return "<ProfileEntry %s %r>" % (self.name, self.times)
+
+
+class ProfileStats(object):
+
+    def __init__(self):
+        self.entries = []
+        self.byname = {}
+        self.byid = {}
+        self.elapsed = 0.0
+
+    def add(self, name, obj):
+        entry = ProfileEntry(name, obj)
+        self.entries.append(entry)
+        self.byname[name] = entry
+        self.byid[id(obj)] = entry
+        return entry
+
+    def __getitem__(self, name):
+        return self.byname[name]
+
+    # rows() returns (name, operation, calls, seconds) for everything
+    # which was called at all, the most time-consuming first.
+
+    def rows(self):
+        rows = []
+        for entry in self.entries:
+            for operation, calls in entry.calls.items():
+                rows.append((entry.name, operation, calls, entry.times[operation]))
+        rows.sort(key = lambda row: -row[3])
+        return rows
+
+    def __str__(self):
+        lines = [ "%-40s %-10s %10s %10s" % ("name", "operation", "calls", "seconds") ]
+        for row in self.rows():
+            lines.append("%-40s %-10s %10d %10.4f" % row)
+        lines.append("total elapsed %.4f seconds" % self.elapsed)
+        return "\n".join(lines)
+
+
+class StopReport(Exception):
+
+    # raised within Report.generate() to end the report early; the
+    # pages already drawn are kept.
+
+    pass
+
+
+class LimitReached(StopReport):
+
+    # LimitReached is returned by Report.generate() when the report was
+    # stopped by one of its limits (maxpages, maxrows, maxseconds or
+    # maxbytes) or by cancel; reason is "pages", "rows", "time",
+    # "bytes" or "cancelled".
+
+    def __init__(self, reason, pages, rows):
+        StopReport.__init__(self, reason)
+        self.reason = reason
+        self.pages = pages
+        self.rows = rows
+
+    def __repr__(self):
+        return "<LimitReached %s: %d pages, %d rows>" % (
+            self.reason, self.pages, self.rows)
+
+
+class NullCanvas(object):
+
+    # NullCanvas is a canvas-like object which draws nothing.  it is
+    # used by Report.paginate().
+
+    def __init__(self, pagesize):
+        self._pagesize = pagesize
+
+    def _ignore(self, *args, **kwargs):
+        pass
+
+    drawAlignedString = drawCentredString = drawRightString = \
+    drawString = drawImage = line = restoreState = saveState = \
+    setFont = setLineWidth = setStrokeGray = showPage = translate = \
+    _ignore
+
+
+# PDFCanvas is a small, fast PDF writer for reports which use only
+# Elements and Rules in the standard PDF fonts.  it implements just
+# the canvas methods PollyReports uses (plus save()), so it may be
+# passed to Report.generate() in place of a Reportlab Canvas.  each
+# page's content stream is compressed and written to the file as
+# soon as the page is finished (or, with threads, as soon as its turn
+# comes), so only a few pages are held in memory.
+#
+# text is written in WinAnsiEncoding (i.e. cp1252); characters
+# outside it print as "?".  the widths below, for codes 32 through
+# 255, are used to align right-aligned and centred text; the Oblique
+# Helvetica fonts share the upright fonts' widths, and every Courier
+# character is 600 units wide.
+
+_standardwidths = {
+    "Helvetica": """
+        278 278 355 556 556 889 667 191 333 333 389 584 278 333 278 278
+        556 556 556 556 556 556 556 556 556 556 278 278 584 584 584 556
+        1015 667 667 722 722 667 611 778 722 278 500 667 556 833 722 778
+        667 778 722 667 611 722 667 944 667 667 611 278 278 278 469 556
+        333 556 556 500 556 556 278 556 556 222 222 500 222 833 556 556
+        556 556 333 500 278 556 500 722 500 500 500 334 260 334 584 350
+        556 350 222 556 333 1000 556 556 333 1000 667 333 1000 350 611 350
+        350 222 222 333 333 350 556 1000 333 1000 500 333 944 350 500 667
+        278 333 556 556 556 556 260 556 333 737 370 556 584 333 737 333
+        400 584 333 333 333 556 537 278 333 333 365 556 834 834 834 611
+        667 667 667 667 667 667 1000 722 667 667 667 667 278 278 278 278
+        722 722 778 778 778 778 778 584 778 722 722 722 722 667 667 611
+        556 556 556 556 556 556 889 500 556 556 556 556 278 278 278 278
+        556 556 556 556 556 556 556 584 611 556 556 556 556 500 556 500
+    """,
+    "Helvetica-Bold": """
+        278 333 474 556 556 889 722 238 333 333 389 584 278 333 278 278
+        556 556 556 556 556 556 556 556 556 556 333 333 584 584 584 611
+        975 722 722 722 722 667 611 778 722 278 556 722 611 833 722 778
+        667 778 722 667 611 722 667 944 667 667 611 333 278 333 584 556
+        333 556 611 556 611 556 333 611 611 278 278 556 278 889 611 611
+        611 611 389 556 333 611 556 778 556 556 500 389 280 389 584 350
+        556 350 278 556 500 1000 556 556 333 1000 667 333 1000 350 611 350
+        350 278 278 500 500 350 556 1000 333 1000 556 333 944 350 500 667
+        278 333 556 556 556 556 280 556 333 737 370 556 584 333 737 333
+        400 584 333 333 333 611 556 278 333 333 365 556 834 834 834 611
+        722 722 722 722 722 722 1000 722 667 667 667 667 278 278 278 278
+        722 722 778 778 778 778 778 584 778 722 722 722 722 667 667 611
+        556 556 556 556 556 556 889 556 556 556 556 556 278 278 278 278
+        611 611 611 611 611 611 611 584 611 611 611 611 611 556 611 556
+    """,
+    "Times-Roman": """
+        250 333 408 500 500 833 778 180 333 333 500 564 250 333 250 278
+        500 500 500 500 500 500 500 500 500 500 278 278 564 564 564 444
+        921 722 667 667 722 611 556 722 722 333 389 722 611 889 722 722
+        556 722 667 556 611 722 722 944 722 722 611 333 278 333 469 500
+        333 444 500 444 500 444 333 500 500 278 278 500 278 778 500 500
+        500 500 333 389 278 500 500 722 500 500 444 480 200 480 541 350
+        500 350 333 500 444 1000 500 500 333 1000 556 333 889 350 611 350
+        350 333 333 444 444 350 500 1000 333 980 389 333 722 350 444 722
+        250 333 500 500 500 500 200 500 333 760 276 500 564 333 760 333
+        400 564 300 300 333 500 453 250 333 300 310 500 750 750 750 444
+        722 722 722 722 722 722 889 667 611 611 611 611 333 333 333 333
+        722 722 722 722 722 722 722 564 722 722 722 722 722 722 556 500
+        444 444 444 444 444 444 667 444 444 444 444 444 278 278 278 278
+        500 500 500 500 500 500 500 564 500 500 500 500 500 500 500 500
+    """,
+    "Times-Bold": """
+        250 333 555 500 500 1000 833 278 333 333 500 570 250 333 250 278
+        500 500 500 500 500 500 500 500 500 500 333 333 570 570 570 500
+        930 722 667 722 722 667 611 778 778 389 500 778 667 944 722 778
+        611 778 722 556 667 722 722 1000 722 722 667 333 278 333 581 500
+        333 500 556 444 556 444 333 500 556 278 333 556 278 833 556 500
+        556 556 444 389 333 556 500 722 500 500 444 394 220 394 520 350
+        500 350 333 500 500 1000 500 500 333 1000 556 333 1000 350 667 350
+        350 333 333 500 500 350 500 1000 333 1000 389 333 722 350 444 722
+        250 333 500 500 500 500 220 500 333 747 300 500 570 333 747 333
+        400 570 300 300 333 556 540 250 333 300 330 500 750 750 750 500
+        722 722 722 722 722 722 1000 722 667 667 667 667 389 389 389 389
+        722 722 778 778 778 778 778 570 778 722 722 722 722 722 611 556
+        500 500 500 500 500 500 722 444 444 444 444 444 278 278 278 278
+        500 556 500 500 500 500 500 570 500 556 556 556 556 500 556 500
+    """,
+    "Times-Italic": """
+        250 333 420 500 500 833 778 214 333 333 500 675 250 333 250 278
+        500 500 500 500 500 500 500 500 500 500 333 333 675 675 675 500
+        920 611 611 667 722 611 611 722 722 333 444 667 556 833 667 722
+        611 722 611 500 556 722 611 833 611 556 556 389 278 389 422 500
+        333 500 500 444 500 444 278 500 500 278 278 444 278 722 500 500
+        500 500 389 389 278 500 444 667 444 444 389 400 275 400 541 350
+        500 350 333 500 556 889 500 500 333 1000 500 333 944 350 556 350
+        350 333 333 556 556 350 500 889 333 980 389 333 667 350 389 556
+        250 389 500 500 500 500 275 500 333 760 276 500 675 333 760 333
+        400 675 300 300 333 500 523 250 333 300 310 500 750 750 750 500
+        611 611 611 611 611 611 889 667 611 611 611 611 333 333 333 333
+        722 667 722 722 722 722 722 675 722 722 722 722 722 556 611 500
+        500 500 500 500 500 500 667 444 444 444 444 444 278 278 278 278
+        500 500 500 500 500 500 500 675 500 500 500 500 500 444 500 444
+    """,
+    "Times-BoldItalic": """
+        250 389 555 500 500 833 778 278 333 333 500 570 250 333 250 278
+        500 500 500 500 500 500 500 500 500 500 333 333 570 570 570 500
+        832 667 667 667 722 667 667 722 778 389 500 667 611 889 722 722
+        611 722 667 556 611 722 667 889 667 611 611 333 278 333 570 500
+        333 500 500 444 500 444 333 500 556 278 278 500 278 778 556 500
+        500 500 389 389 278 556 444 667 500 444 389 348 220 348 570 350
+        500 350 333 500 500 1000 500 500 333 1000 556 333 944 350 611 350
+        350 333 333 500 500 350 500 1000 333 1000 389 333 722 350 389 611
+        250 389 500 500 500 500 220 500 333 747 266 500 606 333 747 333
+        400 570 300 300 333 576 500 250 333 300 300 500 750 750 750 500
+        667 667 667 667 667 667 944 667 667 667 667 667 389 389 389 389
+        722 722 722 722 722 722 722 570 722 722 722 722 722 611 611 500
+        500 500 500 500 500 500 722 444 444 444 444 444 278 278 278 278
+        500 556 500 500 500 500 500 570 500 556 556 556 556 444 500 444
+    """,
+}
+
+for _name in list(_standardwidths):
+    _standardwidths[_name] = [ int(w) for w in _standardwidths[_name].split() ]
+_standardwidths["Helvetica-Oblique"] = _standardwidths["Helvetica"]
+_standardwidths["Helvetica-BoldOblique"] = _standardwidths["Helvetica-Bold"]
+for _name in ("Courier", "Courier-Bold", "Courier-Oblique", "Courier-BoldOblique"):
+    _standardwidths[_name] = [ 600 ] * 224
+del _name
+
+
+def pdfnumber(n):
+    if n == int(n):
+        return "%d" % n
+    return ("%.3f" % n).rstrip("0").rstrip(".")
+
+
+def pdfencode(text):
+    if isinstance(text, bytes):
+        try:
+            text = text.decode("utf-8")
+        except UnicodeError:
+            text = text.decode("latin-1")
+    return text.encode("cp1252", "replace")
+
+
+def pdfstring(text):
+    return pdfencode(text).replace(b"\\", b"\\\\").replace(b"(", b"\\(") \
+                          .replace(b")", b"\\)").replace(b"\r", b"\\r")
+
+
+# pdftext() returns a text string for the document itself, such as an
+# outline title, which unlike page text may be in any language.
+
+def pdftext(text):
+    text = totext(text)
+    try:
+        text.encode("ascii")
+    except UnicodeError:
+        return b"<FEFF" + binascii.hexlify(text.encode("utf-16-be")).upper() + b">"
+    return b"(" + pdfstring(text) + b")"
+
+
+class PDFCanvas(object):
+
+    # filename may be a file name or a file object opened for binary
+    # writing.  the file is not created until the first page is done,
+    # so that resume() may carry on with an existing file.  if filename
+    # is None, nothing is written; the finished page contents are kept
+    # in pages instead, for addpages() on another PDFCanvas.
+    #
+    # level is the zlib compression level.  if threads is given, the
+    # pages are compressed by that many threads (zlib lets others run
+    # meanwhile), with up to twice as many pages waiting at a time;
+    # they are still written in order, so the file is the same.
+
+    def __init__(self, filename, pagesize = (612, 792), compress = 1,
+                 level = 6, threads = 0):
+        self.filename = filename
+        self._pagesize = pagesize or (612, 792)
+        self.compress = compress
+        self.level = level
+        self.threads = threads
+        self.pool = None
+        self.pending = collections.deque()
+        self.file = None
+        self.offsets = {}
+        self.pageids = []
+        self.pages = []
+        self.pagefonts = []     # the fonts first used on each page kept
+        self.newfonts = []
+        self.pagebytes = 0
+        self.outlines = []      # (title, level, page index, top)
+        self.fonts = {}         # font name -> (resource name, object id)
+        self.nextid = 4         # 1: catalog, 2: page tree, 3: resources
+        self.ops = []
+        self.font = None
+        self.fontsize = None
+        self.fontstack = []
+
+    # drawing
+
+    def setFont(self, name, size):
+        if name not in _standardwidths:
+            raise ValueError("PDFCanvas supports only the standard fonts, not %s" % name)
+        if name not in self.fonts:
+            self.addfont(name)
+        self.font = name
+        self.fontsize = size
+
+    def stringWidth(self, text, name = None, size = None):
+        widths = _standardwidths[name or self.font]
+        total = 0
+        for c in bytearray(pdfencode(text)):
+            if c >= 32:
+                total += widths[c - 32]
+        return total * (size or self.fontsize) / 1000.0
+
+    def drawString(self, x, y, text):
+        if self.font is None:
+            self.setFont("Helvetica", 12)
+        self.ops.append(("BT /%s %s Tf %s %s Td (" % (self.fonts[self.font][0],
+            pdfnumber(self.fontsize), pdfnumber(x), pdfnumber(y))).encode("ascii")
+            + pdfstring(text) + b") Tj ET")
+
+    def drawRightString(self, x, y, text):
+        if self.font is None:
+            self.setFont("Helvetica", 12)
+        self.drawString(x - self.stringWidth(text), y, text)
+
+    def drawCentredString(self, x, y, text):
+        if self.font is None:
+            self.setFont("Helvetica", 12)
+        self.drawString(x - self.stringWidth(text) / 2.0, y, text)
+
+    # as with Reportlab, the centre of the first pivotChar is placed
+    # at x; text without one is aligned after its last digit.
+
+    def drawAlignedString(self, x, y, text, pivotChar = "."):
+        if self.font is None:
+            self.setFont("Helvetica", 12)
+        i = text.find(pivotChar)
+        if i < 0:
+            i = len(text)
+            while i > 0 and text[i-1] not in "0123456789":
+                i -= 1
+            if i == 0:
+                i = len(text)
+        x -= self.stringWidth(pivotChar) / 2.0
+        self.drawString(x - self.stringWidth(text[:i]), y, text)
+
+    def drawImage(self, *args, **kwargs):
+        raise TypeError("PDFCanvas does not draw images")
+
+    # bookmark() adds an entry to the document outline for the page
+    # being drawn, top being in points from the bottom of the page.
+
+    def bookmark(self, title, level, top):
+        self.outlines.append((title, level,
+            len(self.pageids) + len(self.pages) + len(self.pending), top))
+
+    def line(self, x1, y1, x2, y2):
+        self.ops.append(("%s %s m %s %s l S" % (pdfnumber(x1), pdfnumber(y1),
+            pdfnumber(x2), pdfnumber(y2))).encode("ascii"))
+
+    def setLineWidth(self, width):
+        self.ops.append(("%s w" % pdfnumber(width)).encode("ascii"))
+
+    def setStrokeGray(self, gray):
+        self.ops.append(("%s G" % pdfnumber(gray)).encode("ascii"))
+
+    def saveState(self):
+        self.fontstack.append((self.font, self.fontsize))
+        self.ops.append(b"q")
+
+    def restoreState(self):
+        self.font, self.fontsize = self.fontstack.pop()
+        self.ops.append(b"Q")
+
+    def translate(self, dx, dy):
+        self.ops.append(("1 0 0 1 %s %s cm" % (pdfnumber(dx), pdfnumber(dy))).encode("ascii"))
+
+    # output
+
+    # outputsize() is the number of bytes written so far, or with no
+    # file, the size of the pages kept.
+
+    def outputsize(self):
+        if self.filename is None:
+            return self.pagebytes
+        if self.file is None:
+            return 0
+        return self.position
+
+    def allocate(self):
+        objid = self.nextid
+        self.nextid += 1
+        return objid
+
+    def open(self):
+        if hasattr(self.filename, "write"):
+            self.file = self.filename
+            self.position = 0
+        else:
+            self.file = open(self.filename, "wb")
+            self.position = 0
+        self.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def write(self, data):
+        self.file.write(data)
+        self.position += len(data)
+
+    def writeobject(self, objid, data):
+        if self.file is None:
+            self.open()
+        self.offsets[objid] = self.position
+        self.write(("%d 0 obj\n" % objid).encode("ascii") + data + b"\nendobj\n")
+
+    # font resources are named after the font, so that page contents
+    # made by one PDFCanvas may be added to another.
+
+    def addfont(self, name):
+        self.fonts[name] = ("F" + name.replace("-", ""), self.allocate())
+        self.newfonts.append(name)
+
+    def makestream(self, data):
+        if self.compress:
+            data = zlib.compress(data, self.level)
+            header = "<< /Length %d /Filter /FlateDecode >>" % len(data)
+        else:
+            header = "<< /Length %d >>" % len(data)
+        return header.encode("ascii") + b"\nstream\n" + data + b"\nendstream"
+
+    def writestream(self, objid, data):
+        self.writeobject(objid, self.makestream(data))
+
+    def writepage(self, stream):
+        contentid = self.allocate()
+        pageid = self.allocate()
+        self.writeobject(contentid, stream)
+        self.writeobject(pageid, ("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] "
+            "/Resources 3 0 R /Contents %d 0 R >>" % (pdfnumber(self._pagesize[0]),
+            pdfnumber(self._pagesize[1]), contentid)).encode("ascii"))
+        self.pageids.append(pageid)
+
+    def showPage(self):
+        data = b"\n".join(self.ops)
+        if self.filename is None:
+            self.pagefonts.append(self.newfonts)
+        self.newfonts = []
+        if self.threads and self.compress:
+            if self.pool is None:
+                from multiprocessing.pool import ThreadPool
+                self.pool = ThreadPool(self.threads)
+            self.pending.append(self.pool.apply_async(self.makestream, (data,)))
+            while len(self.pending) > self.threads * 2:
+                self.addstream(self.pending.popleft().get())
+        else:
+            self.addstream(self.makestream(data))
+        self.ops = []
+        self.font = self.fontsize = None
+        self.fontstack = []
+
+    def addstream(self, stream):
+        if self.filename is None:
+            self.pages.append(stream)
+            self.pagebytes += len(stream)
+        else:
+            self.writepage(stream)
+
+    # flush() waits for the pages being compressed, and writes them.
+
+    def flush(self):
+        while self.pending:
+            self.addstream(self.pending.popleft().get())
+
+    # addpages() appends the pages kept by a PDFCanvas made with no
+    # file name, given its fonts and pages; Report.generatesharded()
+    # uses it to put together pages drawn in other processes.  given
+    # pagefonts as well, each font is added just before the page which
+    # first uses it, as it would have been had the pages been drawn
+    # here, so the file is the same.
+
+    def addpages(self, fonts, pages, outlines = (), pagefonts = None):
+        self.flush()
+        first = len(self.pageids)
+        for title, level, page, top in outlines:
+            self.outlines.append((title, level, first + page, top))
+        for i, stream in enumerate(pages):
+            if pagefonts is not None:
+                for name in pagefonts[i]:
+                    if name not in self.fonts:
+                        self.addfont(name)
+            self.writepage(stream)
+        for name in fonts:
+            if name not in self.fonts:
+                self.addfont(name)
+
+    def save(self):
+        if self.ops or not (self.pageids or self.pages or self.pending):
+            self.showPage()
+        self.flush()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.filename is None:
+            return
+        fonts = sorted(self.fonts.items(), key = lambda item: item[1][1])
+        for name, (resource, objid) in fonts:
+            self.writeobject(objid, ("<< /Type /Font /Subtype /Type1 /BaseFont /%s "
+                "/Encoding /WinAnsiEncoding >>" % name).encode("ascii"))
+        self.writeobject(3, ("<< /ProcSet [/PDF /Text] /Font << %s >> >>"
+            % " ".join([ "/%s %d 0 R" % (resource, objid)
+                         for name, (resource, objid) in fonts ])).encode("ascii"))
+        self.writeobject(2, ("<< /Type /Pages /Count %d /Kids [%s] >>"
+            % (len(self.pageids), " ".join([ "%d 0 R" % i for i in self.pageids ]))).encode("ascii"))
+        if self.outlines:
+            self.writeobject(1, ("<< /Type /Catalog /Pages 2 0 R /Outlines %d 0 R "
+                "/PageMode /UseOutlines >>" % self.writeoutlines()).encode("ascii"))
+        else:
+            self.writeobject(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        xref = self.position
+        lines = [ "xref", "0 %d" % self.nextid, "0000000000 65535 f " ]
+        for objid in range(1, self.nextid):
+            lines.append("%010d 00000 n " % self.offsets.get(objid, 0))
+        lines.append("trailer")
+        lines.append("<< /Size %d /Root 1 0 R >>" % self.nextid)
+        lines.append("startxref")
+        lines.append("%d" % xref)
+        lines.append("%%EOF\n")
+        self.write("\n".join(lines).encode("ascii"))
+        if self.file is not self.filename:
+            self.file.close()
+        else:
+            self.file.flush()
+        self.file = None
+
+    # the outline is written as a tree, each entry nested within the
+    # last before it of a lower level; entries with others nested
+    # within them start out closed.
+
+    def writeoutlines(self):
+        root = [ self.allocate(), None, None, None, [] ]
+        stack = [ (-1, root) ]
+        for title, level, page, top in self.outlines:
+            while stack[-1][0] >= level:
+                stack.pop()
+            node = [ self.allocate(), title, page, top, [] ]
+            stack[-1][1][4].append(node)
+            stack.append((level, node))
+        self.writeoutline(root, None, None, None)
+        return root[0]
+
+    def writeoutline(self, node, parentid, previd, nextid):
+        objid, title, page, top, children = node
+        if title is None:
+            fields = [ b"/Type /Outlines", ("/Count %d" % len(children)).encode("ascii") ]
+        else:
+            pageid = self.pageids[min(page, len(self.pageids) - 1)]
+            fields = [ b"/Title " + pdftext(title), ("/Parent %d 0 R /Dest [%d 0 R /XYZ null %s null]"
+                % (parentid, pageid, pdfnumber(top))).encode("ascii") ]
+            if previd is not None:
+                fields.append(("/Prev %d 0 R" % previd).encode("ascii"))
+            if nextid is not None:
+                fields.append(("/Next %d 0 R" % nextid).encode("ascii"))
+            if children:
+                fields.append(("/Count -%d" % len(children)).encode("ascii"))
+        if children:
+            fields.append(("/First %d 0 R /Last %d 0 R"
+                % (children[0][0], children[-1][0])).encode("ascii"))
+        self.writeobject(objid, b"<< " + b" ".join(fields) + b" >>")
+        for i, child in enumerate(children):
+            previd = nextid = None
+            if i > 0:
+                previd = children[i - 1][0]
+            if i < len(children) - 1:
+                nextid = children[i + 1][0]
+            self.writeoutline(child, objid, previd, nextid)
+
+    # checkpoint() and resume() let Report.resume() carry on writing
+    # a file after an interrupted run; see Report.checkpointfile.
+    # this works only when the canvas was given a file name.
+
+    def checkpoint(self):
+        self.flush()
+        if self.file is None or self.file is self.filename:
+            return None
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {
+            "position": self.position,
+            "offsets": dict(self.offsets),
+            "pageids": list(self.pageids),
+            "fonts": dict(self.fonts),
+            "nextid": self.nextid,
+            "outlines": list(self.outlines),
+        }
+
+    def resume(self, state):
+        if state is None:
+            return
+        self.file = open(self.filename, "r+b")
+        self.file.truncate(state["position"])
+        self.file.seek(state["position"])
+        self.position = state["position"]
+        self.offsets = state["offsets"]
+        self.pageids = state["pageids"]
+        self.fonts = state["fonts"]
+        self.nextid = state["nextid"]
+        self.outlines = state["outlines"]
+
+
+# LayoutCanvas is the base of TextCanvas, CSVCanvas and HTMLCanvas,
+# which write a report out as text rather than drawing it.  it
+# follows translate(), saveState() and restoreState() so that each
+# string may be placed on the page, measured in points from the top
+# left corner to its baseline, and collects the strings, lines and
+# images of each page for writepage() when showPage() is called.
+# fonts are never measured, nor images read.
+
+def totext(text):
+    if isinstance(text, bytes):
+        try:
+            return text.decode("utf-8")
+        except UnicodeError:
+            return text.decode("latin-1")
+    return text
+
+
+class LayoutCanvas(object):
+
+    def __init__(self, filename, pagesize = (612, 792), encoding = "utf-8"):
+        self.filename = filename
+        self._pagesize = pagesize
+        self.encoding = encoding
+        self.file = None
+        self.origin = (0, 0)
+        self.font = ("Helvetica", 12)
+        self.linewidth = 1
+        self.stack = []
+        self.items = []
+        self.pagenumber = 0
+        self.written = 0
+
+    def write(self, text):
+        if self.file is None:
+            if hasattr(self.filename, "write"):
+                self.file = self.filename
+            else:
+                import io
+                self.file = io.open(self.filename, "w",
+                                    encoding = self.encoding, newline = "")
+            self.begin()
+        text = totext(text)
+        self.written += len(text)
+        self.file.write(text)
+
+    # outputsize() is the number of characters written so far.
+
+    def outputsize(self):
+        return self.written
+
+    def place(self, x, y):
+        return (self.origin[0] + x, self._pagesize[1] - (self.origin[1] + y))
+
+    def addstring(self, x, y, text, align):
+        x, top = self.place(x, y)
+        self.items.append(("text", top, x, align, self.font, totext(text)))
+
+    def setFont(self, name, size):
+        self.font = (name, size)
+
+    def drawString(self, x, y, text):
+        self.addstring(x, y, text, "left")
+
+    def drawRightString(self, x, y, text):
+        self.addstring(x, y, text, "right")
+
+    def drawCentredString(self, x, y, text):
+        self.addstring(x, y, text, "centre")
+
+    def drawAlignedString(self, x, y, text, pivotChar = "."):
+        self.addstring(x, y, text, "align")
+
+    def line(self, x1, y1, x2, y2):
+        x1, top1 = self.place(x1, y1)
+        x2, top2 = self.place(x2, y2)
+        self.items.append(("line", min(top1, top2), min(x1, x2),
+                           abs(x2 - x1), abs(top2 - top1), self.linewidth))
+
+    def drawImage(self, image, x, y, width = None, height = None, **kwargs):
+        x, top = self.place(x, y)
+        self.items.append(("image", top - (height or 0), x, width, height, image))
+
+    def setLineWidth(self, width):
+        self.linewidth = width
+
+    def setStrokeGray(self, gray):
+        pass
+
+    def saveState(self):
+        self.stack.append((self.origin, self.font, self.linewidth))
+
+    def restoreState(self):
+        self.origin, self.font, self.linewidth = self.stack.pop()
+
+    def translate(self, dx, dy):
+        self.origin = (self.origin[0] + dx, self.origin[1] + dy)
+
+    def showPage(self):
+        self.pagenumber += 1
+        self.writepage(self.items)
+        self.items = []
+        self.origin = (0, 0)
+        self.stack = []
+
+    def save(self):
+        if self.items:
+            self.showPage()
+        self.write(self.end())
+        if self.file is not self.filename:
+            self.file.close()
+        self.file = None
+
+    # begin() and end() return the text which starts and ends the
+    # file; writepage() writes out a page.
+
+    def begin(self):
+        pass
+
+    def end(self):
+        return ""
+
+    def writepage(self, items):
+        pass
+
+
+# pivot() returns the index in text which drawAlignedString() places
+# at x: the first pivotChar, or failing that the end of the last digit.
+
+def pivot(text, pivotChar = "."):
+    i = text.find(pivotChar)
+    if i < 0:
+        i = len(text)
+        while i > 0 and text[i-1] not in "0123456789":
+            i -= 1
+        if i == 0:
+            i = len(text)
+    return i
+
+
+class TextCanvas(LayoutCanvas):
+
+    # TextCanvas writes each page as plain text, as it might appear
+    # on a line printer: every charwidth points across is a column,
+    # and strings whose baselines are within half a line of each
+    # other share a line.  blank lines stand in for the larger gaps
+    # between lines, and horizontal Rules are drawn with "-".  pages
+    # are separated by pagebreak.
+
+    def __init__(self, filename, pagesize = (612, 792), encoding = "utf-8",
+                 charwidth = 6, lineheight = 12, pagebreak = "\f\n"):
+        LayoutCanvas.__init__(self, filename, pagesize, encoding)
+        self.charwidth = float(charwidth)
+        self.lineheight = float(lineheight)
+        self.pagebreak = pagebreak
+
+    def column(self, x):
+        return int(x / self.charwidth + 0.5)
+
+    def writepage(self, items):
+        if self.pagenumber > 1:
+            self.write(self.pagebreak)
+        items = sorted(items, key = lambda item: (item[1], item[2]))
+        lines = []
+        linetop = None
+        for item in items:
+            top = item[1]
+            if linetop is None or top - linetop > self.lineheight / 2:
+                if linetop is not None:
+                    gap = int((top - linetop) / self.lineheight + 0.5)
+                    for i in range(gap - 1):
+                        lines.append([])
+                lines.append([])
+                linetop = top
+            lines[-1].append(item)
+        for line in lines:
+            self.write(self.layoutline(line).rstrip() + "\n")
+
+    def layoutline(self, items):
+        chars = []
+        def put(col, text, over):
+            if col < 0:
+                text = text[-col:]
+                col = 0
+            if len(chars) < col + len(text):
+                chars.extend(" " * (col + len(text) - len(chars)))
+            for i, c in enumerate(text):
+                if over or chars[col + i] == " ":
+                    chars[col + i] = c
+        # Rules first, so text is drawn over them.
+        for item in items:
+            if item[0] == "line" and item[4] == 0:
+                col = self.column(item[2])
+                put(col, "-" * max(1, self.column(item[2] + item[3]) - col), 1)
+        for item in items:
+            if item[0] != "text":
+                continue
+            kind, top, x, align, font, text = item
+            col = self.column(x)
+            if align == "right":
+                col -= len(text)
+            elif align == "centre":
+                col -= len(text) // 2
+            elif align == "align":
+                col -= pivot(text)
+            put(col, text, 1)
+        return "".join(chars)
+
+
+class CSVCanvas(LayoutCanvas):
+
+    # CSVCanvas writes one CSV record each time one of the named bands
+    # is printed (by default, only the detail band), its fields being
+    # the strings the band prints, in order down and then across the
+    # band; the lines of a wrapped Element stay in one field.  it
+    # depends on Report calling beginband() as each band is printed,
+    # and beginelement() as each Element's text is, so that Elements
+    # stacked at the same x stay in fields of their own.  header, if
+    # given, is written as the first record.
+
+    def __init__(self, filename, bands = ("detail",), header = None,
+                 delimiter = ",", encoding = "utf-8"):
+        LayoutCanvas.__init__(self, filename, (612, 792), encoding)
+        self.bands = bands
+        self.header = header
+        self.delimiter = delimiter
+        self.writer = csv.writer(self, delimiter = delimiter, lineterminator = "\r\n")
+        self.selected = 0
+        self.newelement = 1
+        self.fields = []
+
+    def begin(self):
+        if self.header:
+            self.writerecord(self.header)
+
+    def beginband(self, kind):
+        self.flush()
+        self.selected = self.bands is None or kind in self.bands
+
+    def beginelement(self):
+        self.newelement = 1
+
+    def addstring(self, x, y, text, align):
+        if not self.selected:
+            return
+        x, top = self.place(x, y)
+        text = totext(text)
+        if not self.newelement and self.fields \
+        and self.fields[-1][1] == x and self.fields[-1][3] == align:
+            # the next line of the same Element.
+            self.fields[-1][2] += "\n" + text
+        else:
+            self.fields.append([ top, x, text, align ])
+        self.newelement = 0
+
+    def flush(self):
+        if self.fields:
+            self.fields.sort(key = lambda field: (field[0], field[1]))
+            self.writerecord([ field[2] for field in self.fields ])
+            self.fields = []
+
+    def writerecord(self, values):
+        self.writer.writerow([ totext(value) for value in values ])
+
+    def line(self, *args):
+        pass
+
+    def drawImage(self, *args, **kwargs):
+        pass
+
+    def showPage(self):
+        self.flush()
+        self.items = []
+        self.origin = (0, 0)
+        self.stack = []
+
+    def save(self):
+        self.flush()
+        if self.file is None:
+            self.write("")
+        LayoutCanvas.save(self)
+
+
+def htmlescape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;") \
+               .replace(">", "&gt;").replace('"', "&quot;")
+
+
+class HTMLCanvas(LayoutCanvas):
+
+    # HTMLCanvas writes the report as a single HTML document, each page
+    # a box in which each string, Rule and Image is placed where it
+    # would be on paper.  the standard PDF fonts are mapped to the
+    # usual browser fonts.  images are linked, not read or copied.
+
+    families = {
+        "Helvetica": "Helvetica, Arial, sans-serif",
+        "Times": "'Times New Roman', Times, serif",
+        "Courier": "'Courier New', Courier, monospace",
+    }
+
+    def __init__(self, filename, pagesize = (612, 792), encoding = "utf-8",
+                 title = "Report"):
+        LayoutCanvas.__init__(self, filename, pagesize, encoding)
+        self.title = title
+
+    def begin(self):
+        self.write('<!DOCTYPE html>\n<html>\n<head>\n'
+            '<meta charset="%s">\n<title>%s</title>\n<style>\n'
+            '.page { position: relative; width: %spt; height: %spt; '
+            'margin: 1em auto; border: 1px solid #ccc; overflow: hidden; }\n'
+            '.page span { position: absolute; white-space: pre; line-height: 1; }\n'
+            '.page div, .page img { position: absolute; }\n'
+            '</style>\n</head>\n<body>\n'
+            % (self.encoding, htmlescape(totext(self.title)),
+               pdfnumber(self._pagesize[0]), pdfnumber(self._pagesize[1])))
+
+    def end(self):
+        return "</body>\n</html>\n"
+
+    def fontstyle(self, font):
+        name, size = font
+        family = self.families.get(name.split("-")[0], "sans-serif")
+        style = "font: %s%s%spt %s" % (
+            ("Italic" in name or "Oblique" in name) and "italic " or "",
+            "Bold" in name and "bold " or "",
+            pdfnumber(size), family)
+        return style
+
+    def writepage(self, items):
+        out = [ '<div class="page">' ]
+        for item in items:
+            kind = item[0]
+            if kind == "text":
+                kind, top, x, align, font, text = item
+                style = "%s; top: %spt" % (self.fontstyle(font), pdfnumber(top - font[1]))
+                if align in ("right", "align"):
+                    style += "; right: %spt" % pdfnumber(self._pagesize[0] - x)
+                elif align == "centre":
+                    style += "; left: %spt; transform: translateX(-50%%)" % pdfnumber(x)
+                else:
+                    style += "; left: %spt" % pdfnumber(x)
+                out.append('<span style="%s">%s</span>' % (style, htmlescape(text)))
+            elif kind == "line":
+                kind, top, x, width, height, linewidth = item
+                if height == 0:
+                    border = "border-top: %spt solid #000; width: %spt" % (
+                        pdfnumber(linewidth), pdfnumber(width))
+                    top -= linewidth / 2.0
+                else:
+                    border = "border-left: %spt solid #000; height: %spt" % (
+                        pdfnumber(linewidth), pdfnumber(height))
+                    x -= linewidth / 2.0
+                out.append('<div style="left: %spt; top: %spt; %s"></div>'
+                           % (pdfnumber(x), pdfnumber(top), border))
+            elif kind == "image":
+                kind, top, x, width, height, image = item
+                size = ""
+                if width is not None:
+                    size += "; width: %spt" % pdfnumber(width)
+                if height is not None:
+                    size += "; height: %spt" % pdfnumber(height)
+                out.append('<img src="%s" style="left: %spt; top: %spt%s">'
+                           % (htmlescape(totext(str(image))), pdfnumber(x), pdfnumber(top), size))
+        out.append("</div>\n")
+        self.write("\n".join(out))
+
+
+class PageEntry(object):
+
+    # a PageEntry describes the start of one page: its number, the
+    # number of the row being processed when it began, and the values
+    # of the groups at that point (most important first).  position
+    # and state record where that row is found in the datasource and
+    # the report's state just before it was processed; these are used
+    # by Report.generatepages() to start the report at this page.
+
+    def __init__(self, pagenumber, rownumber, groupkey,
+                 position = None, state = None):
+        self.pagenumber = pagenumber
+        self.rownumber = rownumber
+        self.groupkey = groupkey
+        self.position = position
+        self.state = state
+
+    def __repr__(self):
+        return "PageEntry(%r, %r, %r)" % (
+            self.pagenumber, self.rownumber, self.groupkey)
+
+
+class PageIndex(object):
+
+    def __init__(self):
+        self.pages = []
+        self.pagecount = 0
+        self.rowcount = 0
+
+    def addpage(self, report, row):
+        if row is None:
+            groupkey = None
+        else:
+            groupkey = report.sortkey(row)
+        position, state = report.rowstart
+        self.pages.append(PageEntry(report.pagenumber, report.rownumber,
+                                    groupkey, position, state))
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __getitem__(self, i):
+        return self.pages[i]
+
+
+class Report(object):
+
+    def __init__(self, datasource = None,
+            titleband = None, detailband = None,
+            pageheader = None, pagefooter = None,
+            reportheader = None, reportfooter = None,
+            groupheaders = None, groupfooters = None,
+            onrow = None, onnewpage = None, ondetail = None):
+
+        self.datasource = datasource
+        self.pagesize = None
+        self.topmargin = 36
+        self.bottommargin = 36
+        self.leftmargin = 36
+
+        # presort, if set, is the number of rows to sort in memory
+        # at a time when the datasource must be put in group order.
+        self.presort = None
+        self.sorttempdir = None
+
+        # fields, if given, names the columns of a tuple or list row;
+        # Element and Band keys naming a field are then resolved to
+        # positions when the report is generated.
+        self.fields = None
+        self.fieldindex = None
+
+        # checkpointfile, if given, names a file to which the state of
+        # the report is written every checkpointpages pages, so that
+        # resume() can carry on from there if the run is interrupted.
+        # checkpoints are written and removed only by generate() and
+        # resume(), never by paginate() or generatepages().
+        self.checkpointfile = None
+        self.checkpointpages = 1000
+        self.checkpointing = 0
+
+        # events
+        self.onrow = onrow
+        self.onnewpage = onnewpage
+        self.ondetail = ondetail
+
+        # onprogress, if given, is called with a Progress object every
+        # progressrows rows and every progresspages pages (either may
+        # be 0 to disable it), and once more when the report is done.
+        self.onprogress = None
+        self.progressrows = 10000
+        self.progresspages = 0
+        self.progressstart = None
+        self.progresstotal = None
+        self.nextprogress = 0
+
+        # bands
+        self.titleband = titleband
+        self.detailband = detailband
+        self.pageheader = pageheader
+        self.pagefooter = pagefooter
+        self.reportfooter = reportfooter
+        self.reportheader = reportheader
+        self.groupheaders = groupheaders or []
+        self.groupfooters = groupfooters or []
+
+        self.footerelementlist = []
+
+        self.pagenumber = 0
+        self.rownumber = 0
+        self.currentrow = {}
+        self.prevrow = None
+        self.lastrow = None
+
+        # drawing is cleared while laying out pages which are not
+        # to be rendered; pageindex collects a PageEntry for each page
+        # when it is not None.
+        self.drawing = 1
+        self.pageindex = None
+        self.firstpage = None
+        self.lastpage = None
+        self.rowstart = None
+        self.wantstate = 0
+        self.pagefinished = 0
+        self.pagetop = None
+
+        # groupcache, if given, names a directory in which the output
+        # of each top-level group is kept, so that groups whose rows
+        # have not changed need not be laid out again.
+        self.groupcache = None
+        self.groupcachehits = 0
+        self.groupcachemisses = 0
+        self.recorder = None
+        self.bandhook = None
+        self.elementhook = None
+
+        # contents lists the bookmarks of the group headers (see
+        # Band.bookmark) placed during the last run, as (level, title,
+        # pagenumber, top) tuples, top being the top of the band in
+        # points from the bottom of the page.  each is also passed to
+        # the canvas's bookmark(title, level, top) method, if it has
+        # one, or added to a Reportlab Canvas's outline.
+        self.contents = []
+        self.bookmarkhook = None
+
+        # profile, if set, has the time spent in each band and element
+        # recorded during each run, in a ProfileStats object in stats.
+        self.profile = 0
+        self.stats = None
+        self.profilewrapped = None
+        self.profilestart = None
+
+        # outputcache, if given, names a directory in which the files
+        # written by generatefile() are kept, keyed by the report's
+        # definition and the datasource's fingerprint (see below),
+        # the oldest being removed when they total more than
+        # outputcachesize bytes.
+        self.outputcache = None
+        self.outputcachesize = 100 * 1024 * 1024
+        self.outputcachehits = 0
+        self.outputcachemisses = 0
+
+        # fingerprint identifies the data the report is to be
+        # generated from, for the output cache; it may be a value or a
+        # function called with the datasource.  if it is None, the
+        # datasource's own fingerprint() method is used, if it has one.
+        self.fingerprint = None
+
+        # maxpages, maxrows, maxseconds and maxbytes limit the size of
+        # the report and the time it may take; maxbytes needs a canvas
+        # with an outputsize() method.  cancel may be an object with an
+        # is_set() method, such as a threading.Event, or a function,
+        # which is checked between rows.  when a limit is reached or the
+        # report is cancelled, the current page is finished, and
+        # generate() returns a LimitReached, which is also kept in
+        # stopped; otherwise it returns None.
+        self.maxpages = None
+        self.maxrows = None
+        self.maxseconds = None
+        self.maxbytes = None
+        self.cancel = None
+        self.stopped = None
+        self.limited = 0
+        self.deadline = None
+
+        # private
+        self._sum_detail_ht = 0
+        self._avg_detail_ht = 0
+        self._max_detail_ht = 0
+
+    def newpage(self, canvas, row):
+        if self.onnewpage:
+            self.onnewpage(self)
+        self.endpage(canvas)
+        if self.limited:
+            self.checkpage(canvas)
+        self.pagefinished = 0
+        self.pagenumber += 1
+        if self.onprogress is not None and self.progresspages \
+        and self.pagenumber % self.progresspages == 0:
+            self.progress()
+        if self.pageindex is not None:
+            self.pageindex.addpage(self, row)
+        if self.firstpage is not None:
+            if self.lastpage is not None and self.pagenumber > self.lastpage:
+                raise StopReport
+            self.drawing = self.pagenumber >= self.firstpage
+        if self.checkpointing and self.drawing and self.pagenumber > 1 \
+        and (self.pagenumber - 1) % self.checkpointpages == 0:
+            self.writecheckpoint(canvas)
+        self.endofpage = self.pagesize[1] - self.bottommargin
+        if self.drawing:
+            canvas.translate(0, self.pagesize[1])
+        self.current_offset = self.topmargin
+        if self.titleband and self.pagenumber == 1:
+            elementlist = self.titleband.generate(row)
+            self.current_offset += self.addtopage(canvas, elementlist, "titleband")
+        if self.pageheader:
+            elementlist = self.pageheader.generate(row)
+            self.current_offset += self.addtopage(canvas, elementlist, "pageheader")
+        if self.reportheader and self.pagenumber == 1:
+            elementlist = self.reportheader.generate(row)
+            self.current_offset += self.addtopage(canvas, elementlist, "reportheader")
+        if self.pagefooter:
+            self.footerelementlist = self.pagefooter.generate(row)
+            self.footerrownumber = self.rownumber
+            self.endofpage = self.pagesize[1] - self.bottommargin - elementlist[0]
+        self.pagetop = self.current_offset
+
+    # endpage() prints the page footer and finishes the current page.
+
+    def endpage(self, canvas):
+        if self.pagenumber and self.drawing and not self.pagefinished:
+            if self.bandhook is not None:
+                self.bandhook("pagefooter")
+            self.renderlist(canvas, self.footerelementlist, self.endofpage,
+                            self.footerrownumber)
+            canvas.showPage()
+            self.pagefinished = 1
+
+    # kind names the sort of band being added, for a canvas with a
+    # beginband() method (see CSVCanvas).
+
+    def addtopage(self, canvas, elementlist, kind = None):
+        if self.drawing:
+            if self.bandhook is not None:
+                self.bandhook(kind)
+            self.renderlist(canvas, elementlist, self.current_offset)
+        return elementlist[0]
+
+    def renderlist(self, canvas, elementlist, offset, rownumber = None):
+        if self.stats is not None:
+            return self.profilelist(canvas, elementlist, offset, rownumber)
+        if self.recorder is None or self.recorder.ops is None:
+            for el in elementlist[1:]:
+                el.render(offset, canvas)
+            return
+        # a group is being recorded for the group cache; sysvar
+        # Elements are recorded so they can be rendered again, as the
+        # page and row numbers will differ when the group is replayed.
+        for el in elementlist[1:]:
+            element = getattr(el, "parent", None)
+            if isinstance(element, Element) and element.sysvar is not None \
+            and element._getvalue is None and element.key is None \
+            and element.text is None and type(element).getvalue == Element.getvalue \
+            and id(element) in self.cacheelementids:
+                if rownumber is None:
+                    rownumber = self.rownumber
+                self.recorder.ops.append((None, (
+                    self.cacheelementids[id(element)], el.pos, offset,
+                    self.pagenumber - self.groupstartpage,
+                    rownumber - self.groupstartrow), None))
+                ops = self.recorder.ops
+                self.recorder.ops = None
+                try:
+                    el.render(offset, canvas)
+                finally:
+                    self.recorder.ops = ops
+            else:
+                el.render(offset, canvas)
+
+    # profilelist() is renderlist() when profiling, timing each
+    # renderer and crediting the time to the element it came from.
+
+    def profilelist(self, canvas, elementlist, offset, rownumber):
+        stats = self.stats
+        self.stats = None
+        try:
+            for el in elementlist[1:]:
+                start = clock()
+                self.renderlist(canvas, [ 0, el ], offset, rownumber)
+                entry = stats.byid.get(id(getattr(el, "parent", el)))
+                if entry is not None:
+                    entry.add("render", clock() - start)
+        finally:
+            self.stats = stats
+
+    def setreference(self, bands):
+        for band in bands:
+            if band is not None:
+                if hasattr(band, "bind"):
+                    band.bind(self.fieldindex)
+                for element in band.elements:
+                    element.report = self
+                    if hasattr(element, "bind"):
+                        element.bind(self.fieldindex)
+                self.setreference(band.childbands)
+                self.setreference(band.additionalbands)
+
+    # getfields() returns the field names of the datasource rows:
+    # Report.fields if set, otherwise the fields attribute of the
+    # datasource (as for CSVSource), if known.
+
+    def getfields(self):
+        if self.fields is not None:
+            return self.fields
+        if hasattr(self.datasource, "readfields"):
+            return self.datasource.readfields()
+        return getattr(self.datasource, "fields", None)
+
+    # sortkey() returns the group values for a row, most important
+    # first; it is the ordering used when presort is set.
+
+    def sortkey(self, row):
+        if self.groupheaders:
+            bands = self.groupheaders
+        else:
+            bands = self.groupfooters[::-1]
+        return tuple([ band.getvalue(row) for band in bands ])
+
+    # allbands() yields every Band in the report, including child
+    # and additional bands.
+
+    def allbands(self, bands = None):
+        if bands is None:
+            bands = [
+                self.titleband, self.detailband,
+                self.pageheader, self.pagefooter,
+                self.reportheader, self.reportfooter,
+            ] + self.groupheaders + self.groupfooters
+        for band in bands:
+            if band is not None:
+                yield band
+                for child in self.allbands(band.childbands + band.additionalbands):
+                    yield child
+
+    # reset() clears the state left over from any previous run, so
+    # that a Report may be generated more than once.
+
+    def reset(self):
+        self.pagenumber = 0
+        self.rownumber = 0
+        self._sum_detail_ht = 0
+        self._avg_detail_ht = 0
+        self._max_detail_ht = 0
+        self._fixed_detail_ht = None
+        self._rowsleft = 0
+        self._rowskey = None
+        self.footerelementlist = []
+        self.prevrow = None
+        self.lastrow = None
+        self.pagefinished = 0
+        self.pagetop = None
+        self.footerrownumber = 0
+        self.stopped = None
+        self.contents = []
+        for band in self.allbands():
+            band.previousvalue = None
+            for element in band.elements:
+                if hasattr(element, "reset"):
+                    element.reset()
+
+    def prepare(self, canvas):
+
+        fields = self.getfields()
+        if fields is not None:
+            self.fieldindex = dict([ (name, i) for i, name in enumerate(fields) ])
+        else:
+            self.fieldindex = None
+
+        # every Element in every Band needs a reference to this Report
+        self.setreference([
+            self.titleband, self.detailband,
+            self.pageheader, self.pagefooter,
+            self.reportheader, self.reportfooter,
+        ])
+        self.setreference(self.groupheaders)
+        self.setreference(self.groupfooters)
+
+        self.statebands = self.groupheaders + self.groupfooters
+        self.stateelements = []
+        for band in self.allbands():
+            for element in band.elements:
+                if hasattr(element, "savestate"):
+                    self.stateelements.append(element)
+                if isinstance(element, Image) and isinstance(canvas, PDFCanvas):
+                    raise TypeError("PDFCanvas does not draw images")
+
+        self.reset()
+        for band in self.allbands():
+            if hasattr(band, "prepare"):
+                band.prepare()
+
+        # a detail band of fixed height needs no per-row measurement
+        # for the group header orphan check below.
+        if self.detailband is not None:
+            self._fixed_detail_ht = getattr(self.detailband, "fixedheight", None)
+            if self._fixed_detail_ht is not None:
+                self._avg_detail_ht = self._max_detail_ht = self._fixed_detail_ht
+
+        self.startlimits(canvas)
+        self.bandhook = getattr(canvas, "beginband", None)
+        self.elementhook = getattr(canvas, "beginelement", None)
+        self.bookmarkhook = getattr(canvas, "bookmark", None)
+        if self.bookmarkhook is None and hasattr(canvas, "addOutlineEntry"):
+            self.bookmarkhook = ReportlabOutline(canvas).bookmark
+        self.pagesize = (int(canvas._pagesize[0]), int(canvas._pagesize[1]))
+        self.current_offset = self.pagesize[1]
+        self.endofpage = self.pagesize[1] - self.bottommargin
+
+    # savestate() captures everything that changes from row to row,
+    # and loadstate() puts it back.
+
+    def savestate(self, elementstates = None):
+        if elementstates is None:
+            elementstates = self.saveelements()
+        return (
+            self.pagenumber, self.rownumber,
+            self.current_offset, self.endofpage, self.pagetop,
+            self._sum_detail_ht, self._avg_detail_ht, self._max_detail_ht,
+            self._fixed_detail_ht, self.prevrow,
+            [ band.previousvalue for band in self.statebands ],
+            elementstates,
+            len(self.contents),
+        )
+
+    def saveelements(self):
+        return [ element.savestate() for element in self.stateelements ]
+
+    def loadstate(self, state):
+        (self.pagenumber, self.rownumber,
+         self.current_offset, self.endofpage, self.pagetop,
+         self._sum_detail_ht, self._avg_detail_ht, self._max_detail_ht,
+         self._fixed_detail_ht, self.prevrow, previousvalues, elementstates,
+         contentcount) = state
+        del self.contents[contentcount:]
+        for band, value in zip(self.statebands, previousvalues):
+            band.previousvalue = value
+        for element, value in zip(self.stateelements, elementstates):
+            element.loadstate(value)
+
+    # getdatasource() returns an iterator over the datasource,
+    # starting at the given position.  a position is the value of
+    # datasource.tell() if there is one, otherwise a row offset.
+    # sources with a rowsfrom() method seek directly; lists and
+    # tuples are indexed; anything else is read and skipped.
+
+    def getdatasource(self, position = 0):
+        datasource = self.datasource
+        if self.presort:
+            datasource = SortedSource(datasource, self.sortkey,
+                self.presort, self.sorttempdir)
+        if not position:
+            return datasource
+        if hasattr(datasource, "rowsfrom"):
+            if hasattr(datasource, "tell"):
+                return PositionedRows(datasource.rowsfrom(position), datasource.tell)
+            return datasource.rowsfrom(position)
+        if isinstance(datasource, (list, tuple)):
+            return (datasource[i] for i in range(position, len(datasource)))
+        return itertools.islice(datasource, position, None)
+
+    def generate(self, canvas):
+        started = self.startprofile()
+        try:
+            self.prepare(canvas)
+            if self.groupcache:
+                self.runcached(canvas, self.getdatasource())
+            else:
+                self.run(canvas, self.getdatasource())
+        finally:
+            if started:
+                self.stopprofile()
+        return self.stopped
+
+    # generatepages() renders only pages first through last (or just
+    # page first), using a PageIndex from paginate() to begin at the
+    # row where page first starts.
+
+    def generatepages(self, canvas, pageindex, first, last = None):
+        if last is None:
+            last = first
+        entry = pageindex.pages[first - 1]
+        started = self.startprofile()
+        self.prepare(canvas)
+        self.loadstate(entry.state)
+        self.firstpage = first
+        self.lastpage = last
+        self.drawing = 0
+        try:
+            self.run(canvas, self.getdatasource(entry.position), entry.position)
+        finally:
+            self.firstpage = self.lastpage = None
+            self.drawing = 1
+            if started:
+                self.stopprofile()
+        return self.stopped
+
+    # paginate() lays out the report without drawing anything,
+    # returning a PageIndex describing where each page begins.
+
+    def paginate(self, pagesize):
+        canvas = NullCanvas(pagesize)
+        self.pageindex = PageIndex()
+        self.drawing = 0
+        try:
+            self.generate(canvas)
+            self.pageindex.pagecount = self.pagenumber
+            self.pageindex.rowcount = self.rownumber
+            return self.pageindex
+        finally:
+            self.pageindex = None
+            self.drawing = 1
+
+    # run() processes the rows of the datasource.  when a page index
+    # or checkpoints are wanted, the datasource position is kept at
+    # the start of each row, and the report state too whenever a page
+    # may begin part way through processing it (see rowstate()).  for
+    # checkpoints alone, the state is wanted only on the page before
+    # each checkpoint is due.
+
+    def run(self, canvas, datasource, position = 0):
+        tell = getattr(datasource, "tell", None)
+        indexing = self.pageindex is not None
+        self.checkpointing = bool(self.checkpointfile) and not indexing \
+            and self.lastpage is None
+        checkpointing = self.checkpointing
+        tracking = indexing or checkpointing
+        every = self.checkpointpages
+        self.startprogress()
+        limited = self.limited
+        try:
+            for row in datasource:
+                if limited:
+                    self.checklimits()
+                if tracking:
+                    if tell is not None:
+                        position = tell()
+                    self.rowstart = (position, None)
+                    self.wantstate = indexing \
+                        or (self.pagenumber and self.pagenumber % every == 0)
+                self.processrow(canvas, row)
+                position += 1
+            if tracking:
+                if tell is not None:
+                    position = tell()
+                self.rowstart = (position, self.savestate())
+            self.finish(canvas)
+        except StopReport as stop:
+            if isinstance(stop, LimitReached):
+                self.stopreport(canvas, stop)
+            self.progress(1)
+            return
+        finally:
+            self.checkpointing = 0
+            self.wantstate = 0
+        self.progress(1)
+        if checkpointing and os.path.exists(self.checkpointfile):
+            os.remove(self.checkpointfile)
+
+    # a checkpoint is written just as a page begins, after the previous
+    # page has been finished.  if the canvas has a checkpoint() method,
+    # its result is saved too, and resume() passes it back to the
+    # canvas's resume() method so the output can be continued exactly.
+
+    def writecheckpoint(self, canvas):
+        position, state = self.rowstart
+        if state is None:
+            # a row begun before the page preceding the checkpoint
+            # spans several pages; the next checkpoint will do.
+            return
+        if hasattr(canvas, "checkpoint"):
+            canvasstate = canvas.checkpoint()
+        else:
+            canvasstate = None
+        checkpoint = {
+            "pagenumber": self.pagenumber,
+            "position": position,
+            "state": state,
+            "canvas": canvasstate,
+            "contents": self.contents[:state[-1]],
+        }
+        tmpname = self.checkpointfile + ".tmp"
+        f = open(tmpname, "wb")
+        try:
+            pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        if os.name == "nt" and os.path.exists(self.checkpointfile):
+            os.remove(self.checkpointfile)
+        os.rename(tmpname, self.checkpointfile)
+
+    def readcheckpoint(self):
+        if not self.checkpointfile or not os.path.exists(self.checkpointfile):
+            return None
+        f = open(self.checkpointfile, "rb")
+        try:
+            return pickle.load(f)
+        finally:
+            f.close()
+
+    # resume() continues an interrupted run from its last checkpoint,
+    # or generates the whole report if there is none.  the canvas
+    # receives the pages from the checkpoint onward; if it supports
+    # checkpoints itself, it continues the earlier output.
+
+    def resume(self, canvas):
+        checkpoint = self.readcheckpoint()
+        if checkpoint is None:
+            return self.generate(canvas)
+        started = self.startprofile()
+        self.prepare(canvas)
+        if checkpoint["canvas"] is not None:
+            canvas.resume(checkpoint["canvas"])
+        self.contents = list(checkpoint["contents"])
+        self.loadstate(checkpoint["state"])
+        self.firstpage = checkpoint["pagenumber"]
+        self.drawing = 0
+        try:
+            self.run(canvas, self.getdatasource(checkpoint["position"]),
+                     checkpoint["position"])
+        finally:
+            self.firstpage = None
+            self.drawing = 1
+            if started:
+                self.stopprofile()
+        return self.stopped
+
+    # generatefile() generates the report into the named file, using
+    # makecanvas(filename, pagesize) to create the canvas (by default a
+    # Reportlab Canvas) and calling its save() method at the end.  with
+    # outputcache set and a fingerprint available, a report which has
+    # been generated before is copied from the cache instead, without
+    # reading the datasource.
+
+    def generatefile(self, filename, pagesize = None, makecanvas = None):
+        if makecanvas is None:
+            makecanvas = reportlabcanvas
+        key = self.outputkey(pagesize, makecanvas)
+        if key is not None:
+            cached = os.path.join(self.outputcache, key + ".out")
+            if os.path.exists(cached):
+                self.outputcachehits += 1
+                os.utime(cached, None)
+                shutil.copyfile(cached, filename)
+                return
+            self.outputcachemisses += 1
+        canvas = makecanvas(filename, pagesize)
+        self.generate(canvas)
+        canvas.save()
+        if key is not None:
+            self.storeoutput(filename, cached)
+
+    # the key covers makecanvas (its code, as for signature()) as well,
+    # since the same report makes different files on different canvases.
+
+    def outputkey(self, pagesize, makecanvas = None):
+        if not self.outputcache:
+            return None
+        fingerprint = self.fingerprint
+        if fingerprint is None:
+            if not hasattr(self.datasource, "fingerprint"):
+                return None
+            fingerprint = self.datasource.fingerprint()
+        elif callable(fingerprint):
+            fingerprint = fingerprint(self.datasource)
+        if fingerprint is None:
+            return None
+        key = repr((self.signature(), pagesize, fingerprint, self.imagefiles(),
+                    describe(makecanvas)))
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    # imagefiles() identifies the image files named by Image elements
+    # with fixed text by their size and modification time, so that
+    # replacing one invalidates the cached output.  images named by the
+    # rows must be covered by the fingerprint.
+
+    def imagefiles(self):
+        files = []
+        for band in self.allbands():
+            for element in band.elements:
+                name = getattr(element, "text", None)
+                if isinstance(element, Image) and hasattr(name, "encode") \
+                and os.path.isfile(name):
+                    st = os.stat(name)
+                    files.append((os.path.abspath(name), st.st_size, st.st_mtime))
+        return sorted(files)
+
+    def storeoutput(self, filename, cached):
+        if not os.path.isdir(self.outputcache):
+            os.makedirs(self.outputcache)
+        tmpname = cached + ".tmp"
+        shutil.copyfile(filename, tmpname)
+        if os.name == "nt" and os.path.exists(cached):
+            os.remove(cached)
+        os.rename(tmpname, cached)
+
+        # evict the least recently used files beyond outputcachesize.
+        files = []
+        total = 0
+        for name in os.listdir(self.outputcache):
+            if name.endswith(".out"):
+                path = os.path.join(self.outputcache, name)
+                st = os.stat(path)
+                files.append((st.st_mtime, path, st.st_size))
+                total += st.st_size
+        files.sort()
+        for mtime, path, size in files:
+            if total <= self.outputcachesize:
+                break
+            os.remove(path)
+            total -= size
+
+    # startprogress() is called as a run begins; progress() calls
+    # onprogress, and sets nextprogress to the row number at which
+    # addrow() should call it again.  the rate is figured from the
+    # rows of this run only, as generatepages() and resume() begin
+    # part way through the report.
+
+    def startprogress(self):
+        if self.onprogress is None:
+            self.nextprogress = 0
+            return
+        self.progressstart = (clock(), self.rownumber, self.pagenumber)
+        self.progresstotal = None
+        if hasattr(self.datasource, "__len__"):
+            self.progresstotal = len(self.datasource)
+        self.setnextprogress()
+
+    def setnextprogress(self):
+        if self.progressrows:
+            self.nextprogress = (self.rownumber // self.progressrows + 1) * self.progressrows
+        else:
+            self.nextprogress = 0
+
+    def progress(self, done = 0):
+        if self.onprogress is None or self.progressstart is None:
+            return
+        start, startrow, startpage = self.progressstart
+        elapsed = clock() - start
+        rate = pagerate = 0.0
+        if elapsed > 0:
+            rate = (self.rownumber - startrow) / elapsed
+            pagerate = (self.pagenumber - startpage) / elapsed
+        self.setnextprogress()
+        if done:
+            self.progressstart = None
+        self.onprogress(Progress(self.rownumber, self.pagenumber, elapsed,
+                                 rate, pagerate, self.progresstotal, done))
+
+    # startlimits() notes whether any limit (or a cancel) is set, so
+    # that an unlimited run skips the checks below, and starts the
+    # clock for maxseconds.
+
+    def startlimits(self, canvas):
+        self.limited = self.maxpages is not None or self.maxrows is not None \
+            or self.maxseconds is not None or self.maxbytes is not None \
+            or self.cancel is not None
+        if self.maxbytes is not None and not hasattr(canvas, "outputsize"):
+            raise ValueError("maxbytes requires a canvas with an outputsize() method")
+        if self.maxseconds is not None:
+            self.deadline = clock() + self.maxseconds
+        else:
+            self.deadline = None
+
+    # checklimits() is called between rows, and checkpage() between
+    # pages, once the last page is finished.
+
+    def checklimits(self):
+        if self.cancel is not None:
+            if hasattr(self.cancel, "is_set"):
+                cancelled = self.cancel.is_set()
+            else:
+                cancelled = self.cancel()
+            if cancelled:
+                raise LimitReached("cancelled", self.pagenumber, self.rownumber)
+        if self.maxrows is not None and self.rownumber >= self.maxrows:
+            raise LimitReached("rows", self.pagenumber, self.rownumber)
+        if self.deadline is not None and clock() >= self.deadline:
+            raise LimitReached("time", self.pagenumber, self.rownumber)
+
+    def checkpage(self, canvas):
+        if self.maxpages is not None and self.pagenumber >= self.maxpages:
+            raise LimitReached("pages", self.pagenumber, self.rownumber)
+        if self.maxbytes is not None and self.drawing \
+        and canvas.outputsize() >= self.maxbytes:
+            raise LimitReached("bytes", self.pagenumber, self.rownumber)
+        self.checklimits()
+
+    def stopreport(self, canvas, stop):
+        self.stopped = stop
+        self.endpage(canvas)
+
+    # with profile set, the methods of every band and element are
+    # wrapped for the length of the run to count their calls and time
+    # them, the results going to self.stats.  the wrappers are put on
+    # the instances, and removed again afterwards.
+
+    def startprofile(self):
+        if self.profilewrapped is not None:
+            return 0 # already profiling, e.g. resume() calling generate()
+        if not self.profile:
+            self.stats = None
+            return 0
+        stats = ProfileStats()
+        self.profilewrapped = []
+        self.profilestart = clock()
+
+        def wrap(obj, name, entry, operation):
+            func = getattr(obj, name, None)
+            if func is None:
+                return
+            add = entry.add
+            def wrapper(*args):
+                start = clock()
+                try:
+                    return func(*args)
+                finally:
+                    add(operation, clock() - start)
+            original = obj.__dict__.get(name, _notwrapped)
+            wrapper._unprofiled = original
+            self.profilewrapped.append((obj, name, original))
+            setattr(obj, name, wrapper)
+
+        def walk(label, band):
+            entry = stats.add(label, band)
+            for name in ("generate", "summarize", "getvalue", "getrows"):
+                wrap(band, name, entry, name)
+            for i, element in enumerate(band.elements):
+                entry = stats.add("%s.elements[%d]" % (label, i), element)
+                for name in ("generate", "summarize", "getvalue"):
+                    wrap(element, name, entry, name)
+                wrap(element, "_format", entry, "format")
+            for i, child in enumerate(band.childbands):
+                walk("%s.childbands[%d]" % (label, i), child)
+            for i, child in enumerate(band.additionalbands):
+                walk("%s.additionalbands[%d]" % (label, i), child)
+
+        for label in ("titleband", "detailband", "pageheader", "pagefooter",
+                      "reportheader", "reportfooter"):
+            if getattr(self, label) is not None:
+                walk(label, getattr(self, label))
+        for label in ("groupheaders", "groupfooters"):
+            for i, band in enumerate(getattr(self, label)):
+                walk("%s[%d]" % (label, i), band)
+        wrap(self, "newpage", stats.add("report", self), "newpage")
+        self.stats = stats
+        return 1
+
+    def stopprofile(self):
+        for obj, name, original in reversed(self.profilewrapped):
+            if original is _notwrapped:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, original)
+        self.profilewrapped = None
+        self.stats.elapsed = clock() - self.profilestart
+
+    def addadditional(self, canvas, band, row):
+        for aband in band.additionalbands:
+            if aband.getrows:
+                abandrows = aband.getrows(row)
+            else:
+                abandrows = [ row ]
+            for abandrow in abandrows:
+                elementlist = aband.generate(abandrow)
+                self.makeroom(canvas, elementlist, row)
+                self.addband(canvas, elementlist, "additional", row)
+
+    def processrow(self, canvas, row):
+
+        self.lastrow = row
+        self.currentrow = row
+
+        if self.onrow is not None:
+            self.currentrow = self.lastrow = row = self.onrow(row)
+
+        if row is None:
+            return
+
+        self.addrow(canvas, row)
+
+    def addrow(self, canvas, row):
+
+        prevrow = self.prevrow
+        rowstate = None
+        if self.wantstate:
+            rowstate = self.rowstate(row)
+        self.currentrow = row
+        self.rownumber += 1
+        if self.rownumber == self.nextprogress:
+            self.progress()
+        detaillist = None
+        if rowstate is not None:
+            detaillist = self.keeprowstate(rowstate, row)
+
+        if prevrow is None:
+            for band in self.groupheaders:
+                elementlist = band.generate(row)
+                if (self.current_offset + elementlist[0]) >= self.endofpage:
+                    self.newpage(canvas, row)
+                if band.bookmark:
+                    self.addbookmark(band, row)
+                self.current_offset += self.addtopage(canvas, elementlist, "groupheader")
+                self.addadditional(canvas, band, row)
+
+        lastchanged = None
+        for i in range(len(self.groupfooters)):
+            if self.groupfooters[i].ischanged(row):
+                lastchanged = i
+        if lastchanged is not None:
+            self.closegroups(canvas, lastchanged, prevrow, row)
+        for band in self.groupfooters:
+            band.summarize(row)
+
+        firstchanged = None
+        for i in range(len(self.groupheaders)):
+            if self.groupheaders[i].ischanged(row):
+                if firstchanged is None:
+                    firstchanged = i
+        if firstchanged is not None:
+            for i in range(firstchanged, len(self.groupheaders)):
+                elementlist = self.groupheaders[i].generate(row)
+                if self.groupheaders[i].newpagebefore \
+                or (self.current_offset + elementlist[0] + self._avg_detail_ht) >= self.endofpage:
+                    self.newpage(canvas, row)
+                if self.groupheaders[i].bookmark:
+                    self.addbookmark(self.groupheaders[i], row)
+                self.current_offset += self.addtopage(canvas, elementlist, "groupheader")
+                self.addadditional(canvas, self.groupheaders[i], row)
+                if self.groupheaders[i].newpageafter:
+                    self.current_offset = self.pagesize[1]
+
+        if self.detailband is not None:
+            if detaillist is not None:
+                elementlist = detaillist
+            else:
                 elementlist = self.detailband.generate(row)
+            if elementlist[0] != self._fixed_detail_ht:
+                if self._fixed_detail_ht is not None:
+                    # the fixed height band has varied after all;
+                    # measure every row from here on.
+                    self._sum_detail_ht = self._fixed_detail_ht * (self.rownumber - 1)
+                    self._fixed_detail_ht = None
                 self._max_detail_ht = max(elementlist[0], self._max_detail_ht)
                 self._sum_detail_ht += elementlist[0]
                 self._avg_detail_ht = \
                     ((self._sum_detail_ht // self.rownumber) + self._max_detail_ht) // 2
-                if (self.current_offset + elementlist[0]) >= self.endofpage:
-                    self.newpage(canvas, row)
+            height = self._fixed_detail_ht
+            if height is not None and self.ondetail is None \
+            and (self._rowsleft > 0 and self._rowskey == (self.current_offset, self.endofpage, height)
+                 or self.fixedrows() > 0):
+                self._rowsleft -= 1
+                self.current_offset += self.addtopage(canvas, elementlist, "detail")
+                self._rowskey = (self.current_offset, self.endofpage, height)
+            else:
+                self.makeroom(canvas, elementlist, row)
                 if self.ondetail:
                     self.ondetail(self)
-                self.current_offset += self.addtopage(canvas, elementlist)
-                for aband in self.detailband.additionalbands:
-                    if aband.getrows:
-                        abandrows = aband.getrows(row)
-                    else:
-                        abandrows = [ row ]
-                    for abandrow in abandrows:
-                        elementlist = aband.generate(abandrow)
-                        if (self.current_offset + elementlist[0]) >= self.endofpage:
-                            self.newpage(canvas, row)
-                        self.current_offset += self.addtopage(canvas, elementlist)
+                self.addband(canvas, elementlist, "detail", row)
+            self.addadditional(canvas, self.detailband, row)
 
-            if self.reportfooter:
-                self.reportfooter.summarize(row)
+        if self.reportfooter:
+            self.reportfooter.summarize(row)
+
+        self.prevrow = row
+
+    # fixedrows() returns how many more rows of a fixed height detail
+    # band fit on the page, so that they can be placed without the
+    # page checks of makeroom() and addband().  the count is worked out
+    # once, when the page or the offset changes other than by a detail
+    # row, by the same additions that placing the rows would make.
+
+    def fixedrows(self):
+        height = self._fixed_detail_ht
+        if height <= 0:
+            return 0
+        key = (self.current_offset, self.endofpage, height)
+        if key != self._rowskey:
+            rows = 0
+            offset = self.current_offset
+            while (offset + height) < self.endofpage:
+                offset += height
+                rows += 1
+            self._rowsleft = rows
+            self._rowskey = key
+        return self._rowsleft
+
+    # rowstate() and keeprowstate() save the report state at the start
+    # of a row (in rowstart) only when a page may begin within it, as
+    # copying the state of a large CrossTab for every row would make
+    # paginate() slower than generate().  when the row begins a group
+    # (or the first), or the detail band has additional bands or an
+    # ondetail function, the state is saved at once.  otherwise only
+    # the detail band can start a page, so the state is saved without
+    # the elements, the detail band is generated first, and if it will
+    # not fit, the elements' states (which are unchanged until the
+    # group footers are summarized) are added.  rowstate() returns the
+    # partial state, or None if it has already saved the whole.
+
+    def rowstate(self, row):
+        self.wantstate = 0
+        detailband = self.detailband
+        if self.prevrow is None or self.groupchanged(row) or (detailband is not None
+        and (detailband.additionalbands or self.ondetail is not None)):
+            self.rowstart = (self.rowstart[0], self.savestate())
+            return None
+        return self.savestate([])
 
-            prevrow = row
+    def keeprowstate(self, rowstate, row):
+        if self.detailband is None:
+            return None
+        elementlist = self.detailband.generate(row)
+        if (self.current_offset + elementlist[0]) >= self.endofpage:
+            rowstate[-2].extend(self.saveelements())
+            self.rowstart = (self.rowstart[0], rowstate)
+        return elementlist
+
+    def groupchanged(self, row):
+        for band in self.groupheaders + self.groupfooters:
+            if band.previousvalue is not None and band.previousvalue != band.getvalue(row):
+                return 1
+        return 0
+
+    # addbookmark() adds a group header's bookmark at the current
+    # offset, nested one level within each bookmarked group header
+    # above it.  when a group is recorded for the group cache, the
+    # bookmark is recorded too, to be added again when it is played
+    # back.
+
+    def addbookmark(self, band, row):
+        level = 0
+        for header in self.groupheaders:
+            if header is band:
+                break
+            if header.bookmark:
+                level += 1
+        title = band.bookmarktitle(row)
+        top = self.pagesize[1] - self.current_offset
+        if self.recorder is not None and self.recorder.ops is not None:
+            self.recorder.ops.append(("bookmark", (level, title, top,
+                self.pagenumber - self.groupstartpage), None))
+        self.placebookmark(level, title, top)
+
+    def placebookmark(self, level, title, top):
+        self.contents.append((level, title, self.pagenumber, top))
+        if self.drawing and self.bookmarkhook is not None:
+            self.bookmarkhook(title, level, top)
+
+    # makeroom() starts a new page if the band will not fit on this
+    # one, unless nothing has been put on this one yet and the band is
+    # too tall for any page; addband() then divides such a band
+    # between pages.
+
+    def makeroom(self, canvas, elementlist, row):
+        if (self.current_offset + elementlist[0]) >= self.endofpage \
+        and not (self.current_offset == self.pagetop
+                 and (self.current_offset + elementlist[0]) > self.endofpage):
+            self.newpage(canvas, row)
+
+    def addband(self, canvas, elementlist, kind, row):
+        if (self.current_offset + elementlist[0]) > self.endofpage:
+            self.splitband(canvas, elementlist, kind, row)
+        else:
+            self.current_offset += self.addtopage(canvas, elementlist, kind)
+
+    # splitband() prints a band too tall for the page in strips, one
+    # per page, each continuing after the page header of the next.  a
+    # strip ends where a line (or an image or other element) would
+    # cross the bottom of the page, so each is printed whole on the
+    # first page with room for it.  the lines of wrapped text are
+    # taken from their Renderers a strip at a time.
+
+    def splitband(self, canvas, elementlist, kind, row):
+        cut = 0
+        while 1:
+            bottom = cut + self.endofpage - self.current_offset
+            nextcut = bottom
+            for renderer in elementlist[1:]:
+                top = renderer.pos[1]
+                lineheight = renderer.height
+                if isinstance(renderer, Renderer) and renderer.lines:
+                    lineheight = renderer.lineheight
+                    top += max(0, (bottom - top) // lineheight) * lineheight
+                    if top >= renderer.pos[1] + renderer.height:
+                        continue
+                if cut <= top < bottom < top + lineheight:
+                    nextcut = min(nextcut, top)
+            if nextcut <= cut:
+                nextcut = bottom # taller than a page; let it run off
+            if nextcut >= elementlist[0]:
+                nextcut = elementlist[0]
+            pieces = [ 0 ]
+            for renderer in elementlist[1:]:
+                if isinstance(renderer, Renderer) and renderer.lines:
+                    first = max(0, -((renderer.pos[1] - cut) // renderer.lineheight))
+                    last = min(len(renderer.lines),
+                               -((renderer.pos[1] - nextcut) // renderer.lineheight))
+                    if first < last:
+                        pieces.append(renderer.slice(first, last))
+                elif cut <= renderer.pos[1] < nextcut \
+                or (renderer.pos[1] < 0 and cut == 0):
+                    pieces.append(renderer)
+            if self.drawing and len(pieces) > 1:
+                if self.bandhook is not None:
+                    self.bandhook(kind)
+                self.renderlist(canvas, pieces, self.current_offset - cut)
+            if nextcut >= elementlist[0]:
+                self.current_offset += elementlist[0] - cut
+                return
+            self.newpage(canvas, row)
+            cut = nextcut
+
+    # closegroups() prints the group footers from the first up to
+    # and including lastchanged, for the group ending with prevrow.
+
+    def closegroups(self, canvas, lastchanged, prevrow, row):
+        for i in range(lastchanged+1):
+            elementlist = self.groupfooters[i].generate(prevrow)
+            if self.groupfooters[i].newpagebefore \
+            or (self.current_offset + elementlist[0]) >= self.endofpage:
+                self.newpage(canvas, prevrow)
+            self.current_offset += self.addtopage(canvas, elementlist, "groupfooter")
+            self.addadditional(canvas, self.groupfooters[i], row)
+            if self.groupfooters[i].newpageafter:
+                self.current_offset = self.pagesize[1]
+
+    def finish(self, canvas):
+
+        prevrow = self.prevrow
+        row = self.lastrow
 
         if prevrow:
             for band in self.groupfooters:
                 elementlist = band.generate(prevrow)
                 if band.newpagebefore or (self.current_offset + elementlist[0]) >= self.endofpage:
                     self.newpage(canvas, row)
-                self.current_offset += self.addtopage(canvas, elementlist)
-                for aband in band.additionalbands:
-                    if aband.getrows:
-                        abandrows = aband.getrows(row)
-                    else:
-                        abandrows = [ row ]
-                    for abandrow in abandrows:
-                        elementlist = aband.generate(abandrow)
-                        if (self.current_offset + elementlist[0]) >= self.endofpage:
-                            self.newpage(canvas, row)
-                        self.current_offset += self.addtopage(canvas, elementlist)
+                self.current_offset += self.addtopage(canvas, elementlist, "groupfooter")
+                self.addadditional(canvas, band, row)
                 if band.newpageafter:
                     self.current_offset = self.pagesize[1]
 
@@ -606,23 +3781,978 @@ class Report(object):
                 elementlist = self.reportfooter.generate(row)
                 if self.reportfooter.newpagebefore or (self.current_offset + elementlist[0]) >= self.endofpage:
                     self.newpage(canvas, row)
-                self.current_offset += self.addtopage(canvas, elementlist)
-                for aband in self.reportfooter.additionalbands:
-                    if aband.getrows:
-                        abandrows = aband.getrows(row)
-                    else:
-                        abandrows = [ row ]
-                    for abandrow in abandrows:
-                        elementlist = aband.generate(abandrow)
-                        if (self.current_offset + elementlist[0]) >= self.endofpage:
-                            self.newpage(canvas, row)
-                        self.current_offset += self.addtopage(canvas, elementlist)
-
-        if self.footerelementlist:
-            for el in self.footerelementlist[1:]:
-                el.render(self.endofpage, canvas)
-
-        canvas.showPage()
+                self.current_offset += self.addtopage(canvas, elementlist, "reportfooter")
+                self.addadditional(canvas, self.reportfooter, row)
+
+        if self.drawing and not self.pagefinished:
+            if self.bandhook is not None:
+                self.bandhook("pagefooter")
+            self.renderlist(canvas, self.footerelementlist, self.endofpage)
+            canvas.showPage()
+
+    # with groupcache set, each top-level group is laid out on pages of
+    # its own, so the drawing done for it can be recorded and stored,
+    # along with a fingerprint of its rows.  on the next run, a group
+    # whose fingerprint has not changed is simply played back, with
+    # the page and row numbers printed by sysvar Elements brought up
+    # to date; only changed groups are laid out again.  the last group
+    # is always laid out, as it shares its last page with the report
+    # footer.  nothing is rendered for a group played back, so onrender
+    # handlers are not called, save for those of the sysvar Elements.
+
+    def runcached(self, canvas, datasource):
+        topband = self.topgroupband("groupcache")
+
+        self.groupcachehits = self.groupcachemisses = 0
+        if not os.path.isdir(self.groupcache):
+            os.makedirs(self.groupcache)
+        self.cacheused = set()
+        self.cacheelements = []
+        self.cacheelementids = {}
+        for band in self.allbands():
+            for element in band.elements:
+                self.cacheelementids[id(element)] = len(self.cacheelements)
+                self.cacheelements.append(element)
+        self.cachesignature = self.signature()
+        self.recorder = RecordingCanvas(canvas)
+        if self.bandhook is not None:
+            self.bandhook = self.recorder.beginband
+        if self.elementhook is not None:
+            self.elementhook = self.recorder.beginelement
+        self.startprogress()
+
+        try:
+            group = []
+            groupkey = None
+            for row in datasource:
+                self.lastrow = self.currentrow = row
+                if self.onrow is not None:
+                    self.currentrow = self.lastrow = row = self.onrow(row)
+                if row is None:
+                    continue
+                key = topband.getvalue(row)
+                if group and key != groupkey:
+                    if self.limited:
+                        self.checklimits()
+                    self.rungroup(self.recorder, groupkey, group, row)
+                    group = []
+                groupkey = key
+                group.append(row)
+            for row in group:
+                self.addrow(self.recorder, row)
+            self.finish(self.recorder)
+        except LimitReached as stop:
+            self.stopreport(self.recorder, stop)
+            self.recorder = None
+            self.progress(1)
+            return
+        finally:
+            self.recorder = None
+        self.progress(1)
+
+        for name in os.listdir(self.groupcache):
+            if name.endswith(".group") and name not in self.cacheused:
+                os.remove(os.path.join(self.groupcache, name))
+
+    # topgroupband() returns the band giving the top-level group value,
+    # checking that each top-level group begins a new page, as the
+    # named feature requires.
+
+    def topgroupband(self, feature):
+        if self.groupheaders:
+            topband = self.groupheaders[0]
+        elif self.groupfooters:
+            topband = self.groupfooters[-1]
+        else:
+            raise ValueError("%s requires group bands" % feature)
+        if not ((self.groupheaders and self.groupheaders[0].newpagebefore)
+        or (self.groupfooters and self.groupfooters[-1].newpageafter)):
+            raise ValueError("%s requires the top-level group to "
+                "begin a new page (newpagebefore or newpageafter)" % feature)
+        return topband
+
+    def rungroup(self, canvas, groupkey, rows, nextrow):
+        filename = hashlib.sha1(repr(groupkey).encode("utf-8")).hexdigest() + ".group"
+        self.cacheused.add(filename)
+        filename = os.path.join(self.groupcache, filename)
+
+        if self._fixed_detail_ht is not None:
+            layoutstate = (self._fixed_detail_ht,)
+        else:
+            layoutstate = (self._sum_detail_ht, self._avg_detail_ht,
+                           self._max_detail_ht, self.rownumber)
+        for band in self.groupfooters:
+            if band.additionalbands:
+                # these are given the first row of the next group.
+                layoutstate += (nextrow,)
+                break
+        fingerprint = hashlib.sha1(pickle.dumps(
+            (self.cachesignature, self.pagesize, self.pagenumber == 0,
+             layoutstate, rows), 2)).hexdigest()
+
+        entry = None
+        if os.path.exists(filename):
+            f = open(filename, "rb")
+            try:
+                entry = pickle.load(f)
+            finally:
+                f.close()
+            if entry["fingerprint"] != fingerprint \
+            or (entry["fellback"] and entry["startrow"] != self.rownumber):
+                entry = None
+
+        # the previous group's last page is finished here, rather than
+        # when the next page begins, so this group's drawing may be
+        # recorded or played back by itself.
+        self.endpage(canvas)
+
+        if entry is not None:
+            self.groupcachehits += 1
+            self.replaygroup(canvas, entry, rows)
+            return
+
+        self.groupcachemisses += 1
+        self.groupstartpage = self.pagenumber
+        self.groupstartrow = self.rownumber
+        fixed = self._fixed_detail_ht
+        canvas.ops = []
+        try:
+            for row in rows:
+                self.addrow(canvas, row)
+            self.closegroups(canvas, len(self.groupfooters) - 1, self.prevrow, nextrow)
+            for band in self.groupfooters:
+                band.previousvalue = None
+            self.endpage(canvas)
+            ops = canvas.ops
+        finally:
+            canvas.ops = None
+        entry = {
+            "fingerprint": fingerprint,
+            "ops": ops,
+            "pages": self.pagenumber - self.groupstartpage,
+            "startrow": self.groupstartrow,
+            "rows": self.rownumber - self.groupstartrow,
+            "fellback": fixed is not None and self._fixed_detail_ht is None,
+            "detail": (self._sum_detail_ht, self._avg_detail_ht,
+                       self._max_detail_ht, self._fixed_detail_ht),
+            "footers": [ element.savestate() for element in self.stateelements
+                         if element.report is self and self.isfooterelement(element) ],
+        }
+        try:
+            data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return # e.g. an image which cannot be pickled; not cached
+        f = open(filename, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+    def isfooterelement(self, element):
+        for band in self.allbands(self.groupfooters):
+            if element in band.elements:
+                return 1
+        return 0
+
+    def replaygroup(self, canvas, entry, rows):
+        startpage = self.pagenumber
+        startrow = self.rownumber
+        for name, args, kwargs in entry["ops"]:
+            if name is None:
+                elementid, pos, offset, pagedelta, rowdelta = args
+                self.pagenumber = startpage + pagedelta
+                self.rownumber = startrow + rowdelta
+                renderer = self.cacheelements[elementid].generate(None)
+                renderer.pos = pos
+                renderer.render(offset, canvas)
+            elif name == "bookmark":
+                level, title, top, pagedelta = args
+                self.pagenumber = startpage + pagedelta
+                self.placebookmark(level, title, top)
+            else:
+                getattr(canvas, name)(*args, **kwargs)
+        self.pagenumber = startpage + entry["pages"]
+        self.rownumber = startrow + entry["rows"]
+        self.pagefinished = 1
+        self.current_offset = self.pagesize[1]
+
+        if self._fixed_detail_ht is None or entry["fellback"]:
+            (self._sum_detail_ht, self._avg_detail_ht,
+             self._max_detail_ht, self._fixed_detail_ht) = entry["detail"]
+        footerelements = [ element for element in self.stateelements
+                           if element.report is self and self.isfooterelement(element) ]
+        for element, state in zip(footerelements, entry["footers"]):
+            element.loadstate(state)
+        lastrow = rows[-1]
+        for band in self.groupheaders:
+            band.previousvalue = band.getvalue(lastrow)
+        for band in self.groupfooters:
+            band.previousvalue = None
+        if self.reportfooter:
+            for row in rows:
+                self.reportfooter.summarize(row)
+        self.prevrow = lastrow
+        if self.onprogress is not None and self.progressrows \
+        and self.rownumber >= self.nextprogress:
+            self.progress()
+
+    # generatesharded() generates the report as generate() does, but
+    # divides the rows into about shards pieces (by default four for
+    # each process), each of whole top-level groups, and lays the
+    # pieces out in processes of their own (by default one per CPU).
+    # each top-level group must begin a new page, so that each shard
+    # does.  every shard is laid out once to count its rows, pages
+    # and detail band heights, from which the page and row numbers
+    # each begins with are found, and then again to draw it; a shard
+    # whose layout depends on the heights of the rows before it (when
+    # the detail band is not of fixed height) is counted once more in
+    # between.  the report footer's totals are merged from all the
+    # shards by the mergestate() method of each element in it which
+    # has state.
+    #
+    # the pages drawn are added to canvas in order; to a PDFCanvas
+    # directly, or to any other canvas by repeating the drawing calls
+    # made for them.  the workers are forked, so the report's
+    # functions need not be picklable, but onrow is called in this
+    # process, before the rows are divided.  where processes cannot
+    # be forked, or there is only one shard or process, the report is
+    # generated here as usual.  all the rows are held in memory here,
+    # and each shard is laid out two or three times, so this costs
+    # more in total than generate() does.
+
+    def generatesharded(self, canvas, processes = None, shards = None):
+        import multiprocessing
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if shards is None:
+            shards = processes * 4
+        self.prepare(canvas)
+        topband = self.topgroupband("generatesharded")
+        for element in self.footerstateelements():
+            if not hasattr(element, "mergestate"):
+                raise ValueError("generatesharded cannot merge the totals of %r" % element)
+
+        rows = []
+        for row in self.getdatasource():
+            if self.onrow is not None:
+                row = self.onrow(row)
+            if row is not None:
+                rows.append(row)
+        pieces = self.splitrows(rows, topband, shards)
+
+        # maxpages, maxrows and maxbytes cut the report at a point the
+        # shards cannot know in advance, so such reports are generated
+        # serially; maxseconds and cancel are checked between shards.
+        context = _forkcontext()
+        if context is None or processes < 2 or len(pieces) < 2 \
+        or self.maxpages is not None or self.maxrows is not None \
+        or self.maxbytes is not None:
+            onrow = self.onrow
+            self.onrow = None
+            try:
+                self.prepare(canvas)
+                self.run(canvas, rows)
+            finally:
+                self.onrow = onrow
+            return self.stopped
+
+        if isinstance(canvas, PDFCanvas):
+            compress = (canvas.compress, canvas.level)
+        else:
+            compress = None
+        _shardjob.update(report = self, shards = pieces, pagesize = self.pagesize,
+                         compress = compress, beginband = self.bandhook is not None,
+                         beginelement = self.elementhook is not None,
+                         bookmark = self.bookmarkhook is not None)
+        pool = context.Pool(min(processes, len(pieces)))
+        try:
+            layouts = pool.map(_runshard, [ (i, None, 0) for i in range(len(pieces)) ])
+            starts = self.shardstarts(layouts)
+            recount = [ i for i in range(len(pieces)) if starts[i]["recount"] ]
+            if recount:
+                results = pool.map(_runshard, [ (i, starts[i], 0) for i in recount ])
+                for i, layout in zip(recount, results):
+                    layouts[i] = layout
+            pagenumber = 0
+            for start, layout in zip(starts, layouts):
+                start["pagenumber"] = pagenumber
+                pagenumber += layout["pages"]
+            self.pagenumber = self.rownumber = 0
+            results = pool.imap(_runshard, [ (i, starts[i], 1) for i in range(len(pieces)) ])
+            for piece, layout, result in zip(pieces, layouts, results):
+                self.addshard(canvas, result["output"])
+                self.contents.extend(result["contents"])
+                self.pagenumber += layout["pages"]
+                self.rownumber += len(piece)
+                if self.limited and self.rownumber < len(rows):
+                    try:
+                        self.checklimits()
+                    except LimitReached as stop:
+                        self.stopped = stop
+                        break
+        finally:
+            pool.terminate()
+            pool.join()
+            _shardjob.clear()
+        return self.stopped
+
+    # splitrows() divides the rows into about count lists of similar
+    # length, ending each only where the top-level group changes.
+
+    def splitrows(self, rows, topband, count):
+        size = max(1, len(rows) // max(1, count))
+        pieces = []
+        start = 0
+        end = size
+        while end < len(rows):
+            key = topband.getvalue(rows[end - 1])
+            while end < len(rows) and topband.getvalue(rows[end]) == key:
+                end += 1
+            if end < len(rows):
+                pieces.append(rows[start:end])
+                start = end
+            end += size
+        if start < len(rows):
+            pieces.append(rows[start:])
+        return pieces
+
+    def footerstateelements(self):
+        if self.reportfooter is None:
+            return []
+        return [ element for band in self.allbands([ self.reportfooter ])
+                 for element in band.elements if hasattr(element, "savestate") ]
+
+    # shardstarts() works out the state each shard begins in from the
+    # counts made when the shards were first laid out, each beginning
+    # afresh, and notes which must be counted again from that state.
+
+    def shardstarts(self, layouts):
+        fixed = self._fixed_detail_ht
+        rownumber = total = 0
+        maxht = fixed or 0
+        footers = []
+        starts = []
+        for i, layout in enumerate(layouts):
+            if rownumber and fixed is None:
+                avg = ((total // rownumber) + maxht) // 2
+            else:
+                avg = fixed or 0
+            starts.append({
+                "rownumber": rownumber,
+                "detail": (total, avg, maxht, fixed),
+                "footers": list(footers),
+                "recount": i > 0 and (fixed is None or layout["fellback"]),
+            })
+            rownumber += layout["rows"]
+            total += layout["sum"]
+            maxht = max(maxht, layout["max"])
+            if layout["fellback"]:
+                fixed = None
+            footers.append(layout["footers"])
+        return starts
+
+    # runshard() lays out one shard in a worker process, drawing it if
+    # draw is set.  start is the state it begins in, from shardstarts(),
+    # or None to begin afresh.  a shard after the first carries on from
+    # the last row of the one before, whose last page has been finished,
+    # and a shard before the last closes its groups as they would be
+    # when the first row of the next is read.
+
+    def runshard(self, index, start, draw):
+        pieces = _shardjob["shards"]
+        rows = pieces[index]
+        pagesize = _shardjob["pagesize"]
+        if not draw:
+            canvas = NullCanvas(pagesize)
+        elif _shardjob["compress"] is not None:
+            canvas = PDFCanvas(None, pagesize, *_shardjob["compress"])
+        else:
+            target = NullCanvas(pagesize)
+            if _shardjob["beginband"]:
+                target.beginband = target._ignore
+            if _shardjob["beginelement"]:
+                target.beginelement = target._ignore
+            if _shardjob["bookmark"]:
+                target.bookmark = target._ignore
+            canvas = RecordingCanvas(target)
+            canvas.ops = []
+
+        self.onrow = self.onprogress = self.checkpointfile = None
+        self.maxseconds = self.cancel = None
+        self.prepare(canvas)
+        self.drawing = draw
+        startsum = 0
+        startfixed = self._fixed_detail_ht
+        if index:
+            prevrow = pieces[index - 1][-1]
+            self.prevrow = self.lastrow = prevrow
+            for band in self.groupheaders:
+                band.previousvalue = band.getvalue(prevrow)
+            self.pagenumber = 1
+            self.pagefinished = 1
+        if start is not None:
+            if index:
+                self.pagenumber = start.get("pagenumber", 1)
+            self.rownumber = start["rownumber"]
+            (self._sum_detail_ht, self._avg_detail_ht,
+             self._max_detail_ht, self._fixed_detail_ht) = start["detail"]
+            startsum = self._sum_detail_ht
+            startfixed = self._fixed_detail_ht
+        startpage = self.pagenumber
+        elements = self.footerstateelements()
+        last = index == len(pieces) - 1
+        if draw and last:
+            for states in start["footers"]:
+                for element, state in zip(elements, states):
+                    element.mergestate(state)
+
+        for row in rows:
+            self.lastrow = self.currentrow = row
+            self.addrow(canvas, row)
+        if last:
+            self.finish(canvas)
+        else:
+            self.rownumber += 1
+            self.closegroups(canvas, len(self.groupfooters) - 1,
+                             self.prevrow, pieces[index + 1][0])
+            self.endpage(canvas)
+            self.rownumber -= 1
+
+        if self._fixed_detail_ht is not None:
+            sumht = self._fixed_detail_ht * len(rows)
+        else:
+            sumht = self._sum_detail_ht - startsum
+        result = {
+            "rows": len(rows),
+            "pages": self.pagenumber - startpage,
+            "sum": sumht,
+            "max": self._max_detail_ht,
+            "fellback": startfixed is not None and self._fixed_detail_ht is None,
+            "footers": [ element.savestate() for element in elements ],
+        }
+        if draw:
+            result["contents"] = self.contents
+            if isinstance(canvas, PDFCanvas):
+                result["output"] = ("pdf", sorted(canvas.fonts), canvas.pages,
+                                    canvas.outlines, canvas.pagefonts)
+            else:
+                result["output"] = ("ops", canvas.ops)
+        return result
+
+    def addshard(self, canvas, output):
+        if output[0] == "pdf":
+            canvas.addpages(output[1], output[2], output[3], output[4])
+        else:
+            for name, args, kwargs in output[1]:
+                if name == "bookmark":
+                    self.bookmarkhook(*args, **kwargs)
+                else:
+                    getattr(canvas, name)(*args, **kwargs)
+
+    # signature() returns a hash of the report's definition: its
+    # bands and elements (including the code of any functions they
+    # use), margins and row handling.  the page size is not included,
+    # as it comes from the canvas.
+
+    def signature(self):
+        bands = [
+            self.titleband, self.detailband,
+            self.pageheader, self.pagefooter,
+            self.reportheader, self.reportfooter,
+            self.groupheaders, self.groupfooters,
+        ]
+        definition = describe((self.topmargin, self.bottommargin,
+            self.leftmargin, self.fields, self.presort,
+            self.onrow, self.ondetail, bands))
+        return hashlib.sha1(repr(definition).encode("utf-8")).hexdigest()
+
+
+def reportlabcanvas(filename, pagesize):
+    from reportlab.pdfgen.canvas import Canvas
+    if pagesize is None:
+        return Canvas(filename)
+    return Canvas(filename, pagesize = pagesize)
+
+
+# ReportlabOutline adds the bookmarks of a report to the outline of a
+# Reportlab Canvas, which has no bookmark() method of its own.
+
+class ReportlabOutline(object):
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.count = 0
+        self.level = -1
+
+    # Reportlab refuses an entry more than one level below the one
+    # before it, as happens when generatepages() begins within a group,
+    # so such an entry is moved up to the level below.
+
+    def bookmark(self, title, level, top):
+        if not self.count:
+            self.canvas.showOutline()
+        self.count += 1
+        level = min(level, self.level + 1)
+        self.level = level
+        key = "outline%d" % self.count
+        self.canvas.bookmarkPage(key, fit = "XYZ", top = top)
+        self.canvas.addOutlineEntry(title, key, level, closed = 1)
+
+
+# generatesharded() leaves the report and its shards here for the
+# worker processes, which are forked from it, to find.
+
+_shardjob = {}
+
+def _runshard(args):
+    index, start, draw = args
+    return _shardjob["report"].runshard(index, start, draw)
+
+def _forkcontext():
+    if not hasattr(os, "fork"):
+        return None
+    import multiprocessing
+    if not hasattr(multiprocessing, "get_context"):
+        return multiprocessing
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context("fork")
+
+
+# describe() turns a report definition into nested tuples of plain
+# values, for hashing; functions are described by their code, and
+# the attributes set while a report runs are left out.
+
+_runtimeattrs = set([
+    "report", "previousvalue", "summary", "_key", "cells",
+    "_rowkey", "_columnkey", "_labelkey", "heap", "seq",
+    "positive", "negative", "zeros", "total",
+    "_memo", "_memolookups", "_memohits",
+    "ownheight", "fixedheight", "checklines", "blocks",
+])
+
+def describe(value, seen = None):
+    if seen is None:
+        seen = set()
+    if isinstance(value, (list, tuple)):
+        return tuple([ describe(v, seen) for v in value ])
+    if isinstance(value, dict):
+        return tuple(sorted([ (repr(k), describe(v, seen))
+                              for k, v in value.items() ]))
+    code = getattr(value, "__code__", None)
+    if code is not None:
+        if id(value) in seen:
+            return "<recursive>"
+        seen.add(id(value))
+        cells = [ describecell(cell, seen) for cell in (value.__closure__ or ()) ]
+        return ("function", describecode(code),
+                describe(value.__defaults__, seen), tuple(cells))
+    if hasattr(value, "__dict__") and not isinstance(value, type):
+        if id(value) in seen:
+            return "<recursive>"
+        seen.add(id(value))
+        attrs = []
+        for k, v in sorted(vars(value).items()):
+            v = getattr(v, "_unprofiled", v) # see Report.startprofile()
+            if k not in _runtimeattrs and v is not _notwrapped:
+                attrs.append((k, describe(v, seen)))
+        return (type(value).__name__, tuple(attrs))
+    if callable(value):
+        return ("callable", getattr(value, "__module__", None),
+                getattr(value, "__name__", repr(value)))
+    return repr(value)
+
+# a closure cell is empty when the function refers to a variable of
+# the enclosing function which has not been assigned yet.
+
+def describecell(cell, seen):
+    try:
+        contents = cell.cell_contents
+    except ValueError:
+        return "<empty>"
+    return describe(contents, seen)
+
+def describecode(code):
+    consts = tuple([ describecode(c) if hasattr(c, "co_code") else repr(c)
+                     for c in code.co_consts ])
+    return (code.co_code, consts, code.co_names)
+
+
+# report specs
+#
+# a spec is a report definition made only of dicts, lists, strings
+# and numbers (as might be read from a JSON file), so that it can be
+# stored, or sent to another process, where compilespec() turns it
+# into a Report.  functions are referred to by the names they were
+# registered under, with registerfunction() and registerformat(), so
+# they must be registered in every process which compiles the spec.
+
+specfunctions = {}
+specformats = { "str": str }
+specelements = { "element": Element, "sum": SumElement, "rule": Rule, "image": Image,
+                 "crosstab": CrossTab, "top": TopElement, "quantile": QuantileElement }
+
+specbandkeys = set([ "elements", "childbands", "additionalbands", "key",
+    "getvalue", "newpagebefore", "newpageafter", "hidden", "getrows", "bookmark" ])
+specreportkeys = set([ "titleband", "detailband", "pageheader", "pagefooter",
+    "reportheader", "reportfooter", "groupheaders", "groupfooters",
+    "onrow", "onnewpage", "ondetail", "topmargin", "bottommargin",
+    "leftmargin", "fields", "presort", "sorttempdir", "datasource", "name",
+    "maxpages", "maxrows", "maxseconds", "maxbytes" ])
+
+# compiled specs are kept, keyed by a hash of the spec, so that the
+# same definition is compiled only once per process.  each caller
+# gets a copy of the kept Report, as jobs may be run on several
+# threads at once, and each sets its own datasource and limits.
+
+speccache = {}
+speccacheorder = []
+speccachesize = 64
+
+def registerfunction(name, func):
+    specfunctions[name] = func
+    clearspeccache()
+
+def registerformat(name, func):
+    specformats[name] = func
+    clearspeccache()
+
+def clearspeccache():
+    speccache.clear()
+    del speccacheorder[:]
+
+def specfunction(name):
+    if name is None:
+        return None
+    try:
+        return specfunctions[name]
+    except KeyError:
+        raise ValueError("no function registered as %r" % (name,))
+
+# a band's bookmark may name a function, or simply be true.
+
+def specbookmark(value):
+    if hasattr(value, "encode"):
+        return specfunction(value)
+    return value
+
+def specformat(name):
+    if name in specformats:
+        return specformats[name]
+    if "%" in name:
+        return lambda value: name % value
+    raise ValueError("no format registered as %r" % (name,))
+
+def compileelement(spec):
+    spec = dict(spec)
+    kind = spec.pop("type", "element")
+    if kind not in specelements:
+        raise ValueError("unknown element type %r" % (kind,))
+    for name in ("pos", "font", "headerfont"):
+        if spec.get(name) is not None:
+            spec[name] = tuple(spec[name])
+    for name in ("getvalue", "onrender", "getrowkey", "getcolumnkey", "getlabel"):
+        if name in spec:
+            spec[name] = specfunction(spec[name])
+    if "format" in spec:
+        spec["format"] = specformat(spec["format"])
+    return specelements[kind](**spec)
+
+def compileband(spec):
+    if spec is None:
+        return None
+    unknown = set(spec) - specbandkeys
+    if unknown:
+        raise ValueError("unknown band settings: %s" % ", ".join(sorted(unknown)))
+    return Band([ compileelement(element) for element in spec.get("elements", []) ],
+        childbands = [ compileband(band) for band in spec.get("childbands", []) ],
+        additionalbands = [ compileband(band) for band in spec.get("additionalbands", []) ],
+        key = spec.get("key"),
+        getvalue = specfunction(spec.get("getvalue")),
+        newpagebefore = spec.get("newpagebefore", 0),
+        newpageafter = spec.get("newpageafter", 0),
+        hidden = spec.get("hidden", 0),
+        getrows = specfunction(spec.get("getrows")),
+        bookmark = specbookmark(spec.get("bookmark")))
+
+# compilespec() returns the Report for a spec, without a datasource.
+# each call returns a fresh copy of the compiled Report, so reports
+# from the same spec may be changed and generated independently.  a
+# spec may name a registered function as its datasource;
+# reportfromspec() calls it, with params, to get the datasource.
+
+def compilespec(spec):
+    key = hashlib.sha1(json.dumps(spec, sort_keys = True).encode("utf-8")).hexdigest()
+    rpt = speccache.get(key)
+    if rpt is not None:
+        return copy.deepcopy(rpt)
+    unknown = set(spec) - specreportkeys
+    if unknown:
+        raise ValueError("unknown report settings: %s" % ", ".join(sorted(unknown)))
+    rpt = Report(
+        titleband = compileband(spec.get("titleband")),
+        detailband = compileband(spec.get("detailband")),
+        pageheader = compileband(spec.get("pageheader")),
+        pagefooter = compileband(spec.get("pagefooter")),
+        reportheader = compileband(spec.get("reportheader")),
+        reportfooter = compileband(spec.get("reportfooter")),
+        groupheaders = [ compileband(band) for band in spec.get("groupheaders", []) ],
+        groupfooters = [ compileband(band) for band in spec.get("groupfooters", []) ],
+        onrow = specfunction(spec.get("onrow")),
+        onnewpage = specfunction(spec.get("onnewpage")),
+        ondetail = specfunction(spec.get("ondetail")))
+    for name in ("topmargin", "bottommargin", "leftmargin", "fields",
+                 "presort", "sorttempdir", "maxpages", "maxrows",
+                 "maxseconds", "maxbytes"):
+        if name in spec:
+            setattr(rpt, name, spec[name])
+    speccache[key] = rpt
+    speccacheorder.append(key)
+    while len(speccacheorder) > speccachesize:
+        del speccache[speccacheorder.pop(0)]
+    return copy.deepcopy(rpt)
+
+def reportfromspec(spec, params = None):
+    rpt = compilespec(spec)
+    if spec.get("datasource") is not None:
+        rpt.datasource = specfunction(spec["datasource"])(**(params or {}))
+    return rpt
+
+
+# ReportPool keeps a set of worker processes, each of which calls
+# setup() once when it starts, to import whatever it needs, register
+# fonts, register spec functions, load images and so on, and get a
+# dict mapping report names to factory functions.  a job names a
+# report and passes params to its factory, which returns a Report (or
+# gives a report spec, whose datasource function gets the params);
+# the worker generates it and returns the output as a ReportResult,
+# with its timing.  setup must be a module-level function so it can
+# be sent to the workers.
+#
+# limits, given to the pool or to a single job, is a dict of Report
+# limits (maxpages, maxrows, maxseconds, maxbytes) set on each report
+# before it is generated; the job's own limits win.  a report stopped
+# by a limit still returns its partial output, with the reason in
+# ReportResult.stopped.
+#
+# LocalReportPool does the same in the calling process, for tests;
+# ReportServer and ReportClient carry jobs over a local socket.
+
+class ReportResult(object):
+
+    def __init__(self, name, data, pages, rows, timing, worker, stopped = None):
+        self.name = name
+        self.data = data
+        self.pages = pages
+        self.rows = rows
+        self.timing = timing
+        self.worker = worker
+        self.stopped = stopped
+
+    def __repr__(self):
+        if self.stopped:
+            return "<ReportResult %s: %d pages, %d bytes, %.3f s, stopped (%s)>" % (
+                self.name, self.pages, len(self.data), self.timing["total"],
+                self.stopped)
+        return "<ReportResult %s: %d pages, %d bytes, %.3f s>" % (
+            self.name, self.pages, len(self.data), self.timing["total"])
+
+
+_workerstate = {}
+
+def _initworker(setup, makecanvas, pagesize, limits = None):
+    start = clock()
+    if makecanvas is None:
+        import reportlab.pdfgen.canvas
+        makecanvas = reportlabcanvas
+    _workerstate["reports"] = setup() or {}
+    _workerstate["makecanvas"] = makecanvas
+    _workerstate["pagesize"] = pagesize
+    _workerstate["limits"] = limits or {}
+    _workerstate["setup"] = clock() - start
+
+# the times in ReportResult.timing are in seconds: queued is from
+# submission until a worker took the job (measured by the wall
+# clock, as it spans processes), build is the factory's run, and
+# generate covers generating the report and saving the output.
+
+joblimitnames = ("maxpages", "maxrows", "maxseconds", "maxbytes")
+
+def runjob(name, params, submitted, limits = None):
+    import io, traceback
+    started = time.time()
+    try:
+        start = clock()
+        if isinstance(name, dict):
+            rpt = reportfromspec(name, params)
+            name = name.get("name", "spec")
+        else:
+            rpt = _workerstate["reports"][name](**(params or {}))
+        built = clock()
+        joblimits = dict(_workerstate["limits"])
+        joblimits.update(limits or {})
+        # the factory may hand out the same Report to every job, so the
+        # limits it had are put back afterward.
+        saved = [ (attr, getattr(rpt, attr)) for attr in joblimitnames ]
+        try:
+            for attr in joblimitnames:
+                if attr in joblimits:
+                    setattr(rpt, attr, joblimits[attr])
+            output = io.BytesIO()
+            canvas = _workerstate["makecanvas"](output, _workerstate["pagesize"])
+            stopped = rpt.generate(canvas)
+            canvas.save()
+        finally:
+            for attr, value in saved:
+                setattr(rpt, attr, value)
+        done = clock()
+    except Exception:
+        raise RuntimeError("report %s failed:\n%s" % (name, traceback.format_exc()))
+    timing = {
+        "queued": max(0.0, started - submitted),
+        "build": built - start,
+        "generate": done - built,
+        "total": time.time() - submitted,
+        "setup": _workerstate["setup"],
+    }
+    return ReportResult(name, output.getvalue(), rpt.pagenumber, rpt.rownumber,
+                        timing, os.getpid(), stopped and stopped.reason)
+
+
+class ReportPool(object):
+
+    def __init__(self, setup, processes = None, makecanvas = None,
+                 pagesize = (612, 792), limits = None):
+        import multiprocessing
+        self.pool = multiprocessing.Pool(processes, _initworker,
+                                         (setup, makecanvas, pagesize, limits))
+
+    # submit() returns an object whose get() method waits for the job
+    # and returns its ReportResult, or raises RuntimeError if it failed.
+
+    def submit(self, name, params = None, limits = None):
+        return self.pool.apply_async(runjob, (name, params, time.time(), limits))
+
+    def run(self, name, params = None, limits = None):
+        return self.submit(name, params, limits).get()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class FinishedJob(object):
+
+    def __init__(self, result = None, error = None):
+        self.result = result
+        self.error = error
+
+    def get(self, timeout = None):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class LocalReportPool(object):
+
+    def __init__(self, setup, makecanvas = None, pagesize = (612, 792),
+                 limits = None):
+        _initworker(setup, makecanvas, pagesize, limits)
+        self.state = dict(_workerstate)
+
+    def submit(self, name, params = None, limits = None):
+        _workerstate.update(self.state)
+        try:
+            return FinishedJob(runjob(name, params, time.time(), limits))
+        except RuntimeError as e:
+            return FinishedJob(error = e)
+
+    def run(self, name, params = None, limits = None):
+        return self.submit(name, params, limits).get()
+
+    def close(self):
+        pass
+
+
+# ReportServer accepts jobs for a pool from ReportClients, using
+# multiprocessing.connection.  the requests are pickled, so a client
+# must always give the authkey (bytes); if none is given here, a
+# random one is made, to be passed to the clients from server.authkey.
+# each connection is served by a thread of its own, and may send any
+# number of (name, params) or (name, params, limits) requests, each answered by a ReportResult
+# or a RuntimeError.
+
+class ReportServer(object):
+
+    def __init__(self, pool, address = ("localhost", 0), authkey = None):
+        from multiprocessing.connection import Listener
+        if authkey is None:
+            authkey = os.urandom(32)
+        self.pool = pool
+        self.authkey = authkey
+        self.listener = Listener(address, authkey = authkey)
+        self.address = self.listener.address
+
+    # a client which fails to connect (giving the wrong authkey, say)
+    # is dropped, and serve() carries on while the listener is open.
+
+    def serve(self):
+        import threading
+        from multiprocessing import AuthenticationError
+        while 1:
+            try:
+                conn = self.listener.accept()
+            except (AuthenticationError, OSError, IOError, EOFError):
+                if not self.listening():
+                    return
+                continue
+            thread = threading.Thread(target = self.handle, args = (conn,))
+            thread.daemon = True
+            thread.start()
+
+    def listening(self):
+        listener = self.listener
+        return listener is not None and getattr(listener, "_listener", 1) is not None
+
+    def handle(self, conn):
+        try:
+            while 1:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    return
+                name, params = request[:2]
+                limits = None
+                if len(request) > 2:
+                    limits = request[2]
+                try:
+                    reply = self.pool.submit(name, params, limits).get()
+                except Exception as e:
+                    reply = RuntimeError(str(e))
+                conn.send(reply)
+        finally:
+            conn.close()
+
+    def close(self):
+        listener, self.listener = self.listener, None
+        listener.close()
+
+
+class ReportClient(object):
+
+    def __init__(self, address, authkey):
+        from multiprocessing.connection import Client
+        self.conn = Client(address, authkey = authkey)
+
+    def run(self, name, params = None, limits = None):
+        self.conn.send((name, params, limits))
+        reply = self.conn.recv()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def close(self):
+        self.conn.close()
 
 
 # end of file.
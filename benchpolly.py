@@ -0,0 +1,311 @@
+# PollyReports
+# Copyright 2012 Chris Gonnerman
+# All rights reserved.
+#
+# BSD 2-Clause License
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.  Redistributions in binary
+# form must reproduce the above copyright notice, this list of conditions and
+# the following disclaimer in the documentation and/or other materials
+# provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+    benchpolly.py -- measure PollyReports throughput and memory use
+
+    usage: python benchpolly.py [options]
+
+        --sizes N,N,...     row counts to run (default 10000,100000;
+                            the full suite is 10000,100000,1000000,10000000)
+        --shapes S,S,...    report shapes to run (default all): detail,
+                            groups, wrapped, images, additional
+        --canvas C          reportlab (default), pdf (PollyReports'
+                            own PDFCanvas; not for the images shape),
+                            text, csv, html, or null, to measure
+                            layout alone
+        --output FILE       write the JSON results to FILE (default stdout)
+        --compare FILE      compare against earlier JSON results, and
+                            exit with status 1 if any case is slower by
+                            more than --tolerance percent (default 10)
+
+    each case is run in a process of its own, so that the peak RSS
+    reported belongs to that case alone.
+"""
+
+
+import json, os, platform, random, subprocess, sys, tempfile, time
+
+from PollyReports import *
+from PollyReports import clock
+
+
+SHAPES = [ "detail", "groups", "wrapped", "images", "additional" ]
+
+WORDS = ("alpha bravo charlie delta echo foxtrot golf hotel india juliet "
+         "kilo lima mike november oscar papa quebec romeo sierra tango").split()
+
+IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "typewriter.png")
+
+
+# the synthetic rows are generated as they are read, so that even
+# the largest datasources take no memory to speak of.  they come in
+# order by region, branch and account, for the group bands.
+
+def datasource(rows, seed = 1):
+    rnd = random.Random(seed)
+    for i in range(rows):
+        yield {
+            "region": i * 10 // rows,
+            "branch": i * 100 // rows,
+            "account": i // 25,
+            "name": "Customer %d" % i,
+            "amount": rnd.randint(1, 100000) / 100.0,
+            "note": " ".join([ rnd.choice(WORDS) for j in range(rnd.randint(3, 30)) ]),
+        }
+
+
+def detailband():
+    return Band([
+        Element((36, 0), ("Helvetica", 10), key = "name"),
+        Element((300, 0), ("Helvetica", 10), key = "account"),
+        Element((500, 0), ("Helvetica", 10), key = "amount",
+                align = "right", format = lambda x: "%.2f" % x),
+    ])
+
+
+def makereport(shape, rows):
+    rpt = Report(datasource(rows))
+    rpt.detailband = detailband()
+    rpt.pageheader = Band([
+        Element((36, 0), ("Times-Bold", 16), text = "Benchmark: %s" % shape),
+        Element((500, 0), ("Helvetica", 10), sysvar = "pagenumber", align = "right"),
+        Rule((36, 20), 7.5*72),
+    ])
+    rpt.pagefooter = Band([
+        Element((36, 0), ("Helvetica", 8), sysvar = "rownumber",
+                format = lambda x: "rows to date: %d" % x),
+    ])
+    rpt.reportfooter = Band([
+        Rule((400, 4), 100),
+        SumElement((500, 6), ("Helvetica-Bold", 10), key = "amount",
+                   align = "right", format = lambda x: "%.2f" % x),
+    ])
+
+    if shape == "groups":
+        rpt.groupheaders = [
+            Band([ Element((36, 0), ("Helvetica-Bold", 12), key = "region") ],
+                 getvalue = lambda row: row["region"]),
+            Band([ Element((54, 0), ("Helvetica-Bold", 11), key = "branch") ],
+                 getvalue = lambda row: row["branch"]),
+            Band([ Element((72, 0), ("Helvetica", 10), key = "account") ],
+                 getvalue = lambda row: row["account"]),
+        ]
+        rpt.groupfooters = [
+            Band([ SumElement((500, 0), ("Helvetica", 10), key = "amount",
+                              align = "right", format = lambda x: "%.2f" % x) ],
+                 getvalue = lambda row: row["account"]),
+            Band([ SumElement((500, 0), ("Helvetica-Bold", 10), key = "amount",
+                              align = "right", format = lambda x: "%.2f" % x) ],
+                 getvalue = lambda row: row["branch"]),
+            Band([ SumElement((500, 0), ("Helvetica-Bold", 11), key = "amount",
+                              align = "right", format = lambda x: "%.2f" % x) ],
+                 getvalue = lambda row: row["region"]),
+        ]
+
+    elif shape == "wrapped":
+        rpt.detailband.childbands = [
+            Band([ Element((72, 0), ("Helvetica", 9), key = "note", width = 300) ]),
+        ]
+
+    elif shape == "images":
+        rpt.detailband = Band(detailband().elements + [
+            Image((540, 0), 12, 12, text = IMAGE),
+        ])
+
+    elif shape == "additional":
+        rpt.groupheaders = [
+            Band([ Element((36, 0), ("Helvetica-Bold", 11), key = "account") ],
+                 getvalue = lambda row: row["account"]),
+        ]
+        rpt.groupfooters = [
+            Band([ SumElement((500, 0), ("Helvetica-Bold", 10), key = "amount",
+                              align = "right", format = lambda x: "%.2f" % x) ],
+                 getvalue = lambda row: row["account"],
+                 additionalbands = [
+                     Band([ Element((72, 0), ("Helvetica", 9), key = "line") ],
+                          getrows = lambda row: [ { "line": "memo %d for account %d" % (i, row["account"]) }
+                                                  for i in range(3) ]),
+                 ]),
+        ]
+
+    return rpt
+
+
+def peakrss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss      # bytes
+    return rss * 1024   # kilobytes
+
+
+def runcase(shape, rows, canvastype):
+    rpt = makereport(shape, rows)
+    outputbytes = None
+    if canvastype == "null":
+        canvas = NullCanvas((612, 792))
+        start = clock()
+        rpt.generate(canvas)
+        elapsed = clock() - start
+    else:
+        if canvastype == "pdf":
+            Canvas = PDFCanvas
+        elif canvastype == "text":
+            Canvas = TextCanvas
+        elif canvastype == "csv":
+            Canvas = lambda filename, pagesize: CSVCanvas(filename)
+        elif canvastype == "html":
+            Canvas = HTMLCanvas
+        else:
+            from reportlab.pdfgen.canvas import Canvas
+        fd, filename = tempfile.mkstemp(suffix = "." + canvastype)
+        os.close(fd)
+        try:
+            canvas = Canvas(filename, (612, 792))
+            start = clock()
+            rpt.generate(canvas)
+            canvas.save()
+            elapsed = clock() - start
+            outputbytes = os.path.getsize(filename)
+        finally:
+            os.remove(filename)
+    elapsed = max(elapsed, 1e-9)
+    return {
+        "shape": shape,
+        "rows": rpt.rownumber,
+        "pages": rpt.pagenumber,
+        "canvas": canvastype,
+        "seconds": round(elapsed, 4),
+        "rows_per_sec": round(rpt.rownumber / elapsed, 1),
+        "pages_per_sec": round(rpt.pagenumber / elapsed, 2),
+        "peak_rss_bytes": peakrss(),
+        "output_bytes": outputbytes,
+    }
+
+
+def runsuite(sizes, shapes, canvastype):
+    results = []
+    for rows in sizes:
+        for shape in shapes:
+            proc = subprocess.Popen([ sys.executable, os.path.abspath(__file__),
+                "--case", shape, str(rows), canvastype ], stdout = subprocess.PIPE)
+            out = proc.communicate()[0]
+            if proc.returncode != 0:
+                raise SystemExit("case %s/%d failed" % (shape, rows))
+            result = json.loads(out.decode("utf-8"))
+            sys.stderr.write("%-10s %9d rows %7d pages %10.1f rows/s %8.2f pages/s\n"
+                % (shape, result["rows"], result["pages"],
+                   result["rows_per_sec"], result["pages_per_sec"]))
+            results.append(result)
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "results": results,
+    }
+
+
+# compare() lists the cases found in both sets of results whose
+# throughput has fallen by more than tolerance percent.
+
+def compare(old, new, tolerance):
+    before = {}
+    for result in old["results"]:
+        before[result["shape"], result["rows"], result["canvas"]] = result
+    slower = []
+    for result in new["results"]:
+        prev = before.get((result["shape"], result["rows"], result["canvas"]))
+        if prev is None:
+            continue
+        change = (result["rows_per_sec"] - prev["rows_per_sec"]) * 100.0 / prev["rows_per_sec"]
+        sys.stderr.write("%-10s %9d rows %+7.1f%%\n" % (result["shape"], result["rows"], change))
+        if change < -tolerance:
+            slower.append(result)
+    return slower
+
+
+def main(args):
+    if args[:1] == [ "--case" ]:
+        shape, rows, canvastype = args[1], int(args[2]), args[3]
+        sys.stdout.write(json.dumps(runcase(shape, rows, canvastype)))
+        return 0
+
+    sizes = [ 10000, 100000 ]
+    shapes = SHAPES
+    canvastype = "reportlab"
+    output = None
+    comparefile = None
+    tolerance = 10.0
+    while args:
+        opt = args.pop(0)
+        if not args:
+            raise SystemExit(__doc__)
+        value = args.pop(0)
+        if opt == "--sizes":
+            sizes = [ int(n) for n in value.split(",") ]
+        elif opt == "--shapes":
+            shapes = value.split(",")
+            for shape in shapes:
+                if shape not in SHAPES:
+                    raise SystemExit("unknown shape: %s" % shape)
+        elif opt == "--canvas":
+            canvastype = value
+        elif opt == "--output":
+            output = value
+        elif opt == "--compare":
+            comparefile = value
+        elif opt == "--tolerance":
+            tolerance = float(value)
+        else:
+            raise SystemExit(__doc__)
+
+    results = runsuite(sizes, shapes, canvastype)
+    text = json.dumps(results, indent = 2, sort_keys = True)
+    if output:
+        f = open(output, "w")
+        f.write(text + "\n")
+        f.close()
+    else:
+        sys.stdout.write(text + "\n")
+
+    if comparefile:
+        f = open(comparefile)
+        old = json.load(f)
+        f.close()
+        if compare(old, results, tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+
+# end of file.
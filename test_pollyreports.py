@@ -0,0 +1,971 @@
+# PollyReports
+# Copyright 2012 Chris Gonnerman
+# All rights reserved.
+#
+# BSD 2-Clause License
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.  Redistributions in binary
+# form must reproduce the above copyright notice, this list of conditions and
+# the following disclaimer in the documentation and/or other materials
+# provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+    test_pollyreports.py -- behaviour checks for PollyReports
+
+    usage: python -m unittest test_pollyreports  (or python -m pytest)
+
+    most checks generate the same report by two routes and compare the
+    output byte for byte, using PollyReports' own PDFCanvas so that
+    Reportlab is not needed.
+"""
+
+
+import io, os, random, shutil, sys, tempfile, unittest
+
+from PollyReports import *
+
+
+def makerows(count = 2000, seed = 1):
+    rnd = random.Random(seed)
+    return [ { "region": i * 5 // count, "account": i // 40, "name": "Customer %d" % i,
+               "amount": rnd.randint(1, 100000) / 100.0 }
+             for i in range(count) ]
+
+
+def makereport(rows = None):
+    rpt = Report(makerows() if rows is None else rows)
+    rpt.pageheader = Band([
+        Element((36, 0), ("Helvetica-Bold", 12), text = "Test Report"),
+        Element((500, 0), ("Helvetica", 10), sysvar = "pagenumber", align = "right"),
+    ])
+    rpt.detailband = Band([
+        Element((36, 0), ("Helvetica", 10), key = "name"),
+        Element((500, 0), ("Helvetica", 10), key = "amount", align = "right",
+                format = lambda x: "%.2f" % x),
+    ])
+    rpt.groupheaders = [
+        Band([ Element((36, 0), ("Helvetica-Bold", 12), key = "region",
+                       format = lambda x: "Region %d" % x) ],
+             key = "region", newpagebefore = 1),
+        Band([ Element((36, 0), ("Helvetica", 11), key = "account") ], key = "account"),
+    ]
+    rpt.groupfooters = [
+        Band([ SumElement((500, 0), ("Helvetica", 10), key = "amount", align = "right",
+                          format = lambda x: "%.2f" % x) ], key = "region"),
+    ]
+    rpt.reportfooter = Band([
+        SumElement((500, 0), ("Helvetica-Bold", 10), key = "amount", align = "right",
+                   format = lambda x: "%.2f" % x),
+    ])
+    return rpt
+
+
+def pdfbytes(rpt, method = "generate", **canvasargs):
+    output = io.BytesIO()
+    canvas = PDFCanvas(output, **canvasargs)
+    if method == "generatesharded":
+        rpt.generatesharded(canvas, processes = 2)
+    else:
+        getattr(rpt, method)(canvas)
+    canvas.save()
+    return output.getvalue()
+
+
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors = True)
+
+
+class PaginateTest(unittest.TestCase):
+
+    def makereport(self):
+        rpt = makereport()
+        rpt.reportfooter.elements.append(CrossTab((0, 0), ("Helvetica", 8),
+            rowkey = "region", getcolumnkey = lambda row: row["account"] % 10,
+            key = "amount"))
+        return rpt
+
+    def test_state_saved_only_where_pages_begin(self):
+        rpt = self.makereport()
+        calls = []
+        saveelements = rpt.saveelements
+        def countingsaveelements():
+            calls.append(1)
+            return saveelements()
+        rpt.saveelements = countingsaveelements
+        pageindex = rpt.paginate((612, 792))
+        self.assertTrue(len(calls) < 200)
+
+        # the states saved must be those saved for every row.
+        everyrow = self.makereport()
+        def rowstate(row):
+            everyrow.wantstate = 0
+            everyrow.rowstart = (everyrow.rowstart[0], everyrow.savestate())
+        everyrow.rowstate = rowstate
+        expected = everyrow.paginate((612, 792))
+        self.assertEqual(pageindex.pagecount, expected.pagecount)
+        for entry, other in zip(pageindex.pages, expected.pages):
+            self.assertEqual((entry.position, entry.state), (other.position, other.state))
+
+    def test_page_index_matches_generate(self):
+        rpt = makereport()
+        rpt.generate(NullCanvas((612, 792)))
+        pageindex = makereport().paginate((612, 792))
+        self.assertEqual(pageindex.pagecount, rpt.pagenumber)
+        self.assertEqual(pageindex.rowcount, 2000)
+        self.assertEqual([ entry.pagenumber for entry in pageindex ],
+                         list(range(1, rpt.pagenumber + 1)))
+        rownumbers = [ entry.rownumber for entry in pageindex ]
+        self.assertEqual(rownumbers, sorted(rownumbers))
+
+    def test_generatepages_matches_generate(self):
+        rpt = self.makereport()
+        pageindex = rpt.paginate((612, 792))
+        canvas = NullCanvas((612, 792))
+        rpt.generatepages(canvas, pageindex, pageindex.pagecount - 3, pageindex.pagecount)
+        self.assertEqual(rpt.rownumber, 2000)
+        self.assertEqual(rpt.pagenumber, pageindex.pagecount)
+
+
+class StarImportTest(unittest.TestCase):
+
+    def test_exports_only_public_names(self):
+        import PollyReports
+        names = {}
+        exec("from PollyReports import *", names)
+        del names["__builtins__"]
+        self.assertEqual(sorted(names), sorted(PollyReports.__all__))
+        for name in ("os", "time", "json", "csv", "copy", "pickle", "totext", "runjob"):
+            self.assertFalse(name in names)
+
+
+class SortedSourceTest(TempDirTestCase):
+
+    def test_sorts_stably_across_spilled_runs(self):
+        rows = [ (i % 7, i) for i in range(1000) ]
+        source = SortedSource(rows, lambda row: row[0], runsize = 64, tempdir = self.tempdir)
+        self.assertEqual(list(source), sorted(rows, key = lambda row: row[0]))
+
+    def test_presort_matches_sorted_datasource(self):
+        rows = makerows()
+        shuffled = list(rows)
+        random.Random(2).shuffle(shuffled)
+        shuffled.sort(key = lambda row: row["account"])
+        expected = pdfbytes(makereport(sorted(shuffled, key = lambda row: row["region"])))
+        rpt = makereport(shuffled)
+        rpt.presort = 100
+        rpt.sorttempdir = self.tempdir
+        self.assertEqual(pdfbytes(rpt), expected)
+
+
+class CSVSourceTest(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.filename = os.path.join(self.tempdir, "rows.csv")
+        f = open(self.filename, "w")
+        f.write("name,amount\nalpha,1.5\nbravo,\ncharlie,3\n")
+        f.close()
+
+    def test_header_and_types(self):
+        rows = list(CSVSource(self.filename, types = { "amount": float }))
+        self.assertEqual([ (row["name"], row["amount"]) for row in rows ],
+                         [ ("alpha", 1.5), ("bravo", None), ("charlie", 3.0) ])
+
+    def test_no_header_needs_fields(self):
+        self.assertRaises(ValueError, CSVSource, self.filename, header = 0)
+
+    def test_rowsfrom_reads_header_on_fresh_source(self):
+        source = CSVSource(self.filename)
+        positions = []
+        for row in source:
+            positions.append((source.tell(), row["name"]))
+        fresh = CSVSource(self.filename)
+        self.assertEqual([ row["name"] for row in fresh.rowsfrom(positions[1][0]) ],
+                         [ "bravo", "charlie" ])
+
+    def rendered(self, source):
+        rpt = Report(source)
+        amount = Element((36, 0), ("Helvetica", 10), key = "amount")
+        rpt.detailband = Band([ amount ])
+        text = []
+        canvas = NullCanvas((612, 792))
+        canvas.drawString = lambda x, y, s: text.append(s)
+        rpt.generate(canvas)
+        return amount._key, text
+
+    def test_keys_bound_on_first_run(self):
+        key, text = self.rendered(CSVSource(self.filename))
+        self.assertEqual(key, 1)
+        self.assertEqual(text, [ "1.5", "", "3" ])
+
+    def test_keys_rebound_when_file_rewritten(self):
+        source = CSVSource(self.filename)
+        self.rendered(source)
+        f = open(self.filename, "w")
+        f.write("amount,name\n7,delta\n")
+        f.close()
+        self.assertEqual(self.rendered(source), (0, [ "7" ]))
+
+
+class JSONLSourceTest(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.filename = os.path.join(self.tempdir, "rows.jsonl")
+        f = open(self.filename, "w")
+        f.write('{"name": "alpha", "amount": 1.5}\n\n'
+                '{"name": "bravo"}\n'
+                '{"amount": 3, "name": "charlie", "extra": 1}\n')
+        f.close()
+
+    def test_fields_from_first_object(self):
+        source = JSONLSource(self.filename)
+        self.assertEqual([ tuple(row) for row in source ],
+                         [ ("alpha", 1.5), ("bravo", None), ("charlie", 3) ])
+        self.assertEqual(source.fields, ("name", "amount"))
+
+    def test_given_fields_and_types(self):
+        source = JSONLSource(self.filename, fields = [ "amount" ], types = { "amount": str })
+        self.assertEqual([ row["amount"] for row in source ], [ "1.5", None, "3" ])
+
+    def test_rowsfrom_tell(self):
+        source = JSONLSource(self.filename)
+        positions = []
+        for row in source:
+            positions.append(source.tell())
+        fresh = JSONLSource(self.filename)
+        self.assertEqual([ row["name"] for row in fresh.rowsfrom(positions[1]) ],
+                         [ "bravo", "charlie" ])
+
+
+class QuerySourceTest(unittest.TestCase):
+
+    def setUp(self):
+        import sqlite3
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.execute("create table t (id integer, name text)")
+        self.connection.executemany("insert into t values (?, ?)",
+                                    [ (i, "row %d" % i) for i in range(10) ])
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_rowsfrom_offset(self):
+        source = QuerySource(self.connection, "select id, name from t order by id")
+        self.assertEqual([ row["id"] for row in source ], list(range(10)))
+        self.assertEqual([ row["name"] for row in source.rowsfrom(7) ],
+                         [ "row 7", "row 8", "row 9" ])
+
+    def test_custom_offsetquery(self):
+        source = QuerySource(self.connection, "select id from t order by id",
+                             offsetquery = "%s LIMIT 1 OFFSET %d")
+        self.assertEqual([ row["id"] for row in source.rowsfrom(8) ], [ 8 ])
+
+    def test_fingerprint_follows_data(self):
+        self.assertEqual(QuerySource(self.connection, "select id from t").fingerprint(), None)
+        source = QuerySource(self.connection, "select id from t where id < ?", (5, ),
+                             fingerprintquery = "select count(*) from t where id < ?")
+        before = source.fingerprint()
+        self.assertEqual(source.fingerprint(), before)
+        self.connection.execute("insert into t values (1, 'again')")
+        self.assertNotEqual(source.fingerprint(), before)
+
+
+class FieldsTest(unittest.TestCase):
+
+    fields = ("region", "account", "name", "amount")
+
+    def test_tuple_rows_match_dict_rows(self):
+        rows = makerows()
+        rpt = makereport([ tuple([ row[name] for name in self.fields ]) for row in rows ])
+        rpt.fields = self.fields
+        self.assertEqual(pdfbytes(rpt), pdfbytes(makereport(rows)))
+        self.assertEqual(rpt.detailband.elements[1]._key, 3)
+        self.assertEqual(rpt.groupheaders[0].elements[0]._key, 0)
+
+    def test_other_keys_left_alone(self):
+        rpt = Report([ [ 1, 2 ] ])
+        element = Element((0, 0), ("Helvetica", 10), key = 1)
+        rpt.detailband = Band([ element ])
+        rpt.fields = [ "a", "b" ]
+        rpt.generate(NullCanvas((612, 792)))
+        self.assertEqual(element._key, 1)
+
+
+class SignatureTest(unittest.TestCase):
+
+    def test_empty_closure_cell(self):
+        def outer():
+            getvalue = lambda row: later(row)
+            return getvalue
+            later = str # never reached, so the closure cell stays empty
+        rpt = makereport()
+        rpt.detailband.elements.append(Element((300, 0), ("Helvetica", 10),
+                                               getvalue = outer()))
+        self.assertTrue(rpt.signature())
+
+    def test_changes_with_definition(self):
+        rpt = makereport()
+        before = rpt.signature()
+        self.assertEqual(makereport().signature(), before)
+        rpt.detailband.elements[1].format = lambda x: "%.3f" % x
+        self.assertNotEqual(rpt.signature(), before)
+
+
+class SplitBandTest(unittest.TestCase):
+
+    def generate(self, rows, width = None):
+        rpt = Report(rows)
+        rpt.pageheader = Band([ Element((36, 0), ("Helvetica", 10), text = "Header") ])
+        rpt.detailband = Band([ Element((36, 0), ("Helvetica", 10), key = "text",
+                                        width = width) ])
+        pages = [ [] ]
+        canvas = NullCanvas((612, 792))
+        canvas.drawString = lambda x, y, text: pages[-1].append((-y, text))
+        canvas.showPage = lambda: pages.append([])
+        rpt.generate(canvas)
+        return [ page for page in pages if page ]
+
+    def test_tall_band_split_across_pages(self):
+        lines = [ "line %d" % i for i in range(200) ]
+        pages = self.generate([ { "text": "before" }, { "text": "\n".join(lines) },
+                                { "text": "after" } ])
+        self.assertTrue(len(pages) >= 3)
+        printed = []
+        for page in pages:
+            self.assertEqual(page[0][1], "Header")
+            for y, text in page:
+                self.assertTrue(y <= 792 - 36)
+            printed.extend([ text for y, text in page[1:] ])
+        self.assertEqual(printed, [ "before" ] + lines + [ "after" ])
+
+    def test_long_wrapped_text_split(self):
+        words = [ "word%d" % i for i in range(2000) ]
+        pages = self.generate([ { "text": " ".join(words) } ], width = 200)
+        self.assertTrue(len(pages) >= 2)
+        printed = []
+        for page in pages:
+            printed.extend(" ".join([ text for y, text in page[1:] ]).split())
+        self.assertEqual(printed, words)
+
+
+class SpecTest(unittest.TestCase):
+
+    spec = {
+        "pageheader": { "elements": [
+            { "pos": [ 36, 0 ], "font": [ "Helvetica-Bold", 12 ], "text": "Test Report" },
+            { "pos": [ 500, 0 ], "font": [ "Helvetica", 10 ], "sysvar": "pagenumber",
+              "align": "right" } ] },
+        "detailband": { "elements": [
+            { "pos": [ 36, 0 ], "font": [ "Helvetica", 10 ], "key": "name" },
+            { "pos": [ 500, 0 ], "font": [ "Helvetica", 10 ], "key": "amount",
+              "align": "right", "format": "test-money" } ] },
+        "groupheaders": [
+            { "key": "region", "newpagebefore": 1, "elements": [
+                { "pos": [ 36, 0 ], "font": [ "Helvetica-Bold", 12 ], "key": "region",
+                  "format": "Region %d" } ] },
+            { "key": "account", "elements": [
+                { "pos": [ 36, 0 ], "font": [ "Helvetica", 11 ], "key": "account" } ] } ],
+        "groupfooters": [
+            { "key": "region", "elements": [
+                { "type": "sum", "pos": [ 500, 0 ], "font": [ "Helvetica", 10 ],
+                  "key": "amount", "align": "right", "format": "%.2f" } ] } ],
+        "reportfooter": { "elements": [
+            { "type": "sum", "pos": [ 500, 0 ], "font": [ "Helvetica-Bold", 10 ],
+              "key": "amount", "align": "right", "format": "%.2f" } ] },
+        "datasource": "test-rows",
+    }
+
+    def setUp(self):
+        registerformat("test-money", lambda x: "%.2f" % x)
+        registerfunction("test-rows", lambda count: makerows(count))
+
+    def test_matches_report_built_in_code(self):
+        rpt = reportfromspec(self.spec, { "count": 2000 })
+        self.assertEqual(pdfbytes(rpt), pdfbytes(makereport()))
+
+    def test_unknown_names_rejected(self):
+        self.assertRaises(ValueError, compilespec, { "detailband": { "height": 10 } })
+        self.assertRaises(ValueError, compilespec, { "pagesize": [ 612, 792 ] })
+        self.assertRaises(ValueError, compilespec, { "detailband": { "elements": [
+            { "type": "chart", "pos": [ 0, 0 ] } ] } })
+        self.assertRaises(ValueError, compilespec, { "detailband": {
+            "getvalue": "test-not-registered" } })
+
+
+class ProgressTest(unittest.TestCase):
+
+    def progress(self, rpt):
+        calls = []
+        rpt.onprogress = calls.append
+        rpt.generate(NullCanvas((612, 792)))
+        return calls
+
+    def test_by_rows(self):
+        rpt = makereport()
+        rpt.progressrows = 500
+        calls = self.progress(rpt)
+        self.assertEqual([ (p.rows, p.done) for p in calls ],
+                         [ (500, 0), (1000, 0), (1500, 0), (2000, 0), (2000, 1) ])
+        self.assertEqual([ p.total for p in calls ], [ 2000 ] * 5)
+        self.assertEqual(calls[-1].pages, rpt.pagenumber)
+        self.assertEqual(calls[-1].eta, 0.0)
+
+    def test_by_pages(self):
+        rpt = makereport()
+        rpt.progressrows = 0
+        rpt.progresspages = 10
+        calls = self.progress(rpt)
+        self.assertTrue(rpt.pagenumber > 20)
+        self.assertEqual([ p.pages for p in calls[:-1] ],
+                         list(range(10, rpt.pagenumber + 1, 10)))
+        self.assertTrue(calls[-1].done)
+
+    def test_total_unknown(self):
+        rpt = makereport(iter(makerows()))
+        rpt.progressrows = 1000
+        calls = self.progress(rpt)
+        self.assertEqual([ (p.total, p.eta) for p in calls[:-1] ], [ (None, None) ] * 2)
+
+
+class ProfileTest(unittest.TestCase):
+
+    def makereport(self):
+        rpt = makereport(makerows(100))
+        rpt.detailband.childbands = [
+            Band([ Element((36, 0), ("Helvetica", 8), key = "region") ]),
+        ]
+        return rpt
+
+    def test_child_bands_and_elements_timed(self):
+        expected = pdfbytes(self.makereport())
+        rpt = self.makereport()
+        rpt.profile = 1
+        self.assertEqual(pdfbytes(rpt), expected)
+        for name in ("detailband.elements[0]", "detailband.childbands[0]",
+                     "detailband.childbands[0].elements[0]"):
+            self.assertEqual(rpt.stats[name].calls["generate"], 100)
+
+
+class MemoTest(unittest.TestCase):
+
+    def test_equal_values_formatted_apart(self):
+        import decimal
+        element = Element((0, 0), ("Helvetica", 10), key = 0, memo = 100)
+        for value in (decimal.Decimal("1.00"), decimal.Decimal("1.0"), 0.0, -0.0, 1, 1.0):
+            self.assertEqual(element.gettext([ value ]), str(value))
+
+
+    def counted(self, values, memo = 10):
+        calls = []
+        def format(value):
+            calls.append(value)
+            return "<%s>" % value
+        element = Element((0, 0), ("Helvetica", 10), key = 0, format = format, memo = memo)
+        texts = [ element.gettext([ value ]) for value in values ]
+        self.assertEqual(texts, [ "<%s>" % value for value in values ])
+        return element, len(calls)
+
+    def test_repeated_values_formatted_once(self):
+        element, calls = self.counted([ "a", "b", "a", 1, "b", 1, 1.0 ] * 100)
+        self.assertEqual(calls, 4)
+
+    def test_values_beyond_memo_still_formatted(self):
+        element, calls = self.counted([ 1, 2, 3, 1, 2, 3 ], memo = 2)
+        self.assertEqual(calls, 4)
+
+    def test_gives_up_when_values_differ(self):
+        element, calls = self.counted(range(3000), memo = 10)
+        self.assertEqual(calls, 3000)
+        self.assertEqual(element._memo, None)
+
+    def test_same_report_output(self):
+        rpt = makereport()
+        rpt.detailband = Band([
+            Element((36, 0), ("Helvetica", 10), key = "name", memo = 1000),
+            Element((500, 0), ("Helvetica", 10), key = "amount", align = "right",
+                    format = lambda x: "%.2f" % x, memo = 1000),
+        ])
+        self.assertEqual(pdfbytes(rpt), pdfbytes(makereport()))
+
+
+class CrossTabTest(unittest.TestCase):
+
+    def test_average_needs_a_value(self):
+        self.assertRaises(ValueError, CrossTab, (0, 0), ("Helvetica", 10),
+                          rowkey = "region", columnkey = "account", aggregate = "average")
+
+    def test_average(self):
+        crosstab = CrossTab((0, 0), ("Helvetica", 10), rowkey = "region",
+                            columnkey = "account", key = "amount", aggregate = "average")
+        for amount in (1.0, 2.0, 6.0):
+            crosstab.summarize({ "region": 1, "account": 2, "amount": amount })
+        self.assertEqual(crosstab.formatvalue(crosstab.cells[(1, 2)]), "3.0")
+
+
+class TopElementTest(unittest.TestCase):
+
+    def test_width_wraps_labels(self):
+        rows = [ { "customer": "A customer with a very long name %d" % i, "amount": i }
+                 for i in range(3) ]
+        top = TopElement((0, 0), ("Helvetica", 10), key = "amount",
+                         labelkey = "customer", width = 80, count = 2)
+        for row in rows:
+            top.summarize(row)
+        renderer = top.generate(None)
+        label, value, nextlabel, nextvalue = renderer.renderers
+        self.assertTrue(len(label.lines) > 1)
+        self.assertEqual(value.lines, [ "2" ])
+        self.assertEqual(nextlabel.pos[1], label.height)
+        self.assertEqual(nextvalue.pos[1], label.height)
+        self.assertEqual(renderer.height, label.height + nextlabel.height)
+
+
+class QuantileElementTest(unittest.TestCase):
+
+    def quantile(self, values, **args):
+        element = QuantileElement((0, 0), ("Helvetica", 10), key = 0, **args)
+        for value in values:
+            element.summarize([ value ])
+        return element.getvalue(None)
+
+    def test_within_accuracy(self):
+        values = [ random.Random(3).uniform(-50, 1000) for i in range(5000) ]
+        ordered = sorted(values)
+        for quantile in (0.0, 0.1, 0.5, 0.95, 1.0):
+            exact = ordered[int(quantile * (len(values) - 1))]
+            estimate = self.quantile(values, quantile = quantile)
+            self.assertTrue(abs(estimate - exact) <= abs(exact) * 0.01,
+                            (quantile, estimate, exact))
+
+    def test_zeros_none_and_empty(self):
+        self.assertEqual(self.quantile([ 0, 0, None, 5 ]), 0)
+        self.assertEqual(self.quantile([ None ]), None)
+
+    def test_reset_after_each_group(self):
+        element = QuantileElement((0, 0), ("Helvetica", 10), key = 0)
+        element.summarize([ 10.0 ])
+        element.getvalue(None)
+        element.summarize([ 100.0 ])
+        self.assertTrue(abs(element.getvalue(None) - 100.0) <= 1.0)
+
+    def test_collapse_keeps_high_quantiles(self):
+        values = [ 1.5 ** i for i in range(40) ] * 10
+        exact = sorted(values)[int(0.99 * (len(values) - 1))]
+        estimate = self.quantile(values, quantile = 0.99, maxbuckets = 10)
+        self.assertTrue(abs(estimate - exact) <= exact * 0.01)
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, QuantileElement, (0, 0), ("Helvetica", 10),
+                          key = 0, quantile = 1.5)
+        self.assertRaises(ValueError, QuantileElement, (0, 0), ("Helvetica", 10),
+                          key = 0, accuracy = 0)
+
+
+class LimitsTest(unittest.TestCase):
+
+    def generate(self, rpt, canvas = None):
+        if canvas is None:
+            canvas = NullCanvas((612, 792))
+        return rpt.generate(canvas)
+
+    def test_unlimited(self):
+        rpt = makereport()
+        self.assertEqual(self.generate(rpt), None)
+        self.assertEqual(rpt.stopped, None)
+
+    def test_maxrows(self):
+        rpt = makereport()
+        rpt.maxrows = 100
+        stopped = self.generate(rpt)
+        self.assertTrue(isinstance(stopped, LimitReached))
+        self.assertTrue(rpt.stopped is stopped)
+        self.assertEqual((stopped.reason, stopped.rows), ("rows", 100))
+
+    def test_maxpages(self):
+        rpt = makereport()
+        rpt.maxpages = 3
+        stopped = self.generate(rpt)
+        self.assertEqual((stopped.reason, stopped.pages, rpt.pagenumber), ("pages", 3, 3))
+
+    def test_maxseconds(self):
+        rpt = makereport()
+        rpt.maxseconds = 0
+        self.assertEqual(self.generate(rpt).reason, "time")
+
+    def test_maxbytes(self):
+        rpt = makereport()
+        rpt.maxbytes = 1
+        self.assertRaises(ValueError, self.generate, rpt)
+        output = io.BytesIO()
+        stopped = self.generate(rpt, PDFCanvas(output))
+        self.assertEqual((stopped.reason, stopped.pages), ("bytes", 1))
+
+    def test_cancel(self):
+        import threading
+        event = threading.Event()
+        def onrow(row):
+            if row["name"] == "Customer 50":
+                event.set()
+            return row
+        rpt = makereport()
+        rpt.onrow = onrow
+        rpt.cancel = event
+        stopped = self.generate(rpt)
+        self.assertEqual((stopped.reason, stopped.rows), ("cancelled", 51))
+
+        rpt = makereport()
+        rpt.cancel = lambda: rpt.rownumber >= 10
+        self.assertEqual(self.generate(rpt).rows, 10)
+
+    def test_partial_output_saved(self):
+        rpt = makereport()
+        rpt.maxpages = 2
+        output = io.BytesIO()
+        canvas = PDFCanvas(output)
+        self.generate(rpt, canvas)
+        canvas.save()
+        self.assertEqual(output.getvalue().count(b"/Type /Page "), 2)
+
+
+class PDFCanvasTest(unittest.TestCase):
+
+    def test_images_rejected_before_drawing(self):
+        rpt = makereport()
+        rpt.pageheader.elements.append(Image((540, 0), 12, 12, text = "logo.png"))
+        output = io.BytesIO()
+        canvas = PDFCanvas(output)
+        self.assertRaises(TypeError, rpt.generate, canvas)
+        self.assertEqual(canvas.pages, [])
+        self.assertRaises(TypeError, canvas.drawImage, "logo.png", 0, 0)
+
+
+class CSVCanvasTest(TempDirTestCase):
+
+    def makereport(self):
+        rows = [ { "name": "Customer %d" % i, "city": "Town, %d" % i,
+                   "note": "a note long enough to be wrapped onto several lines" }
+                 for i in range(3) ]
+        rpt = Report(rows)
+        rpt.detailband = Band([
+            Element((36, 0), ("Helvetica", 10), key = "name"),
+            Element((36, 12), ("Helvetica", 10), key = "city"),
+            Element((200, 0), ("Helvetica", 10), key = "note", width = 100),
+        ])
+        return rpt
+
+    def generate(self, rpt):
+        output = io.StringIO()
+        canvas = CSVCanvas(output)
+        rpt.generate(canvas)
+        canvas.save()
+        return output.getvalue()
+
+    def test_stacked_elements_keep_their_fields(self):
+        text = self.generate(self.makereport())
+        self.assertEqual(text.split("\r\n")[0],
+            'Customer 0,"a note long\nenough to be\nwrapped onto\nseveral lines","Town, 0"')
+        self.assertEqual(len(text.split("\r\n")), 4)
+
+    def test_group_cache_replay(self):
+        expected = self.generate(self.makereport())
+        rpt = self.makereport()
+        rpt.groupheaders = [ Band([], key = "name", newpagebefore = 1) ]
+        rpt.groupcache = self.tempdir
+        self.assertEqual(self.generate(rpt), expected)
+        self.assertEqual(self.generate(rpt), expected)
+        self.assertEqual(rpt.groupcachehits, 2)
+
+
+def pooledreports():
+    return { "small": lambda: makereport(makerows(50)) }
+
+
+class ReportPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shared = makereport(makerows(400))
+        self.pool = LocalReportPool(lambda: { "shared": lambda: self.shared },
+                                    lambda output, pagesize: PDFCanvas(output, pagesize))
+
+    def test_job_limits_do_not_leak(self):
+        self.assertEqual(self.pool.run("shared", limits = { "maxpages": 2 }).pages, 2)
+        self.assertEqual(self.pool.run("shared").pages, 10)
+        self.assertEqual(self.shared.maxpages, None)
+
+    def test_compilespec_returns_separate_reports(self):
+        spec = { "detailband": { "elements": [
+                    { "type": "element", "pos": [ 0, 0 ], "font": [ "Helvetica", 10 ],
+                      "key": "name" } ] } }
+        first = compilespec(spec)
+        second = compilespec(spec)
+        self.assertFalse(first is second)
+        self.assertFalse(first.detailband is second.detailband)
+        first.maxpages = 1
+        self.assertEqual(compilespec(spec).maxpages, None)
+
+
+class ReportServerTest(unittest.TestCase):
+
+    def setUp(self):
+        import threading
+        pool = LocalReportPool(pooledreports,
+                               lambda output, pagesize: PDFCanvas(output, pagesize))
+        self.server = ReportServer(pool)
+        self.thread = threading.Thread(target = self.server.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_makes_an_authkey(self):
+        self.assertEqual(len(self.server.authkey), 32)
+
+    def test_serves_on_after_a_wrong_key(self):
+        from multiprocessing import AuthenticationError
+        self.assertRaises(AuthenticationError, ReportClient,
+                          self.server.address, b"wrong key")
+        client = ReportClient(self.server.address, self.server.authkey)
+        try:
+            result = client.run("small")
+        finally:
+            client.close()
+        self.assertEqual(result.rows, 50)
+        self.assertTrue(self.thread.is_alive())
+
+
+class ReportlabOutlineTest(unittest.TestCase):
+
+    def test_generatepages_within_a_group(self):
+        try:
+            from reportlab.pdfgen.canvas import Canvas
+        except ImportError:
+            self.skipTest("Reportlab is not installed")
+        rpt = makereport()
+        rpt.groupheaders[0].bookmark = 1
+        rpt.groupheaders[1].bookmark = 1
+        pageindex = rpt.paginate((612, 792))
+        canvas = Canvas(io.BytesIO(), pagesize = (612, 792))
+        rpt.generatepages(canvas, pageindex, 2, 3)
+        canvas.save()
+        self.assertEqual(rpt.contents[0][0], 1)
+
+
+class OutputCacheTest(TempDirTestCase):
+
+    def makereport(self, image):
+        rpt = makereport()
+        rpt.pageheader.elements.append(Image((540, 0), 12, 12, text = image))
+        rpt.outputcache = os.path.join(self.tempdir, "cache")
+        rpt.fingerprint = "rows"
+        return rpt
+
+    def generate(self, rpt):
+        filename = os.path.join(self.tempdir, "report.txt")
+        rpt.generatefile(filename, (612, 792),
+                         lambda filename, pagesize: TextCanvas(filename, pagesize))
+
+    def test_canvas_type_misses(self):
+        rpt = self.makereport(os.path.join(self.tempdir, "missing.png"))
+        filename = os.path.join(self.tempdir, "report.out")
+        rpt.generatefile(filename, (612, 792),
+                         lambda filename, pagesize: TextCanvas(filename, pagesize))
+        rpt.generatefile(filename, (612, 792),
+                         lambda filename, pagesize: HTMLCanvas(filename, pagesize))
+        self.assertEqual((rpt.outputcachehits, rpt.outputcachemisses), (0, 2))
+        f = open(filename)
+        self.assertTrue(f.read().startswith("<!DOCTYPE html>"))
+        f.close()
+
+    def test_replaced_image_misses(self):
+        image = os.path.join(self.tempdir, "logo.png")
+        f = open(image, "wb")
+        f.write(b"first")
+        f.close()
+        rpt = self.makereport(image)
+        self.generate(rpt)
+        self.generate(rpt)
+        self.assertEqual((rpt.outputcachehits, rpt.outputcachemisses), (1, 1))
+        f = open(image, "wb")
+        f.write(b"second image")
+        f.close()
+        self.generate(rpt)
+        self.assertEqual((rpt.outputcachehits, rpt.outputcachemisses), (1, 2))
+
+
+class SameOutputTest(TempDirTestCase):
+
+    # every way of generating a report must give the same pages as
+    # Report.generate().
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.expected = pdfbytes(makereport())
+
+    def test_generate_is_repeatable(self):
+        rpt = makereport()
+        self.assertEqual(pdfbytes(rpt), self.expected)
+        self.assertEqual(pdfbytes(rpt), self.expected)
+
+    def test_fixed_height_rows_counted(self):
+        # rows of a fixed height detail band are placed without the
+        # page checks, which are made once per page instead.
+        rpt = makereport()
+        calls = []
+        makeroom = rpt.makeroom
+        def countingmakeroom(*args):
+            calls.append(1)
+            return makeroom(*args)
+        rpt.makeroom = countingmakeroom
+        self.assertEqual(pdfbytes(rpt), self.expected)
+        self.assertTrue(0 < len(calls) < 100)
+
+        # an ondetail function has every row checked.
+        checked = makereport()
+        checked.ondetail = lambda rpt: None
+        self.assertEqual(pdfbytes(checked), self.expected)
+
+    def test_groupcache(self):
+        cachedir = os.path.join(self.tempdir, "groups")
+        for hits in (0, 4):
+            rpt = makereport()
+            rpt.groupcache = cachedir
+            self.assertEqual(pdfbytes(rpt), self.expected)
+            self.assertEqual(rpt.groupcachehits, hits)
+
+    def test_generatesharded(self):
+        self.assertEqual(pdfbytes(makereport(), "generatesharded"), self.expected)
+
+    def test_threaded_compression(self):
+        self.assertEqual(pdfbytes(makereport(), threads = 3), self.expected)
+
+    def interrupt(self, filename):
+
+        class Interrupted(Exception):
+            pass
+
+        def onrow(row):
+            if row["name"] == "Customer 1500":
+                raise Interrupted
+            return row
+
+        rpt = makereport()
+        rpt.checkpointfile = filename + ".checkpoint"
+        rpt.checkpointpages = 3
+        rpt.onrow = onrow
+        self.assertRaises(Interrupted, rpt.generate, PDFCanvas(filename))
+        self.assertTrue(os.path.exists(rpt.checkpointfile))
+
+    def test_resume(self):
+        filename = os.path.join(self.tempdir, "report.pdf")
+        self.interrupt(filename)
+        self.resume(filename)
+
+    def test_dry_runs_leave_checkpoint_alone(self):
+        filename = os.path.join(self.tempdir, "report.pdf")
+        self.interrupt(filename)
+        f = open(filename + ".checkpoint", "rb")
+        saved = f.read()
+        f.close()
+        rpt = makereport()
+        rpt.checkpointfile = filename + ".checkpoint"
+        rpt.checkpointpages = 1
+        pageindex = rpt.paginate((612, 792))
+        rpt.generatepages(NullCanvas((612, 792)), pageindex, 2, pageindex.pagecount)
+        f = open(filename + ".checkpoint", "rb")
+        self.assertEqual(f.read(), saved)
+        f.close()
+        self.resume(filename)
+
+    def test_checkpoint_state_saved_only_near_checkpoints(self):
+        rpt = makereport()
+        rpt.checkpointfile = os.path.join(self.tempdir, "report.checkpoint")
+        rpt.checkpointpages = 1000
+        calls = []
+        savestate = rpt.savestate
+        def countingsavestate():
+            calls.append(1)
+            return savestate()
+        rpt.savestate = countingsavestate
+        pdfbytes(rpt)
+        self.assertEqual(len(calls), 1)
+
+    def test_resume_csv_twice(self):
+        source = os.path.join(self.tempdir, "rows.csv")
+        f = open(source, "w")
+        f.write("region,account,name,amount\n")
+        for row in makerows():
+            f.write("%(region)d,%(account)d,%(name)s,%(amount)r\n" % row)
+        f.close()
+        filename = os.path.join(self.tempdir, "report.pdf")
+
+        class Interrupted(Exception):
+            pass
+
+        def makecsvreport(stopat):
+            def onrow(row):
+                if row["name"] == stopat:
+                    raise Interrupted
+                return row
+            rpt = makereport(CSVSource(source,
+                types = { "region": int, "account": int, "amount": float }))
+            rpt.checkpointfile = filename + ".checkpoint"
+            rpt.checkpointpages = 3
+            rpt.onrow = onrow
+            return rpt
+
+        rpt = makecsvreport("Customer 800")
+        self.assertRaises(Interrupted, rpt.generate, PDFCanvas(filename))
+        rpt = makecsvreport("Customer 1500")
+        self.assertRaises(Interrupted, rpt.resume, PDFCanvas(filename))
+        rpt = makecsvreport(None)
+        canvas = PDFCanvas(filename)
+        rpt.resume(canvas)
+        canvas.save()
+        f = open(filename, "rb")
+        try:
+            self.assertEqual(f.read(), self.expected)
+        finally:
+            f.close()
+
+    def resume(self, filename):
+        rpt = makereport()
+        rpt.checkpointfile = filename + ".checkpoint"
+        rpt.checkpointpages = 3
+        canvas = PDFCanvas(filename)
+        rpt.resume(canvas)
+        canvas.save()
+        f = open(filename, "rb")
+        try:
+            self.assertEqual(f.read(), self.expected)
+        finally:
+            f.close()
+        self.assertFalse(os.path.exists(rpt.checkpointfile))
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# end of file.